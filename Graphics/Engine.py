@@ -7,79 +7,327 @@ from itertools import *
 from OpenGL.GLU import *
 from Graphics.Utils.shader_utils import *
 from Graphics.Utils import Shapes
+from Graphics.Utils import transforms
+from Graphics.Utils import culling
+from Graphics.Utils.render_queue import RenderQueue
+from Graphics.Physics import PhysicsWorld
+from Graphics.Simulation import SimulationThread
+from Graphics.Utils import offscreen
+from Graphics.Utils import profiler
+from Graphics.Utils.assets import AssetLoader
+from Graphics.Utils import cache
+from Graphics.Utils.profiler import Profiler
+from Graphics.Utils.lights import LightManager
+from Graphics.Utils.occlusion import OcclusionCuller
+from Graphics.Utils.batching import StaticBatcher
+from Graphics.Utils.scene_store import SceneStore, SceneNode
+from Graphics.Utils.raycast import RayCaster, RayHit, RayHits
 from typing import Optional, List, Dict
 from glm import *
+import numpy as np
+import threading
+import time
 
 
 class PointLight:
-    def __init__(self, position, color, intensity, radius):
+    # Values live in a light_dtype row: the light's own until it is added to a LightManager (Root.addLight),
+    # the manager's buffer afterwards. position / color return copies, assign them to change the light
+    def __init__(self, position, color, intensity, radius, constant: float = 1.0, linear: Optional[float] = None, quadratic: Optional[float] = None):
+        self.manager: Optional[LightManager] = None
+        self.slot = 0
+        self.row = np.zeros(1, dtype=light_dtype)
         self.position = position
         self.color = color
         self.intensity = intensity
         self.radius = radius
+        # Attenuation falls to a few percent at the radius unless given explicitly
+        self.constant = constant
+        self.linear = 4.5 / radius if linear is None else linear
+        self.quadratic = 75.0 / (radius * radius) if quadratic is None else quadratic
+
+    def attach(self, manager: LightManager, slot: int, copy: bool = True):
+        if copy:
+            manager.data[slot] = self.row[0]
+        self.manager = manager
+        self.slot = slot
+        self.row = manager.data[slot:slot + 1]
+
+    def detach(self):
+        self.row = self.row.copy()
+        self.manager = None
+
+    @property
+    def position(self) -> vec3:
+        return vec3(*self.row["position"][0].tolist())
+
+    @position.setter
+    def position(self, value):
+        self.row["position"][0] = tuple(value)
+
+    @property
+    def color(self) -> tuple:
+        return tuple(self.row["color"][0].tolist())
+
+    @color.setter
+    def color(self, value):
+        self.row["color"][0] = tuple(value)
+
+    @property
+    def intensity(self) -> float:
+        return float(self.row["intensity"][0])
+
+    @intensity.setter
+    def intensity(self, value: float):
+        self.row["intensity"][0] = value
+
+    @property
+    def radius(self) -> float:
+        return float(self.row["radius"][0])
+
+    @radius.setter
+    def radius(self, value: float):
+        # The default attenuation divides by it, and lights without a range would never be assigned to a cluster
+        if not value > 0.0:
+            raise ValueError(f"Light radius has to be positive, got {value}")
+        self.row["radius"][0] = value
+
+    @property
+    def constant(self) -> float:
+        return float(self.row["constant"][0])
+
+    @constant.setter
+    def constant(self, value: float):
+        self.row["constant"][0] = value
+
+    @property
+    def linear(self) -> float:
+        return float(self.row["linear"][0])
+
+    @linear.setter
+    def linear(self, value: float):
+        self.row["linear"][0] = value
+
+    @property
+    def quadratic(self) -> float:
+        return float(self.row["quadratic"][0])
+
+    @quadratic.setter
+    def quadratic(self, value: float):
+        self.row["quadratic"][0] = value
+
+class Object(SceneNode):
+    # Handle onto a row of rootNode.nodes (see Graphics/Utils/scene_store.py), children and shapes dicts
+    # are only created once something is added
+    __slots__ = ("rootNode", "name", "activeCamera", "parent", "body", "_shapes", "_children")
 
-class Object:
     def __init__(self, rootNode: Root, name: str, activeCamera: Optional[Camera] = None, parent: Optional['Object'] = None, position: vec3 = vec3(0, 0, 0), angle: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1)):
+        self.init_fields(rootNode, name, activeCamera, parent)
+        self.init_transform(position, angle, scale)
+        self.attach_node(rootNode.nodes, -1 if parent is None else parent.node)
+
+    def init_fields(self, rootNode: Root, name: str, activeCamera: Optional[Camera], parent: Optional['Object']):
+        # Everything but the transform, addChildren creates its objects with this and attaches them all at once
         self.rootNode = rootNode
         self.name: str = name
-        self.shapes: Dict[str, Shapes.Shape] = {}
+        self._shapes: Optional[Dict[str, Shapes.Shape]] = None
         self.activeCamera: Camera = activeCamera
-        self.children: Dict[str, Object] = {}  # Correcting this initialization
+        self._children: Optional[Dict[str, Object]] = None
         self.parent = parent
-        self.position = position
-        self.scale = scale
-        self.angle = angle
-
-
-
+        # Row of this object in rootNode.physics, None when it is not simulated
+        self.body: Optional[int] = None
+
+    @property
+    def shapes(self) -> Dict[str, Shapes.Shape]:
+        if self._shapes is None:
+            self._shapes = {}
+        return self._shapes
+
+    @property
+    def children(self) -> Dict[str, Object]:
+        if self._children is None:
+            self._children = {}
+        return self._children
+
+    # Assigning position/angle/scale (including +=) moves the node. The getters return copies, so editing a
+    # component in place (obj.position.x = 1.0) has no effect, assign the whole vector instead
+    @property
+    def position(self) -> vec3:
+        return vec3(*self.get_trs()[0].tolist())
+
+    @position.setter
+    def position(self, value: vec3):
+        self.get_trs()[0] = tuple(value)
+        self.changed_trs()
+
+    @property
+    def angle(self) -> vec3:
+        return vec3(*self.get_trs()[1].tolist())
+
+    @angle.setter
+    def angle(self, value: vec3):
+        self.get_trs()[1] = tuple(value)
+        self.changed_trs()
+
+    @property
+    def scale(self) -> vec3:
+        return vec3(*self.get_trs()[2].tolist())
+
+    @scale.setter
+    def scale(self, value: vec3):
+        self.get_trs()[2] = tuple(value)
+        self.changed_trs()
+
+    def mark_dirty(self):
+        self.changed_trs()
+
+    def get_local_matrix(self) -> np.ndarray:
+        return self.get_local_array()
+
+    def get_world_matrix(self) -> np.ndarray:
+        # Row-major, computed for the whole tree at once when anything moved
+        return self.get_world_array()
+
+    # Children are positioned relative to their parent, so moving a node moves its whole subtree
     def move(self, amount: vec3):
-        self.position += amount
-        for name, child in self.children:
-            child.move(amount)
+        self.position = self.position + amount
 
     def move_to(self, where: vec3):
         self.position = where
-        for name, child in self.children:
-            child.move_to(where)
 
     def apply_scale(self, scale: vec3):  # Renaming scale method to avoid conflict
         self.scale = scale
 
     def rotate(self, rotation: vec3):  # Fixed typo here (rocation -> rotation)
-        self.angle += rotation
-        for i, a in self.children:
-            a.rotate(rotation)
+        self.angle = self.angle + rotation
 
     def rotate_to(self, rotation: vec3):  # Fixed typo here (rocation -> rotation)
         self.angle = rotation
-        for i, a in self.children:
-            a.rotate_to(rotation)
 
+    # Taken names get a _1, _2, ... suffix (see Root.unique_name), the name actually used is the returned
+    # object's name / the key of the shape in shapes
     def addChild(self, name: str, position: vec3 = vec3(0.0, 0.0, 0.0), angle: vec3 = vec3(0.0, 0.0, 0.0), scale: vec3 = vec3(1.0, 1.0, 1.0)):
-        if not (name in self.children):
-            self.children[name] = Object(self.rootNode, name, None, self, position, angle, scale)
-        else:
-            i = 1
-            new_name = name + "_" + str(i)
-            while new_name in self.children:
-                i += 1
-            self.children[new_name] = Object(self.rootNode, new_name, None, self, position, angle, scale)
+        path = self.get_path() + "/"
+        name = self.rootNode.unique_name(path, name)
+        child = self.children[name] = Object(self.rootNode, name, None, self, position, angle, scale)
+        self.rootNode.paths[path + name] = child
+        return child
+
+    def addChildren(self, name: str, positions, angles=None, scales=None, shape: Optional[Shapes.Mesh] = None, shape_name: str = "shape") -> List[Object]:
+        # Bulk addChild: one child per row of positions (angles / scales default to 0 / 1 and may be a single row),
+        # named like repeated addChild(name) calls. Every child gets a clone of shape (see Mesh.clone), their
+        # transform rows are allocated in one go
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        count = len(positions)
+        trs = np.empty((count, 3, 3), dtype=np.float32)
+        trs[:, 0] = positions
+        trs[:, 1] = 0.0 if angles is None else np.asarray(angles, dtype=np.float32).reshape(-1, 3)
+        trs[:, 2] = 1.0 if scales is None else np.asarray(scales, dtype=np.float32).reshape(-1, 3)
+
+        root = self.rootNode
+        path = self.get_path() + "/"
+        children = []
+        for _ in range(count):
+            child = Object.__new__(Object)
+            child.init_fields(root, root.unique_name(path, name), None, self)
+            root.paths[path + child.name] = child
+            children.append(child)
+        nodes = SceneNode.attach_many(children, root.nodes, self.node, trs)
+        self.children.update((child.name, child) for child in children)
+
+        if shape is not None:
+            clones = [shape.clone() for _ in range(count)]
+            SceneNode.attach_many(clones, root.nodes, nodes, shape.get_trs())
+            for child, clone in zip(children, clones):
+                clone.object = child
+                child._shapes = {shape_name: clone}
+                root.paths[f"{path}{child.name}:{shape_name}"] = clone
+            root.scene.add_many(clones)
+        return children
+
+    def addInstancedGroup(self, name: str, mesh: Shapes.Mesh, position: vec3 = vec3(0.0, 0.0, 0.0), angle: vec3 = vec3(0.0, 0.0, 0.0), scale: vec3 = vec3(1.0, 1.0, 1.0), material: str = "instanced") -> InstancedGroup:
+        path = self.get_path() + "/"
+        name = self.rootNode.unique_name(path, name)
+        group = self.children[name] = InstancedGroup(self.rootNode, name, mesh, None, self, position, angle, scale, material)
+        self.rootNode.paths[path + name] = group
+        self.rootNode.scene.add(group)
+        return group
 
     def removeChild(self, name: str):
-        self.children.pop(name)
+        child = self.children.pop(name)
+        paths = self.rootNode.paths
+        for node in list(child.walk()):
+            path = node.get_path()
+            paths.pop(path, None)
+            for drawable in node.get_drawables():
+                self.rootNode.scene.remove(drawable)
+                self.rootNode.static_batches.discard(drawable)
+            # Rows go back to the store, the handles keep working on their own copy of the transform
+            if node._shapes is not None:
+                for shape_name, shape in node._shapes.items():
+                    paths.pop(f"{path}:{shape_name}", None)
+                    shape.release_node()
+            node.release_node()
 
     def addShape(self, name: str, shape: Shapes.Shape):
-        if not (name in self.shapes):
-            self.shapes[name] = shape
-            self.shapes[name].object = self
-        else:
-            i = 1
-            new_name = name + "_" + str(i)
-            while new_name in self.shapes:
-                i += 1
-            self.shapes[new_name] = shape
-            self.shapes[name].object = self
-
+        path = self.get_path() + ":"
+        name = self.rootNode.unique_name(path, name)
+        self.shapes[name] = shape
+        shape.object = self
+        self.rootNode.paths[path + name] = shape
+        shape.attach_node(self.rootNode.nodes, self.node)
+        self.rootNode.scene.add(shape)
+
+    def get_path(self) -> str:
+        # "Root/Cube/Wheel_3", shapes are "Root/Cube:Cube" in Root.paths
+        if self.parent is None:
+            return self.name
+        return self.parent.get_path() + "/" + self.name
+
+    def find(self, path: str):
+        # Object or shape at a path relative to this one ("Wheel_3", "Wheel_3/Hub:mesh"), None if there is none
+        return self.rootNode.paths.get(self.get_path() + ("" if path[:1] == ":" else "/") + path)
+
+    def make_static(self):
+        # Merges the meshes of this subtree into world space batches (see batching.py). Moving a static node
+        # has no visible effect until rebuild_static() is called
+        self.rootNode.static_batches.add(self)
+
+    def set_static_hidden(self, hidden: bool):
+        self.rootNode.static_batches.set_hidden(self, hidden)
+
+    def rebuild_static(self):
+        # Re-transforms this subtree's meshes inside their batches, after moving it or editing its vertices
+        self.rootNode.static_batches.rebuild(self)
+
+    def get_drawables(self) -> list:
+        # Everything this node registers as a leaf of the scene BVH
+        return self.get_shapes()
+
+    def get_shapes(self) -> list:
+        return [] if self._shapes is None else list(self._shapes.values())
+
+    def get_children(self) -> list:
+        return [] if self._children is None else list(self._children.values())
+
+    def walk(self):
+        # This node and all of its descendants, depth first
+        yield self
+        if self._children is not None:
+            for child in self._children.values():
+                yield from child.walk()
+
+    def get_bounds(self):
+        # World space AABB (min, max) of everything drawn in this subtree, None if it draws nothing
+        mins = []
+        maxs = []
+        for node in self.walk():
+            for drawable in node.get_drawables():
+                lo, hi = drawable.get_world_bounds()
+                mins.append(lo)
+                maxs.append(hi)
+        if not mins:
+            return None
+        return np.min(mins, axis=0), np.max(maxs, axis=0)
 
     def getCamera(self):
         if self.activeCamera != None:
@@ -88,25 +336,199 @@ class Object:
             return self.parent.getCamera()
 
     def draw(self):
-
-        camera: Camera = self.getCamera()
-
-        glPushMatrix()
-        glTranslatef(self.position.x, self.position.y, self.position.z)  # Apply translation
-        glRotatef(self.angle.x, 1, 0, 0)  # Apply rotation on the X-axis
-        glRotatef(self.angle.y, 0, 1, 0)  # Apply rotation on the Y-axis
-        glRotatef(self.angle.z, 0, 0, 1)  # Apply rotation on the Z-axis
-        glScalef(self.scale.x, self.scale.y, self.scale.z)  # Apply scaling
-
+        # Shapes read their model matrix from the cached world transform, nothing is recomputed unless dirty
         # Draw all elements in this object (e.g., cubes, spheres, etc.)
-        for shape_name, shape in self.shapes.items():
+        for shape in self.get_shapes():
             shape.draw()
 
-        glPopMatrix()
-
-        for child_name, child in self.children.items():
+        for child in self.get_children():
             child.draw()
-        pass
+
+class InstancedGroup(Object):
+    # Many copies of one mesh drawn with a single glDrawElementsInstanced call.
+    # Per-instance transforms live in NumPy arrays, only the rows changed since the last frame are re-uploaded.
+    ROW_BYTES = 16 * 4
+
+    def __init__(self, rootNode: Root, name: str, mesh: Shapes.Mesh, activeCamera: Optional[Camera] = None, parent: Optional[Object] = None, position: vec3 = vec3(0, 0, 0), angle: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1), material: str = "instanced", capacity: int = 64):
+        super().__init__(rootNode, name, activeCamera, parent, position, angle, scale)
+        self.mesh = mesh
+        self.mesh.object = self
+        self.mesh.material = material
+
+        self.count = 0
+        self.capacity = 0
+        self.instance_positions = np.zeros((0, 3), dtype=np.float32)
+        self.instance_angles = np.zeros((0, 3), dtype=np.float32)
+        self.instance_scales = np.zeros((0, 3), dtype=np.float32)
+        self.instance_matrices = np.zeros((0, 16), dtype=np.float32)
+        self.dirty_rows = np.zeros(0, dtype=bool)
+        self.reserve(capacity)
+
+        self.vao = None
+        self.instance_vbo = None
+        self.gpu_capacity = 0
+
+    def reserve(self, capacity: int):
+        if capacity <= self.capacity:
+            return
+        # Grow geometrically so repeated adds stay amortised O(1)
+        capacity = capacity if capacity > self.capacity * 2 else self.capacity * 2
+
+        def grow(array, fill):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            return grown
+
+        self.instance_positions = grow(self.instance_positions, 0.0)
+        self.instance_angles = grow(self.instance_angles, 0.0)
+        self.instance_scales = grow(self.instance_scales, 1.0)
+        self.instance_matrices = grow(self.instance_matrices, 0.0)
+        self.dirty_rows = grow(self.dirty_rows, False)
+        self.capacity = capacity
+
+    def add_instances(self, positions, angles=None, scales=None) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        n = len(positions)
+        self.reserve(self.count + n)
+
+        ids = np.arange(self.count, self.count + n)
+        self.count += n
+        self.set_instances(ids, positions, np.zeros((n, 3)) if angles is None else angles, np.ones((n, 3)) if scales is None else scales)
+        return ids
+
+    def add_instance(self, position: vec3 = vec3(0, 0, 0), angle: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1)) -> int:
+        return int(self.add_instances([tuple(position)], [tuple(angle)], [tuple(scale)])[0])
+
+    def set_instances(self, ids, positions=None, angles=None, scales=None):
+        ids = np.asarray(ids, dtype=np.int64)
+        if positions is not None:
+            self.instance_positions[ids] = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        if angles is not None:
+            self.instance_angles[ids] = np.asarray(angles, dtype=np.float32).reshape(-1, 3)
+        if scales is not None:
+            self.instance_scales[ids] = np.asarray(scales, dtype=np.float32).reshape(-1, 3)
+        self.dirty_rows[ids] = True
+        self.rootNode.scene.mark_moved(self)
+
+    def set_instance(self, id: int, position: Optional[vec3] = None, angle: Optional[vec3] = None, scale: Optional[vec3] = None):
+        self.set_instances([id],
+                           None if position is None else [tuple(position)],
+                           None if angle is None else [tuple(angle)],
+                           None if scale is None else [tuple(scale)])
+
+    def remove_instance(self, id: int) -> int:
+        # Swap-remove: the last instance takes over the removed row, its old id is returned so callers can remap it
+        last = self.count - 1
+        if id != last:
+            self.instance_positions[id] = self.instance_positions[last]
+            self.instance_angles[id] = self.instance_angles[last]
+            self.instance_scales[id] = self.instance_scales[last]
+            self.dirty_rows[id] = True
+        self.dirty_rows[last] = False
+        self.count = last
+        self.rootNode.scene.mark_moved(self)
+        return last
+
+    def update_matrices(self) -> np.ndarray:
+        rows = np.flatnonzero(self.dirty_rows[:self.count])
+        if len(rows):
+            self.instance_matrices[rows] = transforms.column_major(transforms.compose_matrices(
+                self.instance_positions[rows], self.instance_angles[rows], self.instance_scales[rows]))
+        return rows
+
+    def upload(self):
+        rows = self.update_matrices()
+
+        if self.vao is None:
+            if self.mesh.dirty:
+                self.mesh.upload()
+            self.vao = glGenVertexArrays(1)
+            self.instance_vbo = glGenBuffers(1)
+
+            glBindVertexArray(self.vao)
+            self.mesh.bind_attributes()
+            glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+            # A mat4 attribute takes four consecutive vec4 locations, one column each
+            for column in range(4):
+                glVertexAttribPointer(2 + column, 4, GL_FLOAT, GL_FALSE, self.ROW_BYTES, ctypes.c_void_p(column * 16))
+                glEnableVertexAttribArray(2 + column)
+                glVertexAttribDivisor(2 + column, 1)
+            glBindVertexArray(0)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
+        if self.gpu_capacity != self.capacity:
+            # Buffer was (re)allocated, send everything once
+            glBufferData(GL_ARRAY_BUFFER, self.capacity * self.ROW_BYTES, self.instance_matrices, GL_DYNAMIC_DRAW)
+            self.gpu_capacity = self.capacity
+            profiler.count("uploaded_bytes", self.capacity * self.ROW_BYTES)
+        elif len(rows):
+            # Upload each contiguous run of changed rows
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            for run in np.split(rows, breaks):
+                start, end = int(run[0]), int(run[-1]) + 1
+                glBufferSubData(GL_ARRAY_BUFFER, start * self.ROW_BYTES, (end - start) * self.ROW_BYTES, self.instance_matrices[start:end])
+                profiler.count("uploaded_bytes", (end - start) * self.ROW_BYTES)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.dirty_rows[:] = False
+
+    def get_drawables(self) -> list:
+        return [self] + self.get_shapes()
+
+    def get_triangle_count(self) -> int:
+        return self.mesh.get_triangle_count() * self.count
+
+    def get_vao(self):
+        return self.vao
+
+    def get_instance_model_matrices(self) -> np.ndarray:
+        # Row-major (count, 4, 4) world matrices of the mesh for every instance
+        self.update_matrices()
+        instances = self.instance_matrices[:self.count].reshape(-1, 4, 4).transpose(0, 2, 1)
+        return self.get_world_matrix() @ instances @ self.mesh.get_local_matrix()
+
+    def get_world_bounds(self):
+        if self.count == 0:
+            # Degenerate box at the group's origin, an infinite one would make BVH centers and depths NaN
+            origin = np.array(self.get_world_matrix()[:3, 3], dtype=np.float32)
+            return origin, origin.copy()
+        matrices = self.get_instance_model_matrices()
+        mins, maxs = culling.transform_aabb(matrices, self.mesh.bounds_min, self.mesh.bounds_max)
+        return mins.min(axis=0), maxs.max(axis=0)
+
+    def draw(self):
+        self.draw_geometry()
+        super().draw()
+
+    def draw_geometry(self):
+        if self.count:
+            self.prepare()
+            material = self.get_material()
+            material.use()
+
+            glBindVertexArray(self.vao)
+            self.issue_draw(material)
+            glBindVertexArray(0)
+
+    def prepare(self):
+        if self.count:
+            self.mesh.prepare()
+            self.upload()
+
+    def get_material(self) -> Material:
+        return self.rootNode.shaders.get_shader(self.mesh.material)
+
+    def issue_draw(self, material: Material):
+        if self.count == 0:
+            return
+        material.set_mat4("model", self.get_world_matrix())
+        material.set_mat4("local", self.mesh.get_local_matrix())
+        material.set_vec3("color", self.mesh.color)
+        base = self.mesh.get_base_vertex()
+        if base:
+            glDrawElementsInstancedBaseVertex(GL_TRIANGLES, self.mesh.index_count, GL_UNSIGNED_INT, None, self.count, base)
+        else:
+            glDrawElementsInstanced(GL_TRIANGLES, self.mesh.index_count, GL_UNSIGNED_INT, None, self.count)
 
 class Camera:
     def __init__(self, parent: Root, id: int, width: int, height: int, fov: float = 45.0, near: float = 0.1, far: float = 100.0,
@@ -133,16 +555,36 @@ class Camera:
     def get_projection_matrix(self):
         return perspective(radians(self.fov), self.aspect_ratio, self.near, self.far)
 
-    def apply_matrices(self, shader):
-        shader.use()
-
+    def get_frustum_planes(self) -> np.ndarray:
+        return culling.frustum_planes(np.array(self.get_projection_matrix() * self.get_view_matrix()))
+
+    def get_rays(self, x, y):
+        # World space rays through window pixels (x right, y down, scalars or arrays), as (origins, directions)
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        forward = np.array(normalize(self.direction), dtype=np.float64)
+        right = np.array(normalize(cross(self.direction, self.up)), dtype=np.float64)
+        up = np.cross(right, forward)
+        # Pixel centers to [-1, 1], scaled to the view plane at distance 1
+        half_height = np.tan(np.radians(self.fov) * 0.5)
+        ndc_x = ((x + 0.5) / self.width * 2.0 - 1.0) * half_height * self.aspect_ratio
+        ndc_y = (1.0 - (y + 0.5) / self.height * 2.0) * half_height
+        directions = forward + ndc_x[:, None] * right + ndc_y[:, None] * up
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        origins = np.repeat(np.array(self.position, dtype=np.float64)[None], len(directions), axis=0)
+        return origins, directions
+
+    def apply_matrices(self, camera_buffer: UniformBuffer):
         # Get matrices
         view = self.get_view_matrix()
         projection = self.get_projection_matrix()
 
-        # Upload to shader
-        shader.set_mat4("view", view)
-        shader.set_mat4("projection", projection)
+        # Upload to the Camera block shared by every shader
+        block = camera_buffer.data[0]
+        block["view"] = transforms.column_major(np.array(view))[0]
+        block["projection"] = transforms.column_major(np.array(projection))[0]
+        block["position"] = (self.position.x, self.position.y, self.position.z, 1.0)
+        camera_buffer.upload()
 
 
 
@@ -178,9 +620,17 @@ class Camera:
         ))
 
 class Root:
-    def __init__(self, physics_frequency: int = 60, visuals_frequency: int = 60, Width: int = 1366, Height: int = 768, FOV: float = 45.0, RenderDistance: float = 100, BGColor: tuple = (0.31, 0.31, 0.31, 1.0)):
+    def __init__(self, physics_frequency: int = 60, visuals_frequency: int = 60, Width: int = 1366, Height: int = 768, FOV: float = 45.0, RenderDistance: float = 100, BGColor: tuple = (0.31, 0.31, 0.31, 1.0), backend: str = "window", threaded_physics: bool = False, asset_cache: Optional[str] = None, shader_cache: Optional[str] = None):
+        # backend is "window" (pygame window) or "headless" (EGL/OSMesa context rendering into a framebuffer).
+        # Headless needs Graphics.Utils.headless.select_platform() to be called before the engine is imported.
+        # Construction returns right away: call run() for the blocking loop, or drive the engine yourself
+        # with step(dt) / render_frame() / render_frames(count).
+        # threaded_physics runs the fixed physics steps on a worker thread, see Graphics/Simulation.py
+        # asset_cache is a directory where loadMesh keeps parsed meshes, see Graphics/Utils/cache.py
+        # shader_cache is a directory for linked program binaries, see shader_utils.ProgramBinaryCache
         pygame.init()
         
+        self.backend = backend
         self.windowGeometry = (Width, Height)
         self.physics_frequency = physics_frequency
         self.visuals_frequency = visuals_frequency
@@ -189,77 +639,377 @@ class Root:
         self.BGColor = BGColor
 
         # OpenGL setup
-        pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, 0)  # Disable VSync
-        self.screen = pygame.display.set_mode(self.display, pygame.DOUBLEBUF | pygame.OPENGL)
+        self.context = None
+        self.framebuffer = None
+        self.screen = None
+        if backend == "window":
+            pygame.display.gl_set_attribute(pygame.GL_SWAP_CONTROL, 0)  # Disable VSync
+            self.screen = pygame.display.set_mode(self.display, pygame.DOUBLEBUF | pygame.OPENGL)
+        elif backend == "headless":
+            self.context = offscreen.create_context(Width, Height)
+            self.framebuffer = offscreen.Framebuffer(Width, Height)
+            self.framebuffer.bind()
+        else:
+            raise ValueError(f"Unknown backend '{backend}', expected 'window' or 'headless'")
         glEnable(GL_DEPTH_TEST)
         glDepthFunc(GL_LESS)
 
-        self.shaders = shaderManager()
+        self.shaders = shaderManager(shader_cache)
         self.shaders.add_shader({
             "name": "default",
             "albedo": (1.0, 1.0, 1.0), 
             "roughness": 0.5, 
             "reflectiveness": 0.5
         })
+        self.shaders.add_shader({
+            "name": "instanced",
+            "albedo": (1.0, 1.0, 1.0),
+            "roughness": 0.5,
+            "reflectiveness": 0.5,
+            "vertex": instanced_vertex_shader
+        })
 
-        self.running = True
+        # Every light in one NumPy buffer, assigned to view clusters each frame (clustered forward lighting)
+        self.light_manager = LightManager()
+        self.lights: List[PointLight] = self.light_manager.lights
+
+        # Transforms of every Object and attached Mesh, see Graphics/Utils/scene_store.py
+        self.nodes = SceneStore()
+        # Every mesh and instanced group in the tree is a leaf of this BVH, used for frustum culling
+        self.scene = culling.SceneBVH()
+        self.frustum_culling = True
+        # Optional hardware occlusion queries after frustum culling, results lag a frame behind (see occlusion.py)
+        self.occlusion_culling = False
+        self.occlusion = OcclusionCuller()
+        # World space batches of the subtrees marked with Object.make_static()
+        self.static_batches = StaticBatcher(self)
+        # Ray casts and picking against the scene's triangles on the CPU (see Graphics/Utils/raycast.py)
+        self.raycaster = RayCaster(self)
+        self.render_queue = RenderQueue()
+        # Level of detail selection for meshes with LODs (Mesh.set_lods), levels only switch once the screen size
+        # is lod_hysteresis (relative) past a threshold
+        self.lod_enabled = True
+        self.lod_hysteresis = 0.1
+
+        # Meshes loaded from files in the background, see loadMesh
+        self.assets = AssetLoader(cache_dir=asset_cache)
+
+        # Frame timings and counters, see Graphics/Utils/profiler.py
+        self.profiler = Profiler()
+
+        # Fixed-step simulation, at most max_physics_steps catch-up steps per loop iteration
+        self.physics = PhysicsWorld()
+        self.max_physics_steps = 5
+        self.physics_lock = threading.RLock()
+        self.simulation = SimulationThread(self) if threaded_physics else None
+
+        self.running = False
+        # Called as callback(dt) with dt in seconds: tick callbacks before every fixed physics step,
+        # frame callbacks before every rendered frame
+        self.tick_callbacks = []
+        self.frame_callbacks = []
         self.cameras: List[Camera] = [Camera(self, 0, width=Width, height=Height, position=vec3(0.0, 0.0, 5.0), active=True)]
         self.activeCamera: int = 0
+        # Every object and shape by path (see Object.get_path) and the next suffix to try per taken name
+        self.paths: Dict[str, object] = {}
+        self.name_suffixes: Dict[str, int] = {}
         self.root = Object(self, "Root", activeCamera=self.cameras[self.activeCamera])
+        self.paths[self.root.name] = self.root
 
-        # ONE CLOCK TO RULE THEM ALL
-        self.clock = pygame.time.Clock()
+        # Time accumulated towards the next physics step / visual frame, in ms
         self.physics_timer = 0.0
         self.visuals_timer = 0.0
 
         # Precomputed frame time targets in milliseconds
         self.physics_timestep = 1000.0 / self.physics_frequency
         self.visuals_timestep = 1000.0 / self.visuals_frequency
+        # The loop sleeps until this close to the next update and yields for the rest, sleep() often overshoots by ~1ms
+        self.spin_margin = 1.5
 
 
         self.root.addChild("Cube", position=vec3(0.0, 0.0, -5.0))
         self.root.children["Cube"].addShape("Cube", Shapes.Cube(self.root.children["Cube"],vec3(0, 0, 0), vec3(0, 0, 0), (1.0, 1.0, 1.0), vec3(1, 1, 1,)))
 
-
-        self.main_loop()
-
-    def main_loop(self):
+    def run(self):
+        # Blocking loop until the window is closed or stop_running() is called, then releases the engine
+        self.running = True
+        last = time.perf_counter()
         while self.running:
-            delta = self.clock.tick()  # Returns time in ms since last tick
-            self.physics_timer += delta
-            self.visuals_timer += delta
+            now = time.perf_counter()
+            self.step(now - last)
+            last = now
+            if self.running:
+                self.wait_for_next_update()
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.running = False
+        self.stop()
 
-            # Physics update
-            if self.physics_timer >= self.physics_timestep:
-                # Call physics update functions here
-                self.physics_timer -= self.physics_timestep  # Subtract instead of zeroing for better accuracy
+    def main_loop(self):
+        self.run()
 
-            # Visual update
-            if self.visuals_timer >= self.visuals_timestep:
-                self.useShader("default")
+    def stop_running(self):
+        self.running = False
 
-                # Clear screen and depth buffer
-                glClearColor(*self.BGColor)
-                glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    def step(self, dt: float) -> bool:
+        # Advances the engine by dt seconds: window events, as many fixed physics steps as are due and a visual
+        # frame if one is due. Returns True when a frame was rendered
+        self.physics_timer += dt * 1000.0
+        self.visuals_timer += dt * 1000.0
 
-                # Draw objects here
-                self.root.draw()
+        if self.backend == "window":
+            with self.profiler.zone("events"):
+                self.poll_events()
 
-                # Swap buffers
+        # Physics update
+        if self.simulation is not None:
+            self.simulation.start()
+        else:
+            with self.profiler.zone("physics"):
+                self.update_physics()
+
+        # Visual update
+        if self.visuals_timer < self.visuals_timestep:
+            return False
+        frame_dt = self.visuals_timer / 1000.0
+        # Frames that could not be rendered in time are skipped instead of being caught up
+        self.visuals_timer %= self.visuals_timestep
+        if self.simulation is not None:
+            with self.profiler.zone("interpolate"):
+                self.simulation.apply()
+        with self.profiler.zone("assets"):
+            self.assets.process()
+        with self.profiler.zone("update"):
+            for callback in list(self.frame_callbacks):
+                callback(frame_dt)
+        self.render_frame()
+        self.profiler.end_frame()
+        return True
+
+    def poll_events(self):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.running = False
+
+    def wait_for_next_update(self):
+        # Sleep until shortly before the next physics step or visual frame is due, then yield until it is,
+        # instead of spinning the loop at 100% CPU
+        # With threaded physics only frames are scheduled here
+        physics_wait = self.physics_timestep - self.physics_timer if self.simulation is None else self.visuals_timestep
+        visuals_wait = self.visuals_timestep - self.visuals_timer
+        wait = physics_wait if physics_wait < visuals_wait else visuals_wait
+        if wait <= 0.0:
+            return
+        deadline = time.perf_counter() + wait / 1000.0
+        if wait > self.spin_margin:
+            time.sleep((wait - self.spin_margin) / 1000.0)
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+
+    def addTickCallback(self, callback):
+        self.tick_callbacks.append(callback)
+        return callback
+
+    def removeTickCallback(self, callback):
+        self.tick_callbacks.remove(callback)
+
+    def addFrameCallback(self, callback):
+        self.frame_callbacks.append(callback)
+        return callback
+
+    def removeFrameCallback(self, callback):
+        self.frame_callbacks.remove(callback)
+
+    def run_tick_callbacks(self, dt: float):
+        for callback in list(self.tick_callbacks):
+            callback(dt)
+
+    def render_frame(self):
+        with self.profiler.zone("uniforms"):
+            self.update_frame_uniforms()
+            self.useShader("default")
+
+        with self.profiler.gpu_zone("frame"):
+            # Clear screen and depth buffer
+            glClearColor(*self.BGColor)
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+            # Draw objects here
+            with self.profiler.zone("draw"):
+                self.draw_scene()
+
+        # Swap buffers
+        if self.backend == "window":
+            with self.profiler.zone("present"):
                 pygame.display.flip()
-                self.visuals_timer -= self.visuals_timestep
-                
-        self.stop()
+
+    def render_frames(self, count: int, read_back: Optional[str] = "sync", step_physics: bool = True) -> List[np.ndarray]:
+        # Renders count frames as fast as possible, one physics step per frame. read_back is "sync" (glReadPixels
+        # every frame), "pbo" (asynchronous, frames arrive a frame late and are flushed at the end) or None.
+        # Returns the frames as (height, width, 4) uint8 arrays
+        frames = []
+        for _ in range(count):
+            if self.simulation is not None:
+                # The worker thread keeps its own pace, frames show its latest state
+                self.simulation.start()
+                with self.profiler.zone("interpolate"):
+                    self.simulation.apply()
+            elif step_physics:
+                with self.profiler.zone("physics"):
+                    self.run_tick_callbacks(self.physics_timestep / 1000.0)
+                    self.physics.step(self.physics_timestep / 1000.0)
+                    self.physics.write_back()
+            with self.profiler.zone("assets"):
+                self.assets.process()
+            with self.profiler.zone("update"):
+                for callback in list(self.frame_callbacks):
+                    callback(self.visuals_timestep / 1000.0)
+            self.render_frame()
+
+            with self.profiler.zone("read_back"):
+                if read_back == "sync":
+                    frames.append(self.read_pixels())
+                elif read_back == "pbo":
+                    frames.extend(self.framebuffer.start_read())
+            self.profiler.end_frame()
+
+        if read_back == "pbo":
+            frames.extend(self.framebuffer.flush_reads())
+        return frames
+
+    def read_pixels(self) -> np.ndarray:
+        if self.framebuffer is not None:
+            return self.framebuffer.read_pixels()
+        width, height = self.windowGeometry
+        pixels = glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE)
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 4)[::-1].copy()
+
+    def update_physics(self):
+        # Timers are in ms, the simulation runs in seconds. The remainder stays in physics_timer for the next frame
+        steps, remainder = self.physics.advance(self.physics_timer / 1000.0, self.physics_timestep / 1000.0, self.max_physics_steps, self.run_tick_callbacks)
+        self.physics_timer = remainder * 1000.0
+        if steps:
+            self.physics.write_back()
+
+    def addRigidBody(self, obj: Object, mass: float = 1.0, velocity: vec3 = vec3(0, 0, 0), angular_velocity: vec3 = vec3(0, 0, 0), collider: Optional[str] = None, radius: Optional[float] = None, half_extents: Optional[vec3] = None) -> int:
+        # collider is None, "sphere" or "box", sizes default to the object's current bounds
+        with self.physics_lock:
+            body = self.physics.add_body(obj, mass, velocity, angular_velocity)
+            if collider is not None:
+                bounds = obj.get_bounds()
+                size = (bounds[1] - bounds[0]) * 0.5 if bounds is not None else np.ones(3, dtype=np.float32)
+                if collider == "sphere":
+                    self.physics.set_sphere_colliders([body], float(np.max(size)) if radius is None else radius)
+                elif collider == "box":
+                    self.physics.set_box_colliders([body], [size if half_extents is None else tuple(half_extents)])
+                else:
+                    raise ValueError(f"Unknown collider '{collider}', expected 'sphere' or 'box'")
+        return body
+
+    def removeRigidBody(self, obj: Object):
+        with self.physics_lock:
+            if obj.body is not None:
+                self.physics.remove_body(obj.body)
+
+    def update_transforms(self):
+        # World matrices of everything that moved, in one batched pass over the tree. Drawables whose matrix
+        # changed get their box refitted in the BVH
+        self.nodes.update()
+        moved = self.nodes.take_moved()
+        if self.scene.structure_dirty:
+            # The BVH is rebuilt from scratch anyway
+            return
+        handles = self.nodes.handles
+        items = self.scene.item_index
+        for node in moved.tolist():
+            handle = handles[node]
+            if id(handle) in items:
+                self.scene.mark_moved(handle)
+
+    def draw_scene(self):
+        camera = self.get_activeCamera()
+        self.update_transforms()
+        # Only what the BVH finds inside the active camera's frustum is submitted
+        visible = self.scene.cull(camera.get_frustum_planes() if self.frustum_culling else None)
+
+        # Front to back distance of each box center, used as the last sort key
+        indices = self.scene.visible_indices
+        frustum_indices = indices
+        if self.occlusion_culling:
+            # Items found hidden by earlier queries are skipped
+            keep = self.occlusion.filter(self.scene, indices, camera.position)
+            indices = indices[keep]
+            visible = [item for item, kept in zip(visible, keep.tolist()) if kept]
+
+        centers = (self.scene.item_mins[indices] + self.scene.item_maxs[indices]) * 0.5
+        depths = np.linalg.norm(centers - np.array(camera.position, dtype=np.float32), axis=1)
+        if self.lod_enabled and len(indices):
+            self.update_lods(camera, indices, depths)
+
+        self.render_queue.clear()
+        self.render_queue.submit_many(visible, depths)
+        self.render_queue.flush()
+
+        if self.occlusion_culling:
+            # Boxes are tested against the finished depth buffer, the results are used from the next frame on
+            self.occlusion.issue(self.scene, frustum_indices)
+
+    def update_lods(self, camera: Camera, indices: np.ndarray, depths: np.ndarray):
+        # Screen size of every visible item at once: bounding sphere radius over distance, as a fraction of the
+        # view height. Only items whose level changed are touched afterwards
+        extents = self.scene.item_maxs[indices] - self.scene.item_mins[indices]
+        radii = np.linalg.norm(extents, axis=1) * 0.5
+        sizes = radii / (np.maximum(depths, camera.near) * np.tan(np.radians(camera.fov) * 0.5))
+        changed, levels = self.scene.select_lods(indices, sizes, self.lod_hysteresis)
+        for index, level in zip(changed.tolist(), levels.tolist()):
+            self.scene.items[index].lod = level
 
     def useShader(self, name):
-        self.get_activeCamera().apply_matrices(self.shaders.get_shader("default"))
+        self.shaders.get_shader(name).use()
+
+    def update_frame_uniforms(self):
+        # Camera and lights are written once per frame into the uniform buffers shared by all materials
+        self.get_activeCamera().apply_matrices(self.shaders.camera_buffer)
+        self.update_lights()
+
+    def update_lights(self):
+        # Lights are clustered for the active camera, the shaders only look at the lights of each fragment's cluster
+        camera = self.get_activeCamera()
+        self.light_manager.update(
+            np.array(camera.get_view_matrix(), dtype=np.float32),
+            float(np.tan(np.radians(camera.fov) * 0.5)), camera.aspect_ratio, camera.near, camera.far,
+            (0.0, 0.0, camera.width, camera.height), self.shaders.lights_buffer
+        )
+
+    def loadMesh(self, path: str, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1), color: tuple = (1.0, 1.0, 1.0), material: str = "default") -> Shapes.MeshPlaceholder:
+        # Starts loading an .obj / .ply / .mesh file in the background. The returned placeholder can be given to
+        # Object.addShape immediately and shows up once the file is parsed and uploaded
+        return self.assets.load(path, position=position, rotation=rotation, scale=scale, color=color, material=material)
+
+    def saveScene(self, path: str, obj: Optional[Object] = None):
+        # Writes obj (the whole scene by default) to a binary .scene file
+        cache.write_scene(path, self.root if obj is None else obj)
+
+    def loadScene(self, path: str, parent: Optional[Object] = None) -> Object:
+        # Adds the tree saved in path under parent (the root by default), meshes are memory mapped from the file
+        return cache.read_scene(path, self.root if parent is None else parent)
+
+    def addLight(self, position: vec3, color: tuple = (1.0, 1.0, 1.0), intensity: float = 1.0, radius: float = 10.0) -> PointLight:
+        light = PointLight(position, color, intensity, radius)
+        self.light_manager.add(light)
+        return light
+
+    def removeLight(self, light: PointLight):
+        self.light_manager.remove(light)
 
     # Utility methods
     def stop(self):
+        if self.simulation is not None:
+            self.simulation.stop()
+        self.assets.shutdown()
+        self.light_manager.delete()
+        self.occlusion.delete()
+        if self.context is not None:
+            self.context.destroy()
+            self.context = None
         pygame.quit()
 
     def addCamera(self, width: int, height: int, fov: float = 45.0, near: float = 0.1, far: float = 100.0,
@@ -282,15 +1032,45 @@ class Root:
             self.activeCamera = id
 
     def addObject(self, name: str, position: vec3 = vec3(0.0, 0.0, 0.0), angle: vec3 = vec3(0.0, 0.0, 0.0), scale: vec3 = vec3(1.0, 1.0, 1.0)):
-        if not (name in self.root.children):
-            self.root.addChild(name, Object(name, None, self.root, position, angle, scale))
-        else:
-            i = 1
-            new_name = f"{name}_{i}"
-            while new_name in self.root.children:
-                i += 1
-                new_name = f"{name}_{i}"
-            self.root.addChild(new_name, Object(new_name, None, self.root, position, angle, scale))
+        return self.root.addChild(name, position, angle, scale)
+
+    def addObjects(self, name: str, positions, angles=None, scales=None, shape: Optional[Shapes.Mesh] = None, shape_name: str = "shape") -> List[Object]:
+        return self.root.addChildren(name, positions, angles, scales, shape, shape_name)
+
+    def unique_name(self, prefix: str, name: str) -> str:
+        # name, or name_<i> with the first free i when prefix + name is taken. prefix is a parent path followed by
+        # "/" (children) or ":" (shapes). Suffixes already handed out are not tried again, so adding many
+        # objects with the same name stays linear
+        if prefix + name not in self.paths:
+            return name
+        key = prefix + name
+        i = self.name_suffixes.get(key, 1)
+        while f"{key}_{i}" in self.paths:
+            i += 1
+        self.name_suffixes[key] = i + 1
+        return f"{name}_{i}"
+
+    def find(self, path: str):
+        # Object or shape by full path ("Root/Cube", "Root/Cube:Cube"), None if there is none
+        return self.paths.get(path)
+
+    def get_node(self, node: int):
+        # Object or shape by its scene store id (handle.node)
+        return self.nodes.handles[node]
+
+    def raycast(self, origin, direction, max_distance: float = np.inf) -> Optional[RayHit]:
+        # Nearest hit along the ray, None when it hits nothing within max_distance (world units)
+        return self.raycaster.cast(origin, direction, max_distance)[0]
+
+    def raycast_many(self, origins, directions, max_distance=np.inf) -> RayHits:
+        # Nearest hit of each of the (N, 3) rays, max_distance is one value or one per ray
+        return self.raycaster.cast(origins, directions, max_distance)
+
+    def pick(self, x, y, camera: Optional[Camera] = None) -> Optional[RayHit]:
+        # What is under the window pixel (x, y) (y down) seen from camera, by default the active one
+        camera = camera if camera is not None else self.get_activeCamera()
+        origins, directions = camera.get_rays(x, y)
+        return self.raycaster.cast(origins, directions, camera.far)[0]
 
     def removeObject(self, name: str):
         self.root.removeChild(name)
@@ -298,7 +1078,15 @@ class Root:
 
 
 # Function to draw a sphere at a given position (x, y, z)
-def draw_sphere(x, y, z, radius=0.1, slices=10, stacks=10):
+def draw_sphere(x, y, z, radius=0.1, slices=10, stacks=10, camera: Optional[Camera] = None):
+    # With a camera the tessellation follows the sphere's screen size instead (up to slices x stacks),
+    # Shapes.Sphere is the mesh based version with LOD levels
+    if camera is not None:
+        distance = np.linalg.norm(np.array([x, y, z], dtype=np.float32) - np.array(camera.position, dtype=np.float32))
+        size = radius / ((distance if distance > camera.near else camera.near) * np.tan(np.radians(camera.fov) * 0.5))
+        detail = float(np.clip(size * 4.0, 0.0, 1.0))
+        slices = int(np.clip(np.round(slices * detail), 6, slices))
+        stacks = int(np.clip(np.round(stacks * detail), 4, stacks))
     glPushMatrix()  # Save the current transformation matrix
     glTranslatef(x, y, z)  # Move the sphere to the specified position
     quadric = gluNewQuadric()  # Create a new Quadric object (sphere)
@@ -0,0 +1,419 @@
+from __future__ import annotations
+from typing import Optional, List
+import numpy as np
+from glm import vec3
+from Graphics.Utils.scene_store import assign_poses
+
+# Rigid body simulation. Bodies are stored as struct-of-arrays so one step integrates all of them with
+# a handful of NumPy operations. Nothing here needs a window or a GL context.
+
+# Collider kinds
+NO_COLLIDER = 0
+SPHERE = 1
+BOX = 2  # axis aligned, the body's angle is not taken into account
+
+# Cell coordinates are packed into one int64 key, 21 bits per axis
+CELL_BITS = 21
+CELL_BIAS = 1 << (CELL_BITS - 1)
+CELL_MASK = (1 << CELL_BITS) - 1
+
+# Half of the 26 neighbour cells, the other half is covered from the neighbour's side
+NEIGHBOUR_OFFSETS = np.array([
+    (dx, dy, dz)
+    for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+    if (dx, dy, dz) > (0, 0, 0)
+], dtype=np.int64)
+
+def pack_cells(cells) -> np.ndarray:
+    cells = cells.astype(np.int64) + CELL_BIAS
+    return (cells[:, 0] << (2 * CELL_BITS)) | (cells[:, 1] << CELL_BITS) | cells[:, 2]
+
+def unpack_cells(keys) -> np.ndarray:
+    cells = np.stack([(keys >> (2 * CELL_BITS)) & CELL_MASK, (keys >> CELL_BITS) & CELL_MASK, keys & CELL_MASK], axis=1)
+    return cells - CELL_BIAS
+
+def cross_pairs(a_starts, a_counts, b_starts, b_counts):
+    # Every (slot in run a, slot in run b) combination for each pair of runs, without a Python loop
+    totals = a_counts * b_counts
+    run = np.repeat(np.arange(len(totals)), totals)
+    local = np.arange(totals.sum()) - np.repeat(np.cumsum(totals) - totals, totals)
+    return a_starts[run] + local // b_counts[run], b_starts[run] + local % b_counts[run]
+
+class SpatialHashGrid:
+    # Uniform grid broad phase. Each body lives in the cell of its AABB center, cells are at least as large as
+    # the largest body so only neighbouring cells can overlap. Bodies are kept sorted by cell key: when only a
+    # few change cell they are moved with searchsorted/insert instead of sorting again, and candidate pairs are
+    # only regenerated when some body changed cell.
+    def __init__(self, cell_size: Optional[float] = None):
+        self.cell_size = cell_size
+        self.bodies = np.zeros(0, dtype=np.int64)  # tracked body ids, grid slots index into this
+        self.keys = np.zeros(0, dtype=np.int64)  # cell key of every tracked body
+        self.order = np.zeros(0, dtype=np.int64)  # tracked bodies sorted by key
+        self.sorted_keys = np.zeros(0, dtype=np.int64)
+        self.candidates = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+        # Statistics of the last update
+        self.rebuilt = False
+        self.moved_bodies = 0
+        self.candidate_count = 0
+
+    def cell_keys(self, mins, maxs) -> np.ndarray:
+        return pack_cells(np.floor((mins + maxs) * 0.5 / self.cell_size))
+
+    def rebuild(self, bodies, mins, maxs):
+        largest = float((maxs - mins).max()) if len(bodies) else 1.0
+        if self.cell_size is None or self.cell_size < largest:
+            self.cell_size = largest if largest > 0.0 else 1.0
+        self.bodies = bodies
+        self.keys = self.cell_keys(mins, maxs)
+        self.order = np.argsort(self.keys, kind="stable")
+        self.sorted_keys = self.keys[self.order]
+        self.rebuilt = True
+
+    def move(self, changed, new_keys):
+        # Take the changed bodies out of the sorted order and insert them back at their new keys
+        keep = np.ones(len(self.keys), dtype=bool)
+        keep[changed] = False
+        order = self.order[keep[self.order]]
+        sorted_keys = self.keys[order]
+
+        self.keys[changed] = new_keys[changed]
+        moved = changed[np.argsort(self.keys[changed], kind="stable")]
+        where = np.searchsorted(sorted_keys, self.keys[moved])
+        self.order = np.insert(order, where, moved)
+        self.sorted_keys = self.keys[self.order]
+
+    def build_candidates(self):
+        cells, starts, counts = np.unique(self.sorted_keys, return_index=True, return_counts=True)
+        first = []
+        second = []
+
+        # Pairs inside the same cell
+        crowded = counts > 1
+        a, b = cross_pairs(starts[crowded], counts[crowded], starts[crowded], counts[crowded])
+        upper = a < b
+        first.append(a[upper])
+        second.append(b[upper])
+
+        # Pairs with half of the neighbouring cells
+        coordinates = unpack_cells(cells)
+        for offset in NEIGHBOUR_OFFSETS:
+            neighbour = pack_cells(coordinates + offset)
+            index = np.minimum(np.searchsorted(cells, neighbour), len(cells) - 1)
+            found = cells[index] == neighbour
+            if found.any():
+                a, b = cross_pairs(starts[found], counts[found], starts[index[found]], counts[index[found]])
+                first.append(a)
+                second.append(b)
+
+        # Sorted slots -> tracked body -> body id
+        self.candidates = (self.bodies[self.order[np.concatenate(first)]], self.bodies[self.order[np.concatenate(second)]])
+
+    def update(self, bodies, mins, maxs):
+        # Returns candidate pairs (i, j) of body ids whose AABBs overlap
+        self.rebuilt = False
+        if len(bodies) < 2:
+            self.bodies = bodies
+            self.candidate_count = 0
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        if len(bodies) != len(self.bodies) or not np.array_equal(bodies, self.bodies) or float((maxs - mins).max()) > self.cell_size:
+            self.rebuild(bodies, mins, maxs)
+            self.moved_bodies = len(bodies)
+        else:
+            new_keys = self.cell_keys(mins, maxs)
+            changed = np.flatnonzero(new_keys != self.keys)
+            self.moved_bodies = len(changed)
+            if len(changed) * 4 > len(bodies):
+                self.rebuild(bodies, mins, maxs)
+            elif len(changed):
+                self.move(changed, new_keys)
+
+        if self.rebuilt or self.moved_bodies:
+            self.build_candidates()
+
+        # Exact AABB test on the candidates, positions change every step even when cells don't
+        i, j = self.candidates
+        slot = np.empty(int(self.bodies.max()) + 1, dtype=np.int64)
+        slot[self.bodies] = np.arange(len(self.bodies))
+        si, sj = slot[i], slot[j]
+        overlap = ((mins[si] <= maxs[sj]) & (mins[sj] <= maxs[si])).all(axis=1)
+        self.candidate_count = int(overlap.sum())
+        return i[overlap], j[overlap]
+
+def collide(positions, colliders, radii, half_extents, i, j):
+    # Vectorized narrow phase for sphere/sphere, box/box and sphere/box pairs.
+    # Returns (a, b, normals from a to b, penetration depths) for the pairs that touch
+    a_list, b_list, normal_list, depth_list = [], [], [], []
+
+    def emit(a, b, normals, depths):
+        hit = depths > 0.0
+        a_list.append(a[hit])
+        b_list.append(b[hit])
+        normal_list.append(normals[hit])
+        depth_list.append(depths[hit])
+
+    kind_i = colliders[i]
+    kind_j = colliders[j]
+
+    # Sphere / sphere
+    mask = (kind_i == SPHERE) & (kind_j == SPHERE)
+    a, b = i[mask], j[mask]
+    delta = positions[b] - positions[a]
+    distance = np.linalg.norm(delta, axis=1)
+    normals = np.where(distance[:, None] > 0.0, delta / np.where(distance > 0.0, distance, 1.0)[:, None], np.array([0.0, 1.0, 0.0], dtype=np.float32))
+    emit(a, b, normals, radii[a] + radii[b] - distance)
+
+    # Box / box, separated along the axis of least overlap
+    mask = (kind_i == BOX) & (kind_j == BOX)
+    a, b = i[mask], j[mask]
+    delta = positions[b] - positions[a]
+    overlap = half_extents[a] + half_extents[b] - np.abs(delta)
+    axis = np.argmin(overlap, axis=1)
+    rows = np.arange(len(a))
+    normals = np.zeros((len(a), 3), dtype=np.float32)
+    normals[rows, axis] = np.where(delta[rows, axis] < 0.0, -1.0, 1.0)
+    emit(a, b, normals, np.where((overlap > 0.0).all(axis=1), overlap[rows, axis], 0.0))
+
+    # Sphere / box, always reported as (box, sphere)
+    mask = ((kind_i == BOX) & (kind_j == SPHERE)) | ((kind_i == SPHERE) & (kind_j == BOX))
+    swap = kind_i[mask] == SPHERE
+    a = np.where(swap, j[mask], i[mask])
+    b = np.where(swap, i[mask], j[mask])
+    delta = positions[b] - positions[a]
+    closest = np.clip(delta, -half_extents[a], half_extents[a])
+    offset = delta - closest
+    distance = np.linalg.norm(offset, axis=1)
+    inside = distance == 0.0
+    normals = offset / np.where(inside, 1.0, distance)[:, None]
+    depths = radii[b] - distance
+    if inside.any():
+        # Sphere center inside the box: push out through the closest face
+        face = half_extents[a][inside] - np.abs(delta[inside])
+        axis = np.argmin(face, axis=1)
+        rows = np.arange(len(axis))
+        pushed = np.zeros((len(axis), 3), dtype=np.float32)
+        pushed[rows, axis] = np.where(delta[inside][rows, axis] < 0.0, -1.0, 1.0)
+        normals[inside] = pushed
+        depths[inside] = face[rows, axis] + radii[b][inside]
+    emit(a, b, normals, depths)
+
+    return np.concatenate(a_list), np.concatenate(b_list), np.concatenate(normal_list), np.concatenate(depth_list)
+
+class PhysicsWorld:
+    def __init__(self, gravity: tuple = (0.0, -9.81, 0.0), linear_damping: float = 0.0, angular_damping: float = 0.0, capacity: int = 64):
+        self.gravity = np.array(gravity, dtype=np.float32)
+        # Fraction of velocity lost per second
+        self.linear_damping = linear_damping
+        self.angular_damping = angular_damping
+
+        self.count = 0
+        self.capacity = 0
+        self.positions = np.zeros((0, 3), dtype=np.float32)
+        self.velocities = np.zeros((0, 3), dtype=np.float32)
+        self.angles = np.zeros((0, 3), dtype=np.float32)  # degrees, like Object.angle
+        self.angular_velocities = np.zeros((0, 3), dtype=np.float32)  # degrees per second
+        self.forces = np.zeros((0, 3), dtype=np.float32)
+        self.masses = np.zeros(0, dtype=np.float32)
+        self.inverse_masses = np.zeros(0, dtype=np.float32)  # 0 for static bodies
+        self.colliders = np.zeros(0, dtype=np.int8)
+        self.radii = np.zeros(0, dtype=np.float32)  # spheres
+        self.half_extents = np.zeros((0, 3), dtype=np.float32)  # boxes
+        # Pose of each body at the last write_back(), NaN until it has been written once
+        self.written_positions = np.zeros((0, 3), dtype=np.float32)
+        self.written_angles = np.zeros((0, 3), dtype=np.float32)
+        # Object driven by each body (None for pure simulation bodies)
+        self.objects: List[Optional[object]] = []
+        self.reserve(capacity)
+
+        # Collision detection and response
+        self.grid = SpatialHashGrid()
+        self.restitution = 0.2
+        self.contacts = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.float32))
+
+        self.steps = 0
+        self.dropped_time = 0.0
+        # Bumped whenever body ids change meaning (add / swap-remove), snapshots of different layouts can't be blended
+        self.layout_version = 0
+
+    def reserve(self, capacity: int):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, self.capacity * 2)
+
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            return grown
+
+        self.positions = grow(self.positions)
+        self.velocities = grow(self.velocities)
+        self.angles = grow(self.angles)
+        self.angular_velocities = grow(self.angular_velocities)
+        self.forces = grow(self.forces)
+        self.masses = grow(self.masses)
+        self.inverse_masses = grow(self.inverse_masses)
+        self.colliders = grow(self.colliders)
+        self.radii = grow(self.radii)
+        self.half_extents = grow(self.half_extents)
+        self.written_positions = grow(self.written_positions)
+        self.written_angles = grow(self.written_angles)
+        self.capacity = capacity
+
+    def add_bodies(self, positions, velocities=None, masses=1.0, angles=None, angular_velocities=None, objects=None) -> np.ndarray:
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        n = len(positions)
+        self.reserve(self.count + n)
+
+        ids = np.arange(self.count, self.count + n)
+        self.positions[ids] = positions
+        self.velocities[ids] = 0.0 if velocities is None else np.asarray(velocities, dtype=np.float32).reshape(-1, 3)
+        self.angles[ids] = 0.0 if angles is None else np.asarray(angles, dtype=np.float32).reshape(-1, 3)
+        self.angular_velocities[ids] = 0.0 if angular_velocities is None else np.asarray(angular_velocities, dtype=np.float32).reshape(-1, 3)
+        self.forces[ids] = 0.0
+        self.colliders[ids] = NO_COLLIDER
+        self.written_positions[ids] = np.nan
+        self.written_angles[ids] = np.nan
+        self.set_masses(ids, masses)
+
+        objects = [None] * n if objects is None else list(objects)
+        for body, obj in zip(ids, objects):
+            if obj is not None:
+                obj.body = int(body)
+        self.objects.extend(objects)
+        self.count += n
+        self.layout_version += 1
+        return ids
+
+    def add_body(self, obj=None, mass: float = 1.0, velocity: vec3 = vec3(0, 0, 0), angular_velocity: vec3 = vec3(0, 0, 0), position: Optional[vec3] = None, angle: Optional[vec3] = None) -> int:
+        # The body starts where its object is unless a position is given
+        if position is None:
+            position = obj.position if obj is not None else vec3(0, 0, 0)
+        if angle is None:
+            angle = obj.angle if obj is not None else vec3(0, 0, 0)
+        return int(self.add_bodies([tuple(position)], [tuple(velocity)], mass, [tuple(angle)], [tuple(angular_velocity)], [obj])[0])
+
+    def remove_body(self, id: int) -> int:
+        # Swap-remove: the last body takes over the removed row, its old id is returned
+        last = self.count - 1
+        removed = self.objects[id]
+        if removed is not None:
+            removed.body = None
+        if id != last:
+            for array in (self.positions, self.velocities, self.angles, self.angular_velocities, self.forces, self.masses, self.inverse_masses, self.colliders, self.radii, self.half_extents, self.written_positions, self.written_angles):
+                array[id] = array[last]
+            self.objects[id] = self.objects[last]
+            if self.objects[id] is not None:
+                self.objects[id].body = id
+        self.objects.pop()
+        self.count = last
+        self.layout_version += 1
+        return last
+
+    def set_masses(self, ids, masses):
+        masses = np.broadcast_to(np.asarray(masses, dtype=np.float32), np.shape(ids))
+        self.masses[ids] = masses
+        # Mass 0 means static, the body is never integrated
+        self.inverse_masses[ids] = np.divide(1.0, masses, out=np.zeros_like(masses), where=masses > 0.0)
+
+    def set_sphere_colliders(self, ids, radii):
+        self.colliders[ids] = SPHERE
+        self.radii[ids] = radii
+        self.half_extents[ids] = np.asarray(radii, dtype=np.float32).reshape(-1, 1)
+
+    def set_box_colliders(self, ids, half_extents):
+        self.colliders[ids] = BOX
+        self.half_extents[ids] = np.asarray(half_extents, dtype=np.float32).reshape(-1, 3)
+
+    def apply_forces(self, ids, forces):
+        np.add.at(self.forces, ids, np.asarray(forces, dtype=np.float32).reshape(-1, 3))
+
+    def apply_impulses(self, ids, impulses):
+        ids = np.asarray(ids)
+        self.velocities[ids] += np.asarray(impulses, dtype=np.float32).reshape(-1, 3) * self.inverse_masses[ids, None]
+
+    def step(self, dt: float):
+        # Semi-implicit Euler over every body at once
+        n = self.count
+        inverse_masses = self.inverse_masses[:n, None]
+        dynamic = inverse_masses > 0.0
+
+        acceleration = self.forces[:n] * inverse_masses + self.gravity * dynamic
+        velocities = self.velocities[:n]
+        velocities += acceleration * dt
+        if self.linear_damping:
+            velocities *= (1.0 - self.linear_damping) ** dt
+        velocities *= dynamic
+        self.positions[:n] += velocities * dt
+
+        angular_velocities = self.angular_velocities[:n]
+        if self.angular_damping:
+            angular_velocities *= (1.0 - self.angular_damping) ** dt
+        angular_velocities *= dynamic
+        self.angles[:n] += angular_velocities * dt
+
+        self.forces[:n] = 0.0
+        self.resolve_collisions()
+        self.steps += 1
+
+    def find_contacts(self):
+        bodies = np.flatnonzero(self.colliders[:self.count] != NO_COLLIDER)
+        mins = self.positions[bodies] - self.half_extents[bodies]
+        maxs = self.positions[bodies] + self.half_extents[bodies]
+        i, j = self.grid.update(bodies, mins, maxs)
+
+        # Two static bodies never need resolving
+        dynamic = (self.inverse_masses[i] > 0.0) | (self.inverse_masses[j] > 0.0)
+        self.contacts = collide(self.positions, self.colliders, self.radii, self.half_extents, i[dynamic], j[dynamic])
+        return self.contacts
+
+    def resolve_collisions(self):
+        a, b, normals, depths = self.find_contacts()
+        if len(a) == 0:
+            return
+
+        inverse_a = self.inverse_masses[a]
+        inverse_b = self.inverse_masses[b]
+        total = inverse_a + inverse_b
+
+        # Push the bodies apart in proportion to their inverse mass
+        correction = normals * (depths / total)[:, None]
+        np.add.at(self.positions, a, -correction * inverse_a[:, None])
+        np.add.at(self.positions, b, correction * inverse_b[:, None])
+
+        # Impulse along the normal for the pairs that are still approaching
+        closing = np.einsum("ij,ij->i", self.velocities[b] - self.velocities[a], normals)
+        approaching = closing < 0.0
+        impulse = normals * (-(1.0 + self.restitution) * np.where(approaching, closing, 0.0) / total)[:, None]
+        np.add.at(self.velocities, a, -impulse * inverse_a[:, None])
+        np.add.at(self.velocities, b, impulse * inverse_b[:, None])
+
+    def advance(self, accumulator: float, timestep: float, max_steps: int = 5, before_step=None):
+        # Runs as many fixed steps as the accumulated time allows, at most max_steps so a slow frame can't
+        # trigger ever longer catch-ups (spiral of death). Time beyond the cap is dropped.
+        # before_step(timestep) is called ahead of every step, e.g. to apply forces.
+        # Returns (steps taken, accumulator left over), both in the caller's time unit (timestep is seconds here)
+        steps = 0
+        while accumulator >= timestep and steps < max_steps:
+            if before_step is not None:
+                before_step(timestep)
+            self.step(timestep)
+            accumulator -= timestep
+            steps += 1
+        if accumulator >= timestep:
+            dropped = accumulator - accumulator % timestep
+            self.dropped_time += dropped
+            accumulator -= dropped
+        return steps, accumulator
+
+    def write_back(self):
+        # Copies the simulated transform of every body with an object into Object.position / angle when it changed
+        # since the last write-back. Compared by pose rather than velocity: a body at rest can still be pushed out
+        # of a penetration by resolve_collisions
+        n = self.count
+        positions, angles = self.positions[:n], self.angles[:n]
+        changed = np.flatnonzero((positions != self.written_positions[:n]).any(axis=1) | (angles != self.written_angles[:n]).any(axis=1))
+        objects = self.objects
+        assign_poses([objects[body] for body in changed.tolist()], positions[changed], angles[changed])
+        self.written_positions[changed] = positions[changed]
+        self.written_angles[changed] = angles[changed]
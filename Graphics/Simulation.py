@@ -0,0 +1,144 @@
+from __future__ import annotations
+from Graphics.Utils.scene_store import assign_poses
+import threading
+import time
+import numpy as np
+
+# Optional simulation thread (Root(threaded_physics=True)): fixed physics steps run on a worker thread and publish
+# body transforms into double buffered snapshots, the GL thread blends the last two into the Objects each frame.
+# Tick callbacks run on the worker thread. Code on the GL thread that changes the physics world directly has
+# to hold Root.physics_lock (addRigidBody / removeRigidBody already do).
+
+class Snapshot:
+    # Body transforms after a physics step, arrays are reused between publishes
+    def __init__(self):
+        self.tick = -1
+        self.time = 0.0  # perf_counter time the step corresponds to
+        self.layout_version = -1
+        self.count = 0
+        self.positions = np.zeros((0, 3), dtype=np.float32)
+        self.angles = np.zeros((0, 3), dtype=np.float32)
+        self.objects = []
+
+    def capture(self, world, tick: int, when: float):
+        n = world.count
+        if len(self.positions) < n:
+            self.positions = np.empty((world.capacity, 3), dtype=np.float32)
+            self.angles = np.empty((world.capacity, 3), dtype=np.float32)
+        self.positions[:n] = world.positions[:n]
+        self.angles[:n] = world.angles[:n]
+        # Body ids only change meaning with the layout, the object list can be kept otherwise
+        if self.layout_version != world.layout_version:
+            self.objects = list(world.objects)
+            self.layout_version = world.layout_version
+        self.count = n
+        self.tick = tick
+        self.time = when
+
+class SnapshotBuffer:
+    # previous / current are read by the GL thread, back is written by the simulation thread without holding the lock.
+    # Publishing only rotates the three under the lock
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = Snapshot()
+        self.current = Snapshot()
+        self.back = Snapshot()
+
+    def publish(self, world, tick: int, when: float):
+        self.back.capture(world, tick, when)
+        with self.lock:
+            self.previous, self.current, self.back = self.current, self.back, self.previous
+
+class SimulationThread:
+    def __init__(self, root: "Root"):
+        self.root = root
+        self.snapshots = SnapshotBuffer()
+        self.thread = None
+        self.running = False
+        self.ticks = 0
+        self.error = None
+        # Bodies written to their objects by the last apply(), so stopped bodies get their final position once
+        self.last_changed = np.zeros(0, dtype=bool)
+        self.last_layout = -1
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="simulation", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        root = self.root
+        world = root.physics
+        timestep = root.physics_timestep / 1000.0
+        accumulator = 0.0
+        last = time.perf_counter()
+        try:
+            while self.running:
+                now = time.perf_counter()
+                accumulator += now - last
+                last = now
+                with root.physics_lock:
+                    steps, accumulator = world.advance(accumulator, timestep, root.max_physics_steps, root.run_tick_callbacks)
+                    if steps:
+                        self.ticks += steps
+                        # The published state belongs to the time the last step was due
+                        self.snapshots.publish(world, self.ticks, now - accumulator)
+
+                wait = timestep - (time.perf_counter() - last) - accumulator
+                if wait > 0.0:
+                    time.sleep(wait)
+        except Exception as error:
+            # Handed to the GL thread by the next apply()
+            self.error = error
+            self.running = False
+
+    def apply(self) -> float:
+        # Writes the transforms blended between the last two snapshots into the Objects, by how far we are into
+        # the current step. Returns the blend factor (0 = previous step, 1 = latest step)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Simulation thread failed") from error
+
+        timestep = self.root.physics_timestep / 1000.0
+        with self.snapshots.lock:
+            previous, current = self.snapshots.previous, self.snapshots.current
+            if current.tick < 0:
+                return 0.0
+            elapsed = time.perf_counter() - current.time
+            alpha = elapsed / timestep
+            alpha = 0.0 if alpha < 0.0 else 1.0 if alpha > 1.0 else alpha
+
+            n = current.count
+            if previous.tick >= 0 and previous.layout_version == current.layout_version:
+                start_positions, end_positions = previous.positions[:n], current.positions[:n]
+                start_angles, end_angles = previous.angles[:n], current.angles[:n]
+                positions = start_positions + (end_positions - start_positions) * alpha
+                angles = start_angles + (end_angles - start_angles) * alpha
+                changed = (start_positions != end_positions).any(axis=1) | (start_angles != end_angles).any(axis=1)
+            else:
+                positions = current.positions[:n].copy()
+                angles = current.angles[:n].copy()
+                changed = np.ones(n, dtype=bool)
+            objects = current.objects
+            layout = current.layout_version
+
+        write = changed.copy()
+        if layout == self.last_layout:
+            write |= self.last_changed
+        self.last_changed = changed
+        self.last_layout = layout
+
+        bodies = np.flatnonzero(write)
+        assign_poses([objects[body] for body in bodies.tolist()], positions[bodies], angles[bodies])
+
+        # Same meaning as in the single threaded loop: time accumulated towards the next step, in ms
+        self.root.physics_timer = elapsed * 1000.0
+        return alpha
@@ -6,195 +6,640 @@ from OpenGL.GLUT import *
 from itertools import *
 from OpenGL.GLU import *
 from Graphics.Utils.shader_utils import Material
+from Graphics.Utils import culling
+from Graphics.Utils import profiler
+from Graphics.Utils.scene_store import SceneNode
 from typing import Optional, List
 from glm import *
 import numpy as np
 
-class Shape():
+class Shape(SceneNode):
+    # Shapes added to an Object get a row in rootNode.nodes next to it, see Graphics/Utils/scene_store.py
+    __slots__ = ("material", "object")
+
     def __init__(self, material: str = "default"):
         self.material = material
         self.object: Optional[Object] = None
         pass
 
-class Triangle(Shape):
-    def __init__(self, object: Object, vertices: List[vec3]):
 
-        super().__init__()
+def compute_normals(positions: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    # Area weighted vertex normals, vertices that are not shared end up with the flat face normal
+    tris = indices.reshape(-1, 3)
+    v0 = positions[tris[:, 0]]
+    face_normals = np.cross(positions[tris[:, 1]] - v0, positions[tris[:, 2]] - v0)
+
+    normals = np.zeros_like(positions)
+    for corner in range(3):
+        np.add.at(normals, tris[:, corner], face_normals)
+
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0.0] = 1.0
+    return (normals / lengths).astype(np.float32)
+
+def interleave_vertices(positions: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    # (N, 6) float32 rows of position + normal, the layout of every vertex buffer
+    vertex_data = np.empty((len(positions), 6), dtype=np.float32)
+    vertex_data[:, 0:3] = positions
+    vertex_data[:, 3:6] = normals
+    return vertex_data
+
+def vertex_runs(mask: np.ndarray, gap: int = 0):
+    # (starts, ends) of the runs of True in mask, runs less than gap apart are merged into one
+    rows = np.flatnonzero(mask)
+    if not len(rows):
+        return rows, rows
+    breaks = np.flatnonzero(np.diff(rows) > gap + 1) + 1
+    starts = rows[np.concatenate([[0], breaks])]
+    ends = rows[np.concatenate([breaks - 1, [len(rows) - 1]])] + 1
+    return starts, ends
+
+def vertex_triangles(indices: np.ndarray, vertex_count: int):
+    # Triangles using each vertex as CSR arrays: triangles[offsets[v]:offsets[v + 1]] for vertex v
+    order = np.argsort(indices, kind="stable")
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=vertex_count), out=offsets[1:])
+    return offsets, order // 3
+
+def gather_triangles(adjacency, vertices: np.ndarray) -> np.ndarray:
+    # Sorted unique triangles using any of vertices
+    offsets, triangles = adjacency
+    starts = offsets[vertices]
+    counts = offsets[vertices + 1] - starts
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    used = np.zeros(len(triangles) // 3, dtype=bool)
+    used[triangles[np.repeat(starts, counts) + local]] = True
+    return np.flatnonzero(used)
+
+# Read-only (vertex_data, indices, bounds_min, bounds_max) of the built-in primitives, shared by every shape
+# created with the same parameters. Editing a shape's vertices replaces its arrays, the shared ones never change
+SHARED_GEOMETRY = {}
+
+def shared_geometry(key, build):
+    # build() returns (positions, indices, normals or None), it is only called the first time key is seen
+    geometry = SHARED_GEOMETRY.get(key)
+    if geometry is None:
+        positions, indices, normals = build()
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        indices = np.ascontiguousarray(indices, dtype=np.uint32).reshape(-1)
+        vertex_data = interleave_vertices(positions, compute_normals(positions, indices) if normals is None else normals)
+        geometry = (vertex_data, indices, vertex_data[:, 0:3].min(axis=0), vertex_data[:, 0:3].max(axis=0))
+        for array in geometry:
+            array.flags.writeable = False
+        SHARED_GEOMETRY[key] = geometry
+    return geometry
+
+class Mesh(Shape):
+    # One interleaved VBO (position + normal) and one EBO per shape, drawn with a single glDrawElements
+    STRIDE = 6 * 4
+    __slots__ = ("color", "vertex_data", "indices", "vertex_count", "index_count", "dirty", "bounds_min", "bounds_max",
+                 "vao", "vbo", "ebo", "uploaded_vertices", "uploaded_indices", "lod_meshes", "lod_thresholds", "lod", "static_batch",
+                 "dirty_vertices", "adjacency", "edit_count")
+    # Dirty vertex runs closer than this are uploaded with one call
+    MERGE_GAP = 16
+
+    def __init__(self, object: Object, positions, indices, normals=None, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1), color: tuple = (1.0, 1.0, 1.0), material: str = "default", vertex_data=None, bounds=None):
+        # Either positions (+ normals, computed when missing) or ready made interleaved vertex_data and optionally
+        # its (min, max) bounds, see set_vertex_data
+        super().__init__(material)
         self.object = object
-        self.position = vec3(0, 0, 0)
-        self.rotation = vec3(0, 0, 0)
-        self.scale = vec3(1, 1, 1)
+        self.color = color
 
-        # 🧊 Compute normal
-        u = vertices[1] - vertices[0]
-        v = vertices[2] - vertices[0]
-        normal = normalize(cross(u, v))
+        # position / rotation / scale live in the scene store once the mesh is added to an Object
+        self.init_transform(position, rotation, scale)
+
+        # GL objects are created lazily on the first draw so meshes can be built without a context
+        self.vao = None
+        self.vbo = None
+        self.ebo = None
+        self.uploaded_vertices = 0
+        self.uploaded_indices = 0
+
+        # Coarser versions of this mesh: lod_meshes[k - 1] is drawn at level k, chosen each frame by the scene
+        # once the mesh covers less than lod_thresholds[k - 1] of the view height. Empty tuples until set_lods
+        self.lod_meshes: List[Mesh] = ()
+        self.lod_thresholds: List[float] = ()
+        self.lod = 0
+        # StaticBatch holding this mesh's world space copy once its subtree was made static (see batching.py)
+        self.static_batch = None
+        # Vertices edited since the last upload (see update_vertices), None when there are none
+        self.dirty_vertices = None
+        # vertex_triangles of the indices, built on the first edit
+        self.adjacency = None
+        # Bumped whenever the vertex data changes, lets CPU side copies (ray cast trees) know when to refit
+        self.edit_count = 0
+
+        if vertex_data is not None:
+            self.set_vertex_data(vertex_data, indices, *(bounds if bounds is not None else (None, None)))
+        else:
+            self.set_geometry(positions, indices, normals)
+
+    def set_geometry(self, positions, indices, normals=None):
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        indices = np.ascontiguousarray(indices, dtype=np.uint32).reshape(-1)
+        if normals is None:
+            normals = compute_normals(positions, indices)
+        self.set_vertex_data(interleave_vertices(positions, normals), indices)
+
+    def set_vertex_data(self, vertex_data, indices, bounds_min=None, bounds_max=None):
+        # Takes the arrays as they are when they already have the right layout (float32 (N, 6) and uint32),
+        # memory mapped cache files stay mapped and go to glBufferData without a copy
+        self.vertex_data = vertex_data if vertex_data.dtype == np.float32 and vertex_data.flags.c_contiguous else np.ascontiguousarray(vertex_data, dtype=np.float32)
+        if self.vertex_data.ndim != 2:
+            self.vertex_data = self.vertex_data.reshape(-1, 6)
+        self.indices = indices if indices.dtype == np.uint32 and indices.flags.c_contiguous else np.ascontiguousarray(indices, dtype=np.uint32)
+        if self.indices.ndim != 1:
+            self.indices = self.indices.reshape(-1)
+        self.vertex_count = len(self.vertex_data)
+        self.index_count = len(self.indices)
+        self.dirty = True
+        self.dirty_vertices = None
+        self.adjacency = None
+        self.edit_count += 1
+
+        # Local space bounding box, used for culling
+        if bounds_min is not None:
+            self.bounds_min = np.asarray(bounds_min, dtype=np.float32)
+            self.bounds_max = np.asarray(bounds_max, dtype=np.float32)
+        elif self.vertex_count:
+            self.bounds_min = self.vertex_data[:, 0:3].min(axis=0)
+            self.bounds_max = self.vertex_data[:, 0:3].max(axis=0)
+        else:
+            self.bounds_min = np.zeros(3, dtype=np.float32)
+            self.bounds_max = np.zeros(3, dtype=np.float32)
+        self.notify_moved()
+
+    def update_vertices(self, rows, positions):
+        # Moves some vertices, only the normals around them are recomputed and only their range is uploaded
+        if not self.vertex_data.flags.writeable:
+            # Shared or memory mapped geometry, this mesh gets its own (in memory) copy first
+            self.vertex_data = np.array(self.vertex_data)
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+        self.vertex_data[rows, 0:3] = positions
+        self.touch_vertices(rows)
+
+    def touch_vertices(self, rows, normals: bool = True):
+        # Call after editing positions in place (mesh.positions[rows] = ...), normals=False keeps the current ones
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+        if normals:
+            rows = np.union1d(rows, self.update_normals(rows))
+        if not self.dirty:
+            if self.dirty_vertices is None:
+                self.dirty_vertices = np.zeros(self.vertex_count, dtype=bool)
+            self.dirty_vertices[rows] = True
+        self.edit_count += 1
+        self.bounds_min = self.vertex_data[:, 0:3].min(axis=0)
+        self.bounds_max = self.vertex_data[:, 0:3].max(axis=0)
+        self.notify_moved()
+
+    def update_normals(self, rows: np.ndarray) -> np.ndarray:
+        # Recomputes (as compute_normals does) the normals of every vertex sharing a triangle with rows, from the
+        # triangles around those vertices only. Returns the vertices whose normal was rewritten
+        if self.adjacency is None:
+            self.adjacency = vertex_triangles(self.indices, self.vertex_count)
+        tris = self.indices.reshape(-1, 3)
+        affected = np.zeros(self.vertex_count, dtype=bool)
+        affected[tris[gather_triangles(self.adjacency, rows)]] = True
+        affected = np.flatnonzero(affected)
+        corners = tris[gather_triangles(self.adjacency, affected)]
+        positions = self.vertex_data[:, 0:3]
+        v0 = positions[corners[:, 0]]
+        face_normals = np.repeat(np.cross(positions[corners[:, 1]] - v0, positions[corners[:, 2]] - v0), 3, axis=0)
+
+        # Sums for every vertex of those triangles, only the affected ones have all of their triangles in there
+        corners = corners.reshape(-1)
+        normals = np.stack([np.bincount(corners, face_normals[:, axis], minlength=self.vertex_count)[affected] for axis in range(3)], axis=1)
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        lengths[lengths == 0.0] = 1.0
+        self.vertex_data[affected, 3:6] = normals / lengths
+        return affected
+
+    def clone(self) -> Mesh:
+        # Plain Mesh with this mesh's geometry, LODs, transform, color and material. The geometry is shared
+        # (made read-only, so whichever copy is edited first gets its own arrays)
+        self.vertex_data.flags.writeable = False
+        self.indices.flags.writeable = False
+        # Fields are copied directly, this is the per object cost of Object.addChildren
+        mesh = Mesh.__new__(Mesh)
+        mesh.material = self.material
+        mesh.object = None
+        mesh.store = None
+        mesh.node = None
+        mesh.detached = self.get_trs().copy()
+        mesh.color = self.color
+        mesh.vertex_data = self.vertex_data
+        mesh.indices = self.indices
+        mesh.vertex_count = self.vertex_count
+        mesh.index_count = self.index_count
+        mesh.dirty = True
+        mesh.bounds_min = self.bounds_min
+        mesh.bounds_max = self.bounds_max
+        mesh.vao = mesh.vbo = mesh.ebo = None
+        mesh.uploaded_vertices = mesh.uploaded_indices = 0
+        mesh.lod_meshes = self.lod_meshes
+        mesh.lod_thresholds = self.lod_thresholds
+        mesh.lod = 0
+        mesh.static_batch = None
+        mesh.dirty_vertices = None
+        mesh.adjacency = self.adjacency
+        mesh.edit_count = self.edit_count
+        return mesh
+
+    def set_lods(self, meshes: List[Mesh], thresholds: List[float]):
+        # thresholds are decreasing screen sizes (fraction of the view height), one per mesh.
+        # LOD meshes only provide geometry, they are drawn with this mesh's transform, color and material
+        if len(meshes) != len(thresholds):
+            raise ValueError("Every LOD mesh needs a threshold")
+        if np.any(np.diff(np.asarray(thresholds, dtype=np.float64)) >= 0.0):
+            raise ValueError("LOD thresholds have to be decreasing")
+        self.lod_meshes = list(meshes)
+        self.lod_thresholds = list(thresholds)
+        self.lod = 0
+        if self.object is not None:
+            self.object.rootNode.scene.set_lod_thresholds(self, self.lod_thresholds)
+
+    def get_geometry(self) -> Mesh:
+        # Mesh whose buffers are drawn at the current level of detail
+        return self if self.lod == 0 else self.lod_meshes[self.lod - 1]
+
+    def get_vao(self):
+        return self.get_geometry().vao
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self.vertex_data[:, 0:3]
+
+    @property
+    def normals(self) -> np.ndarray:
+        return self.vertex_data[:, 3:6]
+
+    def upload(self):
+        if self.vao is None:
+            self.vao = glGenVertexArrays(1)
+            self.vbo = glGenBuffers(1)
+            self.ebo = glGenBuffers(1)
 
-        data = []
-        for vtx in vertices:
-            data += [vtx.x, vtx.y, vtx.z]
-            data += [normal.x, normal.y, normal.z]
+        glBindVertexArray(self.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        if self.uploaded_vertices == self.vertex_count:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.vertex_data.nbytes, self.vertex_data)
+        else:
+            glBufferData(GL_ARRAY_BUFFER, self.vertex_data.nbytes, self.vertex_data, GL_STATIC_DRAW)
 
-        self.vertex_count = 3
-        self.vao = glGenVertexArrays(1)
-        self.vbo = glGenBuffers(1)
+        self.bind_attributes()
+        if self.uploaded_indices == self.index_count:
+            glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, 0, self.indices.nbytes, self.indices)
+        else:
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
 
-        glBindVertexArray(self.vao)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.uploaded_vertices = self.vertex_count
+        self.uploaded_indices = self.index_count
+        self.dirty = False
+        self.dirty_vertices = None
+        profiler.count("uploaded_bytes", self.vertex_data.nbytes + self.indices.nbytes)
+
+    def upload_ranges(self):
+        # Sends only the runs of edited vertices
+        starts, ends = vertex_runs(self.dirty_vertices, self.MERGE_GAP)
         glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            glBufferSubData(GL_ARRAY_BUFFER, start * self.STRIDE, (end - start) * self.STRIDE, self.vertex_data[start:end])
+            profiler.count("uploaded_bytes", (end - start) * self.STRIDE)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.dirty_vertices = None
 
-        vertex_data = np.array(data, dtype=np.float32)
-        glBufferData(GL_ARRAY_BUFFER, vertex_data.nbytes, vertex_data, GL_STATIC_DRAW)
+    def bind_attributes(self):
+        # Points attributes 0 and 1 of the bound VAO at this mesh's buffers, other VAOs (instancing) reuse this
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
 
         # position
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 6 * 4, ctypes.c_void_p(0))
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, self.STRIDE, ctypes.c_void_p(0))
         glEnableVertexAttribArray(0)
 
         # normal
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 6 * 4, ctypes.c_void_p(3 * 4))
+        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, self.STRIDE, ctypes.c_void_p(3 * 4))
         glEnableVertexAttribArray(1)
 
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
-        glBindVertexArray(0)
+        # The element buffer binding is part of the VAO state
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ebo)
 
-    def get_model_matrix(self):
-        model = mat4(1.0)
-        model = translate(model, vec3(self.position.x, self.position.y, self.position.z))
-        model = rotate(model, radians(self.rotation.x), vec3(1, 0, 0))
-        model = rotate(model, radians(self.rotation.y), vec3(0, 1, 0))
-        model = rotate(model, radians(self.rotation.z), vec3(0, 0, 1))
-        model = scale(model, vec3(self.scale.x, self.scale.y, self.scale.z))
-        return np.array(model.to_list(), dtype=np.float32)
+    def delete(self):
+        if self.vao is not None:
+            glDeleteBuffers(2, [self.vbo, self.ebo])
+            glDeleteVertexArrays(1, [self.vao])
+            self.vao = self.vbo = self.ebo = None
+            self.uploaded_vertices = self.uploaded_indices = 0
 
-    def draw(self):
-        material = self.object.rootNode.shaders.get_shader(self.material)
-        # Set the model matrix for the current object
-        model = self.get_model_matrix()
-        material.set_mat4("model", model)
-        # Optionally pass color to shader
-        glUniform3f(glGetUniformLocation(material.id, b"color"), 1.0, 1.0, 1.0)
+    # Like Object.position / angle / scale the getters return copies, assign the whole vector to move the mesh
+    @property
+    def position(self) -> vec3:
+        return vec3(*self.get_trs()[0].tolist())
 
-        # Bind and draw the object
-        glBindVertexArray(self.vao)
-        glDrawArrays(GL_TRIANGLES, 0, self.vertex_count)
-        glBindVertexArray(0)
+    @position.setter
+    def position(self, value: vec3):
+        self.get_trs()[0] = tuple(value)
+        self.changed_trs()
 
-class Plane(Shape):
-    def __init__(self, object: Object, position: vec3 = vec3(0, 0, 0), vertices: List[vec3] = [vec3(-1, -1, 0), vec3( 1, -1, 0), vec3( 1,  1, 0), vec3(-1,  1, 0)], rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1,)):
-        super().__init__()
-        self.object = object
-        # Panel size defines width and height (a square panel, for simplicity)
-        self.position = position
-        self.scale = scale
-        self.rotation = rotation
-        self.vertices = vertices
-        
-        # Create two triangles to form the panel (quad)
-        self.triangles = [
-            Triangle(self.object, vertices=[self.vertices[0], self.vertices[1], self.vertices[2]]),  # Bottom triangle
-            Triangle(self.object, vertices=[self.vertices[0], self.vertices[2], self.vertices[3]])   # Top triangle
-        ]
+    @property
+    def rotation(self) -> vec3:
+        return vec3(*self.get_trs()[1].tolist())
 
-    def updateTriangles(self):
-        self.triangles[0].vertices = [self.vertices[0], self.vertices[1], self.vertices[2]]
-        self.triangles[1].vertices = [self.vertices[0], self.vertices[2], self.vertices[3]]
-        self.triangles[0].color = self.color
-        self.triangles[1].color = self.color
+    @rotation.setter
+    def rotation(self, value: vec3):
+        self.get_trs()[1] = tuple(value)
+        self.changed_trs()
 
-    def moveVertice(self, which: int, by: vec3):
-        self.vertices[which] += by
-        self.updateTriangles()
+    @property
+    def scale(self) -> vec3:
+        return vec3(*self.get_trs()[2].tolist())
 
-    def moveVertice_to(self, which: int, to: vec3):
-        self.vertices[which] = to
-        self.updateTriangles()
+    @scale.setter
+    def scale(self, value: vec3):
+        self.get_trs()[2] = tuple(value)
+        self.changed_trs()
+
+    def notify_moved(self):
+        # Tells the scene BVH that this mesh's local bounds changed (moves are picked up from the scene store)
+        if self.object is not None:
+            self.object.rootNode.scene.mark_moved(self)
+
+    def get_world_bounds(self):
+        return culling.transform_aabb(self.get_model_matrix(), self.bounds_min, self.bounds_max)
 
     def rotate(self, by: vec3):
-        self.rotation += by
+        self.rotation = self.rotation + by
 
     def rotate_to(self, to: vec3):
         self.rotation = to
 
+    def get_local_matrix(self) -> np.ndarray:
+        return self.get_local_array()
+
+    def get_model_matrix(self) -> np.ndarray:
+        # Row-major object world * local. Added meshes read it from the store, a mesh that only references its
+        # object (an instanced group's mesh) composes it on every call
+        if self.node is not None:
+            return self.get_world_array()
+        local = self.get_local_array()
+        if self.object is None:
+            return local
+        return self.object.get_world_matrix() @ local
+
     def draw(self):
-        glPushMatrix()
-        
-        # Apply world transformations (position, rotation, etc.)
-        glTranslatef(self.position.x, self.position.y, self.position.z)
-        glRotatef(self.rotation.x, 1, 0, 0)
-        glRotatef(self.rotation.y, 0, 1, 0)
-        glRotatef(self.rotation.z, 0, 0, 1)
-        glScalef(self.scale.x, self.scale.y, self.scale.z)
-        
-        # Draw the two triangles of the panel
-        for triangle in self.triangles:
-            triangle.draw()
-
-        glPopMatrix()
-
-class Cube(Shape):
-    def __init__(self, object: Object, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), color: tuple = (1.0, 1.0, 1.0), scale: vec3 = vec3(1, 1, 1,)):
-        super().__init__()
-        self.object = object
-        # Panel size defines width and height (a square panel, for simplicity)
-        self.position = position
-        self.rotation = rotation
-        self.color = color
-        self.scale = scale
-
-        vertices = [
-            vec3(-1, -1, 1),  # Bottom-left-front
-            vec3( 1, -1, 1),  # Bottom-right-front
-            vec3( 1,  1, 1),  # Top-right-front
-            vec3(-1,  1, 1),  # Top-left-front
-            vec3(-1, -1, -1),  # Bottom-left-back
-            vec3( 1, -1, -1),  # Bottom-right-back
-            vec3( 1,  1, -1),  # Top-right-back
-            vec3(-1,  1, -1)   # Top-left-back
-        ]
-        
-        # Create two triangles to form the panel (quad)
-        self.planes = [
-            Plane(self.object, vertices=[vertices[6], vertices[7], vertices[3], vertices[2]]), # top plane
-            Plane(self.object, vertices=[vertices[5], vertices[4], vertices[0], vertices[1]]), # bottom plane
-            Plane(self.object, vertices=[vertices[1], vertices[0], vertices[3], vertices[2]]), # front plane
-            Plane(self.object, vertices=[vertices[5], vertices[4], vertices[7], vertices[6]]), # back plane
-            Plane(self.object, vertices=[vertices[7], vertices[3], vertices[0], vertices[4]]), # left plane
-            Plane(self.object, vertices=[vertices[6], vertices[2], vertices[1], vertices[5]])  # right plane
-        ]
+        if self.static_batch is not None:
+            self.static_batch.draw_member(self)
+            return
+        self.draw_geometry()
+
+    def draw_geometry(self):
+        self.prepare()
+        if self.get_vao() is None:
+            return
+        material = self.get_material()
+        material.use()
+
+        # Bind and draw the whole mesh at once
+        glBindVertexArray(self.get_vao())
+        self.issue_draw(material)
+        glBindVertexArray(0)
 
-    def updatePlanes(self):
-        self.planes[0].vertices = [vertices[7], vertices[6], vertices[3], vertices[2]]
-        self.planes[1].vertices = [vertices[4], vertices[5], vertices[0], vertices[1]]
-        for i in self.planes:
-            #i.color = self.color
-            i.updateTriangles()
+    # prepare / get_material / issue_draw are what the RenderQueue uses to draw with sorted, shared state
+    def prepare(self):
+        geometry = self.get_geometry()
+        if geometry.dirty:
+            geometry.upload()
+        elif geometry.dirty_vertices is not None:
+            geometry.upload_ranges()
+
+    def get_material(self) -> Material:
+        return self.object.rootNode.shaders.get_shader(self.material)
+
+    def get_triangle_count(self) -> int:
+        return self.get_geometry().index_count // 3
+
+    def issue_draw(self, material: Material):
+        # Expects the material's program and this mesh's VAO to be bound
+        # Set the model matrix for the current object
+        material.set_mat4("model", self.get_model_matrix())
+        # Optionally pass color to shader
+        material.set_vec3("color", self.color)
+        glDrawElements(GL_TRIANGLES, self.get_geometry().index_count, GL_UNSIGNED_INT, None)
+
+    def get_base_vertex(self) -> int:
+        # First vertex of the current data in the vertex buffer, only DynamicMesh moves it
+        return 0
+
+class MeshPlaceholder(Mesh):
+    # Empty mesh standing in for geometry that is still loading (see Graphics/Utils/assets.py). It can be added
+    # with Object.addShape right away and stays invisible (no VAO) until its data has been streamed to the GPU
+    __slots__ = ("loaded", "error", "source", "streamed")
+
+    def __init__(self, object: Object = None, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1), color: tuple = (1.0, 1.0, 1.0), material: str = "default"):
+        self.loaded = False
+        self.error = None
+        self.source = None
+        self.streamed = 0
+        super().__init__(object, np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.uint32), np.zeros((0, 3), dtype=np.float32), position, rotation, scale, color, material)
+
+    def prepare(self):
+        if self.loaded:
+            super().prepare()
+
+    def stream(self, budget: int) -> int:
+        # Uploads up to budget bytes of the arrived geometry into buffers allocated (orphaned) on the first call.
+        # Returns the number of bytes sent, the mesh becomes drawable once everything is on the GPU
+        vertex_bytes = self.vertex_data.reshape(-1).view(np.uint8)
+        index_bytes = self.indices.view(np.uint8)
+        if self.vbo is None:
+            self.vbo = glGenBuffers(1)
+            self.ebo = glGenBuffers(1)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.vbo)
+            glBufferData(GL_COPY_WRITE_BUFFER, len(vertex_bytes), None, GL_STATIC_DRAW)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.ebo)
+            glBufferData(GL_COPY_WRITE_BUFFER, len(index_bytes), None, GL_STATIC_DRAW)
+            self.streamed = 0
+
+        total = len(vertex_bytes) + len(index_bytes)
+        end = self.streamed + budget if self.streamed + budget < total else total
+        start = self.streamed
+        # The vertex buffer is filled first, then the index buffer
+        for buffer, data, offset in ((self.vbo, vertex_bytes, 0), (self.ebo, index_bytes, len(vertex_bytes))):
+            first = (start if start > offset else offset) - offset
+            last = (end if end < offset + len(data) else offset + len(data)) - offset
+            if last > first:
+                glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+                glBufferSubData(GL_COPY_WRITE_BUFFER, first, last - first, data[first:last])
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        self.streamed = end
+        profiler.count("uploaded_bytes", end - start)
+
+        if end == total:
+            self.vao = glGenVertexArrays(1)
+            glBindVertexArray(self.vao)
+            self.bind_attributes()
+            glBindVertexArray(0)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            self.uploaded_vertices = self.vertex_count
+            self.uploaded_indices = self.index_count
+            self.dirty = False
+            self.loaded = True
+        return end - start
+
+class Triangle(Mesh):
+    __slots__ = ("vertices",)
+
+    def __init__(self, object: Object, vertices: List[vec3], color: tuple = (1.0, 1.0, 1.0)):
+        self.vertices = list(vertices)
+        super().__init__(object, [[v.x, v.y, v.z] for v in self.vertices], [0, 1, 2], color=color)
+
+    def updateVertices(self):
+        self.set_geometry([[v.x, v.y, v.z] for v in self.vertices], self.indices)
+
+class Plane(Mesh):
+    CORNERS = [[-1, -1, 0], [1, -1, 0], [1, 1, 0], [-1, 1, 0]]
+    __slots__ = ("_vertices",)
+
+    def __init__(self, object: Object, position: vec3 = vec3(0, 0, 0), vertices: Optional[List[vec3]] = None, rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1,), color: tuple = (1.0, 1.0, 1.0)):
+        # Panel size defines width and height (a square panel, for simplicity). Without vertices the panel uses
+        # the shared default geometry and its vertex list is only created when it is accessed
+        self._vertices = None if vertices is None else list(vertices)
+
+        # Two triangles form the panel (quad): bottom (0, 1, 2) and top (0, 2, 3)
+        if self._vertices is None:
+            vertex_data, indices, bounds_min, bounds_max = shared_geometry("plane", lambda: (self.CORNERS, [0, 1, 2, 0, 2, 3], None))
+            super().__init__(object, None, indices, position=position, rotation=rotation, scale=scale, color=color, vertex_data=vertex_data, bounds=(bounds_min, bounds_max))
+        else:
+            super().__init__(object, self.get_positions(), [0, 1, 2, 0, 2, 3], position=position, rotation=rotation, scale=scale, color=color)
+
+    @property
+    def vertices(self) -> List[vec3]:
+        if self._vertices is None:
+            self._vertices = [vec3(*corner) for corner in self.CORNERS]
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, value: List[vec3]):
+        self._vertices = list(value)
+
+    def get_positions(self):
+        return [[v.x, v.y, v.z] for v in self.vertices]
+
+    def updateTriangles(self):
+        self.set_geometry(self.get_positions(), self.indices)
 
+    # Moving one vertex only rewrites that vertex and the normals around it, see Mesh.update_vertices
     def moveVertice(self, which: int, by: vec3):
-        vertices[which] += by
-        self.updatePlanes()
+        self.moveVertice_to(which, self.vertices[which] + by)
 
     def moveVertice_to(self, which: int, to: vec3):
-        vertices[which] = to
-        self.updatePlanes()
+        self.vertices[which] = vec3(to)
+        self.update_vertices(which, tuple(self.vertices[which]))
+
+class Cube(Mesh):
+    # Corner indices of the 8 cube vertices used by each face (wound so normals point outwards),
+    # every face gets its own 4 vertices for flat normals
+    FACES = [
+        [6, 7, 3, 2], # top plane
+        [4, 5, 1, 0], # bottom plane
+        [0, 1, 2, 3], # front plane
+        [5, 4, 7, 6], # back plane
+        [4, 0, 3, 7], # left plane
+        [6, 2, 1, 5]  # right plane
+    ]
+
+    CORNERS = [
+        [-1, -1, 1],  # Bottom-left-front
+        [ 1, -1, 1],  # Bottom-right-front
+        [ 1,  1, 1],  # Top-right-front
+        [-1,  1, 1],  # Top-left-front
+        [-1, -1, -1],  # Bottom-left-back
+        [ 1, -1, -1],  # Bottom-right-back
+        [ 1,  1, -1],  # Top-right-back
+        [-1,  1, -1]   # Top-left-back
+    ]
+    __slots__ = ("_vertices",)
 
-    def rotate(self, by: vec3):
-        self.rotation += by
+    def __init__(self, object: Object, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), color: tuple = (1.0, 1.0, 1.0), scale: vec3 = vec3(1, 1, 1,)):
+        # Every cube starts out with the shared geometry, the vertex list only exists once it is accessed
+        self._vertices = None
+        vertex_data, indices, bounds_min, bounds_max = shared_geometry("cube", lambda: (self.get_positions(), self.get_indices(), None))
+        super().__init__(object, None, indices, position=position, rotation=rotation, scale=scale, color=color, vertex_data=vertex_data, bounds=(bounds_min, bounds_max))
 
-    def rotate_to(self, to: vec3):
-        self.rotation = to
+    @property
+    def vertices(self) -> List[vec3]:
+        if self._vertices is None:
+            self._vertices = [vec3(*corner) for corner in self.CORNERS]
+        return self._vertices
 
-    def draw(self):
-        glPushMatrix()
-        
-        # Apply world transformations (position, rotation, etc.)
-        glTranslatef(self.position.x, self.position.y, self.position.z)
-        glRotatef(self.rotation.x, 1, 0, 0)
-        glRotatef(self.rotation.y, 0, 1, 0)
-        glRotatef(self.rotation.z, 0, 0, 1)
-        glScalef(self.scale.x, self.scale.y, self.scale.z)
-        
-        # Draw the two triangles of the panel
-        for planes in self.planes:
-            planes.draw()
-
-        glPopMatrix()
+    @vertices.setter
+    def vertices(self, value: List[vec3]):
+        self._vertices = list(value)
+
+    def get_indices(self):
+        quad = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+        return (np.arange(len(self.FACES), dtype=np.uint32)[:, None] * 4 + quad).reshape(-1)
 
+    def get_positions(self):
+        corners = np.array(self.CORNERS if self._vertices is None else [[v.x, v.y, v.z] for v in self._vertices], dtype=np.float32)
+        return corners[np.array(self.FACES).reshape(-1)]
+
+    def updatePlanes(self):
+        self.set_geometry(self.get_positions(), self.indices)
+
+    # A corner is one vertex on each of its three faces, those are moved and their faces' normals recomputed
+    def moveVertice(self, which: int, by: vec3):
+        self.moveVertice_to(which, self.vertices[which] + by)
+
+    def moveVertice_to(self, which: int, to: vec3):
+        self.vertices[which] = vec3(to)
+        rows = np.flatnonzero(np.array(self.FACES).reshape(-1) == which)
+        self.update_vertices(rows, tuple(self.vertices[which]))
+
+
+class Sphere(Mesh):
+    # UV sphere. Every entry of lod_thresholds adds a coarser tessellation (half the slices and stacks of the
+    # previous one), used below that screen size. Spheres with the same parameters share their geometry, LOD
+    # meshes included (and with them the LOD buffers on the GPU)
+    __slots__ = ("radius",)
+    LOD_MESHES = {}
+
+    def __init__(self, object: Object, radius: float = 1.0, slices: int = 32, stacks: int = 16, position: vec3 = vec3(0, 0, 0), color: tuple = (1.0, 1.0, 1.0), lod_thresholds: List[float] = ()):
+        self.radius = radius
+        vertex_data, indices, bounds_min, bounds_max = self.get_tessellation(radius, slices, stacks)
+        super().__init__(object, None, indices, position=position, color=color, vertex_data=vertex_data, bounds=(bounds_min, bounds_max))
+
+        if lod_thresholds:
+            key = (radius, slices, stacks, len(lod_thresholds))
+            lods = self.LOD_MESHES.get(key)
+            if lods is None:
+                lods = []
+                for level in range(1, len(lod_thresholds) + 1):
+                    lod_slices = slices >> level if slices >> level > 3 else 3
+                    lod_stacks = stacks >> level if stacks >> level > 2 else 2
+                    lod_vertex_data, lod_indices, lod_min, lod_max = self.get_tessellation(radius, lod_slices, lod_stacks)
+                    lods.append(Mesh(None, None, lod_indices, vertex_data=lod_vertex_data, bounds=(lod_min, lod_max)))
+                lods = self.LOD_MESHES[key] = tuple(lods)
+            self.set_lods(lods, lod_thresholds)
+
+    @classmethod
+    def get_tessellation(cls, radius: float, slices: int, stacks: int):
+        def build():
+            positions, indices = cls.tessellate(radius, slices, stacks)
+            # Normals of a sphere are its normalized positions
+            return positions, indices, positions / radius
+        return shared_geometry(("sphere", radius, slices, stacks), build)
+
+    @staticmethod
+    def tessellate(radius: float, slices: int, stacks: int):
+        theta = np.linspace(0.0, np.pi, stacks + 1, dtype=np.float32)[:, None]
+        phi = np.linspace(0.0, 2.0 * np.pi, slices + 1, dtype=np.float32)[None, :]
+        positions = np.stack(np.broadcast_arrays(np.sin(theta) * np.cos(phi), np.cos(theta), np.sin(theta) * np.sin(phi)), axis=-1).reshape(-1, 3) * radius
+
+        # Two triangles per grid cell, wound counter clockwise seen from outside
+        row = slices + 1
+        cells = (np.arange(stacks)[:, None] * row + np.arange(slices)[None, :]).reshape(-1)
+        indices = np.stack([cells, cells + 1, cells + row, cells + 1, cells + row + 1, cells + row], axis=1)
+        return positions.astype(np.float32), indices.reshape(-1).astype(np.uint32)
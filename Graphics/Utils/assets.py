@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from Graphics.Utils.Shapes import MeshPlaceholder, compute_normals, interleave_vertices
+from Graphics.Utils.cache import MeshCache, read_mesh_binary
+from typing import Optional
+import os
+import queue
+import time
+import numpy as np
+
+# Mesh file parsing (OBJ, PLY, and our own binary .mesh format, see cache.py) and an asynchronous loader that
+# parses on a worker pool and streams the results to the GPU over several frames.
+
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"
+}
+
+def triangulate(faces, dtype=np.uint32) -> np.ndarray:
+    # Fan triangulation of a list of polygons (lists of vertex indices), grouped by size so each group is one array op.
+    # dtype is the type of the result, signed for indices that still need remapping (OBJ)
+    faces = list(faces)
+    if not faces:
+        return np.zeros(0, dtype=dtype)
+    sizes = np.fromiter((len(face) for face in faces), dtype=np.int64, count=len(faces))
+    triangles = []
+    for size in np.unique(sizes):
+        if size < 3:
+            continue
+        polygons = np.array([face for face, n in zip(faces, sizes) if n == size], dtype=np.int64)
+        fan = np.stack([np.zeros(size - 2, dtype=np.int64), np.arange(1, size - 1), np.arange(2, size)], axis=1)
+        triangles.append(polygons[:, fan].reshape(-1))
+    if not triangles:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(triangles).astype(dtype)
+
+def parse_obj(path: str):
+    # Positions and faces only, texture coordinates and OBJ normals are ignored (normals are recomputed)
+    positions = []
+    faces = []
+    with open(path, "r") as file:
+        for line in file:
+            if line.startswith("v "):
+                positions.append(line.split()[1:4])
+            elif line.startswith("f "):
+                # OBJ indices start at 1, negative ones count back from the last vertex read so far (-1 is the last)
+                count = len(positions)
+                face = [int(token.split("/")[0]) for token in line.split()[1:]]
+                faces.append([index - 1 if index > 0 else count + index for index in face])
+    positions = np.array(positions, dtype=np.float32).reshape(-1, 3)
+
+    # Signed until checked, a 0 or a too negative index would otherwise wrap around
+    indices = triangulate(faces, np.int64)
+    if len(indices) and int(indices.min()) < 0:
+        raise ValueError(f"{path} references vertices that don't exist")
+    return positions, indices.astype(np.uint32), None
+
+def read_ply_header(file):
+    header = []
+    while True:
+        line = file.readline()
+        if not line:
+            raise ValueError("PLY header has no end_header")
+        line = line.decode("ascii").strip()
+        header.append(line)
+        if line == "end_header":
+            break
+    if header[0] != "ply":
+        raise ValueError("Not a PLY file")
+
+    format = None
+    elements = []  # [name, count, properties], a property is (name, type) or (name, count type, item type)
+    for line in header[1:]:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == "format":
+            format = words[1]
+        elif words[0] == "element":
+            elements.append([words[1], int(words[2]), []])
+        elif words[0] == "property":
+            if words[1] == "list":
+                elements[-1][2].append((words[4], PLY_TYPES[words[2]], PLY_TYPES[words[3]]))
+            else:
+                elements[-1][2].append((words[2], PLY_TYPES[words[1]]))
+    return format, elements, file.tell()
+
+def parse_ply(path: str):
+    with open(path, "rb") as file:
+        format, elements, offset = read_ply_header(file)
+        if format == "ascii":
+            lines = file.read().decode("ascii").split("\n")
+        else:
+            lines = None
+
+    vertices = None
+    faces = None
+    if lines is not None:
+        row = 0
+        for name, count, properties in elements:
+            block = [line.split() for line in lines[row:row + count]]
+            row += count
+            if name == "vertex":
+                values = np.array(block, dtype=np.float32).reshape(count, len(properties))
+                vertices = {prop[0]: values[:, i] for i, prop in enumerate(properties)}
+            elif name == "face":
+                faces = triangulate([int(value) for value in values[1:1 + int(values[0])]] for values in block)
+    else:
+        # Binary data is memory mapped (copy on write), fixed size elements are read as structured arrays in place
+        data = np.memmap(path, dtype=np.uint8, mode="c", offset=offset)
+        endian = "<" if format == "binary_little_endian" else ">"
+        position = 0
+        for name, count, properties in elements:
+            if all(len(prop) == 2 for prop in properties):
+                dtype = np.dtype([(prop[0], endian + prop[1]) for prop in properties])
+                block = data[position:position + count * dtype.itemsize].view(dtype)
+                position += count * dtype.itemsize
+                if name == "vertex":
+                    vertices = {prop[0]: block[prop[0]] for prop in properties}
+            elif len(properties) == 1:
+                prop_name, count_type, item_type = properties[0]
+                position, polygons = read_ply_lists(data, position, count, endian + count_type, endian + item_type)
+                if name == "face":
+                    faces = polygons
+            else:
+                raise ValueError(f"PLY element '{name}' mixes list and scalar properties, which is not supported")
+
+    if vertices is None or faces is None:
+        raise ValueError(f"{path} needs a vertex and a face element")
+    positions = np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1).astype(np.float32)
+    normals = None
+    if "nx" in vertices:
+        normals = np.stack([vertices["nx"], vertices["ny"], vertices["nz"]], axis=1).astype(np.float32)
+    return positions, faces, normals
+
+def read_ply_lists(data, position: int, count: int, count_type: str, item_type: str):
+    # Triangle only meshes are read in one go, anything else falls back to walking the lists one by one
+    count_size = np.dtype(count_type).itemsize
+    item_size = np.dtype(item_type).itemsize
+    triangles = np.dtype([("n", count_type), ("i", item_type, 3)])
+    end = position + count * triangles.itemsize
+    if end <= len(data):
+        block = data[position:end].view(triangles)
+        if (block["n"] == 3).all():
+            return end, block["i"].reshape(-1).astype(np.uint32)
+
+    polygons = []
+    for _ in range(count):
+        n = int(data[position:position + count_size].view(count_type)[0])
+        position += count_size
+        polygons.append(data[position:position + n * item_size].view(item_type).tolist())
+        position += n * item_size
+    return position, triangulate(polygons)
+
+MESH_PARSERS = {
+    ".obj": parse_obj,
+    ".ply": parse_ply
+}
+
+def load_mesh_data(path: str, cache: Optional[MeshCache] = None):
+    # (vertex_data, indices, bounds_min, bounds_max) ready for Mesh.set_vertex_data, normals are computed when the
+    # file has none. Runs on the worker pool, so everything expensive happens here and not on the GL thread.
+    # With a cache, sources parsed before are mapped from their .mesh file instead
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".mesh":
+        return read_mesh_binary(path)
+    if extension not in MESH_PARSERS:
+        raise ValueError(f"Unsupported mesh format '{extension}', expected one of {sorted(MESH_PARSERS) + ['.mesh']}")
+    if cache is not None:
+        cached = cache.lookup(path)
+        if cached is not None:
+            return cached
+
+    positions, indices, normals = MESH_PARSERS[extension](path)
+    positions = np.asarray(positions, dtype=np.float32)
+    indices = np.asarray(indices, dtype=np.uint32)
+    if len(indices) and int(indices.max()) >= len(positions):
+        raise ValueError(f"{path} references vertices that don't exist")
+    if normals is None:
+        normals = compute_normals(positions, indices)
+    vertex_data = interleave_vertices(positions, normals)
+    if cache is not None:
+        cache.store(path, vertex_data, indices)
+    return vertex_data, indices, None, None
+
+class AssetLoader:
+    # Parses mesh files on a thread pool (or process pool) and fills MeshPlaceholders from the GL thread.
+    # process() has to be called once per frame on the GL thread, it uploads at most upload_budget bytes so
+    # big meshes arrive over several frames instead of stalling one.
+    def __init__(self, workers: int = 4, processes: bool = False, upload_budget: int = 8 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.workers = workers
+        # Parsed files are kept as .mesh files in cache_dir, keyed by the hash of their content
+        self.cache = MeshCache(cache_dir) if cache_dir is not None else None
+        self.processes = processes
+        self.upload_budget = upload_budget
+        self.executor = None
+        # (placeholder, future) pairs finished by the pool, filled from worker callbacks
+        self.finished = queue.Queue()
+        self.streaming = []
+        self.in_flight = 0
+
+    def load(self, path: str, placeholder: Optional[MeshPlaceholder] = None, **placeholder_args) -> MeshPlaceholder:
+        # Returns right away with a placeholder to add with Object.addShape, it becomes visible once loaded
+        if placeholder is None:
+            placeholder = MeshPlaceholder(**placeholder_args)
+        placeholder.source = path
+        if self.executor is None:
+            pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+            self.executor = pool(max_workers=self.workers)
+
+        future = self.executor.submit(load_mesh_data, path, self.cache)
+        self.in_flight += 1
+        future.add_done_callback(lambda future: self.finished.put((placeholder, future)))
+        return placeholder
+
+    def pending(self) -> int:
+        # Files still being parsed or uploaded
+        return self.in_flight + len(self.streaming)
+
+    def process(self, budget: Optional[int] = None) -> int:
+        # GL thread only. Hands finished parses to their placeholders and streams up to budget bytes, returns bytes sent
+        budget = self.upload_budget if budget is None else budget
+        while True:
+            try:
+                placeholder, future = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.in_flight -= 1
+            error = future.exception()
+            if error is not None:
+                placeholder.error = error
+                print(f"[Assets ⚠] Could not load {placeholder.source}: {error}")
+                continue
+            placeholder.set_vertex_data(*future.result())
+            self.streaming.append(placeholder)
+
+        sent = 0
+        while self.streaming and sent < budget:
+            placeholder = self.streaming[0]
+            sent += placeholder.stream(budget - sent)
+            if placeholder.loaded:
+                self.streaming.pop(0)
+        return sent
+
+    def wait(self):
+        # Blocks until every requested file is on the GPU (loading screens, tests)
+        while self.pending():
+            if not self.streaming and self.finished.empty():
+                time.sleep(0.001)
+            self.process()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
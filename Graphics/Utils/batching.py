@@ -0,0 +1,253 @@
+from __future__ import annotations
+from OpenGL.GL import *
+from Graphics.Utils.Shapes import Mesh, MeshPlaceholder
+from Graphics.Utils.dynamic import DynamicMesh
+from Graphics.Utils.shader_utils import Material
+from Graphics.Utils import profiler
+from typing import Dict, List
+import ctypes
+import numpy as np
+
+# Static batching: meshes of subtrees marked with Object.make_static() are transformed to world space once and
+# merged into one VBO/EBO pair per (material, color). Each batch is a single item of the scene BVH and draws
+# all of its visible members with one glMultiDrawElements call (one glDrawElements when none are hidden).
+# Members keep their index range, so one can be hidden or re-transformed without merging everything again.
+
+IDENTITY = np.identity(4, dtype=np.float32)
+
+def transform_vertices(vertex_data: np.ndarray, matrices: np.ndarray, owner: np.ndarray) -> np.ndarray:
+    # Interleaved (N, 6) vertices to world space, vertex i uses the row-major matrix matrices[owner[i]].
+    # Normals go through the inverse transpose so non uniform scales keep them perpendicular
+    matrices = np.asarray(matrices, dtype=np.float32).reshape(-1, 4, 4)
+    rotations = matrices[:, :3, :3]
+    normal_matrices = np.linalg.inv(rotations).transpose(0, 2, 1)
+
+    world = np.empty_like(vertex_data)
+    world[:, 0:3] = np.einsum("vij,vj->vi", rotations[owner], vertex_data[:, 0:3]) + matrices[owner, :3, 3]
+    normals = np.einsum("vij,vj->vi", normal_matrices[owner], vertex_data[:, 3:6])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0.0] = 1.0
+    world[:, 3:6] = normals / lengths
+    return world
+
+class StaticBatch(Mesh):
+    # Vertices are already in world space, the model matrix is the identity
+    __slots__ = ("members", "member_index", "first_vertex", "first_index", "index_counts", "hidden", "runs")
+
+    def __init__(self, root: "Root", material: str, color: tuple):
+        self.members: List[Mesh] = []
+        self.member_index: Dict[int, int] = {}
+        self.first_vertex = np.zeros(0, dtype=np.int64)
+        self.first_index = np.zeros(0, dtype=np.int64)
+        self.index_counts = np.zeros(0, dtype=np.int64)
+        self.hidden = np.zeros(0, dtype=bool)
+        # (counts, byte offsets) of the runs of visible members, None when they have to be recomputed
+        self.runs = None
+        super().__init__(root.root, np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.uint32), np.zeros((0, 3), dtype=np.float32), color=color, material=material)
+
+    def get_model_matrix(self):
+        return IDENTITY
+
+    def add_members(self, meshes: List[Mesh]):
+        for mesh in meshes:
+            self.member_index[id(mesh)] = len(self.members)
+            self.members.append(mesh)
+            mesh.static_batch = self
+        self.hidden = np.concatenate([self.hidden, np.zeros(len(meshes), dtype=bool)])
+        self.append(meshes)
+
+    def remove_member(self, mesh: Mesh):
+        # Cuts the member's ranges out of the buffers, the members after it move down. Nothing is transformed
+        # again, only the indices after the removed range are shifted. Uploaded again on the next prepare()
+        index = self.member_index.pop(id(mesh))
+        vertex_start = int(self.first_vertex[index])
+        vertex_end = int(self.first_vertex[index + 1]) if index + 1 < len(self.members) else self.vertex_count
+        index_start = int(self.first_index[index])
+        index_end = index_start + int(self.index_counts[index])
+        removed_vertices = vertex_end - vertex_start
+
+        vertex_data = np.concatenate([self.vertex_data[:vertex_start], self.vertex_data[vertex_end:]])
+        indices = np.concatenate([self.indices[:index_start], self.indices[index_end:]])
+        indices[index_start:] -= np.uint32(removed_vertices)
+
+        self.members.pop(index)
+        for i in range(index, len(self.members)):
+            self.member_index[id(self.members[i])] = i
+        self.hidden = np.delete(self.hidden, index)
+        self.first_vertex = np.delete(self.first_vertex, index)
+        self.first_vertex[index:] -= removed_vertices
+        self.first_index = np.delete(self.first_index, index)
+        self.first_index[index:] -= index_end - index_start
+        self.index_counts = np.delete(self.index_counts, index)
+        mesh.static_batch = None
+        # Bounds are recomputed from the remaining vertices
+        self.set_vertex_data(vertex_data, indices)
+        self.runs = None
+
+    def transform_members(self, meshes: List[Mesh], first_vertex: int):
+        # World space vertices of meshes and their indices into the batch when placed from first_vertex on.
+        # Returns (vertex_data, indices, vertex_counts, index_counts)
+        vertex_counts = np.fromiter((mesh.vertex_count for mesh in meshes), dtype=np.int64, count=len(meshes))
+        index_counts = np.fromiter((mesh.index_count for mesh in meshes), dtype=np.int64, count=len(meshes))
+        if not meshes:
+            return np.zeros((0, 6), dtype=np.float32), np.zeros(0, dtype=np.uint32), vertex_counts, index_counts
+        owner = np.repeat(np.arange(len(meshes)), vertex_counts)
+        matrices = np.stack([mesh.get_model_matrix() for mesh in meshes])
+        vertex_data = transform_vertices(np.concatenate([mesh.vertex_data for mesh in meshes]), matrices, owner)
+        indices = np.concatenate([mesh.indices for mesh in meshes]).astype(np.int64)
+        indices += np.repeat(first_vertex + np.cumsum(vertex_counts) - vertex_counts, index_counts)
+        return vertex_data, indices.astype(np.uint32), vertex_counts, index_counts
+
+    def merge(self):
+        # Rebuilds the whole buffer from the members' current geometry and world transforms
+        vertex_data, indices, vertex_counts, self.index_counts = self.transform_members(self.members, 0)
+        self.first_vertex = np.cumsum(vertex_counts) - vertex_counts
+        self.first_index = np.cumsum(self.index_counts) - self.index_counts
+        self.set_vertex_data(vertex_data, indices)
+        self.runs = None
+
+    def append(self, meshes: List[Mesh]):
+        # Adds the ranges of new members after the existing ones, only the new meshes are transformed. The
+        # buffer is uploaded again on the next prepare(), so many make_static() calls in a frame cost one upload
+        vertex_data, indices, vertex_counts, index_counts = self.transform_members(meshes, self.vertex_count)
+        self.first_vertex = np.concatenate([self.first_vertex, self.vertex_count + np.cumsum(vertex_counts) - vertex_counts])
+        self.first_index = np.concatenate([self.first_index, self.index_count + np.cumsum(index_counts) - index_counts])
+        self.index_counts = np.concatenate([self.index_counts, index_counts])
+        if not len(vertex_data):
+            bounds = (self.bounds_min, self.bounds_max)
+        elif not self.vertex_count:
+            bounds = (vertex_data[:, 0:3].min(axis=0), vertex_data[:, 0:3].max(axis=0))
+        else:
+            # Existing members keep their exact box, only the new vertices are scanned
+            bounds = (np.minimum(self.bounds_min, vertex_data[:, 0:3].min(axis=0)), np.maximum(self.bounds_max, vertex_data[:, 0:3].max(axis=0)))
+        self.set_vertex_data(np.concatenate([self.vertex_data, vertex_data]), np.concatenate([self.indices, indices]), *bounds)
+        self.runs = None
+
+    def rebuild_member(self, mesh: Mesh):
+        # Re-transforms one member in place, after it moved or its vertices changed. A member whose vertex or
+        # index count changed no longer fits its range and the batch is merged again
+        index = self.member_index[id(mesh)]
+        start = int(self.first_vertex[index])
+        count = mesh.vertex_count
+        end_vertex = start + count
+        if (index + 1 < len(self.members) and end_vertex != self.first_vertex[index + 1]) or \
+                (index + 1 == len(self.members) and end_vertex != self.vertex_count) or mesh.index_count != self.index_counts[index]:
+            self.merge()
+            return
+
+        vertices = transform_vertices(mesh.vertex_data, mesh.get_model_matrix()[None], np.zeros(count, dtype=np.int64))
+        self.vertex_data[start:end_vertex] = vertices
+        first = int(self.first_index[index])
+        self.indices[first:first + mesh.index_count] = mesh.indices + np.uint32(start)
+        self.edit_count += 1
+
+        # Recomputed over the whole batch, a member that moved away must not leave the box enlarged
+        self.bounds_min = self.vertex_data[:, 0:3].min(axis=0)
+        self.bounds_max = self.vertex_data[:, 0:3].max(axis=0)
+        self.notify_moved()
+        if self.vao is None or self.dirty:
+            # Not on the GPU yet, the next prepare() uploads everything
+            self.dirty = True
+            return
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferSubData(GL_ARRAY_BUFFER, start * self.STRIDE, vertices.nbytes, vertices)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindVertexArray(self.vao)
+        glBufferSubData(GL_ELEMENT_ARRAY_BUFFER, first * 4, mesh.index_count * 4, self.indices[first:first + mesh.index_count])
+        glBindVertexArray(0)
+        profiler.count("uploaded_bytes", vertices.nbytes + mesh.index_count * 4)
+
+    def set_hidden(self, mesh: Mesh, hidden: bool):
+        self.hidden[self.member_index[id(mesh)]] = hidden
+        self.runs = None
+
+    def get_runs(self):
+        # Neighbouring visible members are contiguous in the index buffer, each run of them is one draw
+        if self.runs is None:
+            visible = ~self.hidden & (self.index_counts > 0)
+            starts = np.flatnonzero(visible & ~np.concatenate([[False], visible[:-1]]))
+            ends = np.flatnonzero(visible & ~np.concatenate([visible[1:], [False]]))
+            counts = self.first_index[ends] + self.index_counts[ends] - self.first_index[starts]
+            self.runs = (counts.astype(np.int32), (self.first_index[starts] * 4).astype(np.uintp))
+        return self.runs
+
+    def get_triangle_count(self) -> int:
+        return int(self.get_runs()[0].sum()) // 3
+
+    def issue_draw(self, material: Material):
+        counts, offsets = self.get_runs()
+        if not len(counts):
+            return
+        material.set_mat4("model", IDENTITY)
+        material.set_vec3("color", self.color)
+        if len(counts) == 1:
+            glDrawElements(GL_TRIANGLES, int(counts[0]), GL_UNSIGNED_INT, ctypes.c_void_p(int(offsets[0])))
+        else:
+            glMultiDrawElements(GL_TRIANGLES, counts, GL_UNSIGNED_INT, (ctypes.c_void_p * len(offsets))(*offsets.tolist()), len(counts))
+        profiler.count("static_runs", len(counts))
+
+    def draw_member(self, mesh: Mesh):
+        # Draws a single member from the batch buffers (Object.draw path)
+        index = self.member_index[id(mesh)]
+        self.prepare()
+        if self.hidden[index] or self.vao is None or not self.index_counts[index]:
+            return
+        material = self.get_material()
+        material.use()
+        material.set_mat4("model", IDENTITY)
+        material.set_vec3("color", self.color)
+        glBindVertexArray(self.vao)
+        glDrawElements(GL_TRIANGLES, int(self.index_counts[index]), GL_UNSIGNED_INT, ctypes.c_void_p(int(self.first_index[index]) * 4))
+        glBindVertexArray(0)
+
+class StaticBatcher:
+    # Root.static_batches, owns every StaticBatch keyed by (material, color)
+    def __init__(self, root: "Root"):
+        self.root = root
+        self.batches: Dict[tuple, StaticBatch] = {}
+
+    def add(self, obj: "Object"):
+        # Every mesh of obj's subtree leaves the scene BVH and joins the batch of its material and color.
+        # Instanced groups, dynamic meshes and meshes that are still loading keep being drawn on their own
+        groups: Dict[tuple, List[Mesh]] = {}
+        for node in obj.walk():
+            for shape in node.shapes.values():
+                if not isinstance(shape, Mesh) or shape.static_batch is not None:
+                    continue
+                if isinstance(shape, MeshPlaceholder) and not shape.loaded or isinstance(shape, DynamicMesh):
+                    continue
+                groups.setdefault((shape.material, tuple(shape.color)), []).append(shape)
+
+        for key, meshes in groups.items():
+            for mesh in meshes:
+                self.root.scene.remove(mesh)
+            batch = self.batches.get(key)
+            if batch is None:
+                batch = self.batches[key] = StaticBatch(self.root, *key)
+                self.root.scene.add(batch)
+            batch.add_members(meshes)
+
+    def meshes(self, obj: "Object"):
+        for node in obj.walk():
+            for shape in node.shapes.values():
+                if getattr(shape, "static_batch", None) is not None:
+                    yield shape
+
+    def set_hidden(self, obj: "Object", hidden: bool):
+        for mesh in self.meshes(obj):
+            mesh.static_batch.set_hidden(mesh, hidden)
+
+    def rebuild(self, obj: "Object"):
+        for mesh in self.meshes(obj):
+            mesh.static_batch.rebuild_member(mesh)
+
+    def discard(self, mesh: Mesh):
+        # Takes a mesh out of its batch (its node was removed), empty batches are deleted
+        batch = getattr(mesh, "static_batch", None)
+        if batch is None:
+            return
+        batch.remove_member(mesh)
+        if not batch.members:
+            self.root.scene.remove(batch)
+            batch.delete()
+            self.batches = {key: other for key, other in self.batches.items() if other is not batch}
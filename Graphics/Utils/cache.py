@@ -0,0 +1,295 @@
+from __future__ import annotations
+from glm import vec3
+from typing import Optional
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+# Binary files for processed geometry: .mesh (one mesh) and .scene (an Object tree with its meshes).
+# Both are a fixed header followed by 64 byte aligned blocks, and are opened with np.memmap so vertex and index
+# data go to glBufferData straight from the page cache. Vertices are stored interleaved exactly like
+# Mesh.vertex_data (float32 position + normal), indices as uint32.
+
+ALIGNMENT = 64
+
+MESH_MAGIC = b"GLMESH\0\0"
+MESH_VERSION = 2
+mesh_header_dtype = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("vertex_count", "<u4"),
+    ("index_count", "<u4"),
+    ("vertex_offset", "<u4"),
+    ("index_offset", "<u4"),
+    ("bounds_min", "<f4", 3),
+    ("bounds_max", "<f4", 3)
+])
+
+SCENE_MAGIC = b"GLSCENE\0"
+SCENE_VERSION = 1
+scene_header_dtype = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("node_count", "<u4"),
+    ("shape_count", "<u4"),
+    ("mesh_count", "<u4"),
+    # Byte offsets of the blocks below
+    ("nodes", "<u8"),
+    ("shapes", "<u8"),
+    ("meshes", "<u8"),
+    ("names", "<u8"),
+    ("names_size", "<u8"),
+    ("vertices", "<u8"),
+    ("vertex_count", "<u8"),
+    ("indices", "<u8"),
+    ("index_count", "<u8")
+])
+# Nodes are stored depth first, so a parent always comes before its children (parent -1 is the saved root)
+scene_node_dtype = np.dtype([
+    ("parent", "<i4"),
+    ("name", "<u4", 2),  # offset, length in the names block
+    ("position", "<f4", 3),
+    ("angle", "<f4", 3),
+    ("scale", "<f4", 3)
+])
+scene_shape_dtype = np.dtype([
+    ("node", "<u4"),
+    ("mesh", "<u4"),
+    ("name", "<u4", 2),
+    ("material", "<u4", 2),
+    ("position", "<f4", 3),
+    ("rotation", "<f4", 3),
+    ("scale", "<f4", 3),
+    ("color", "<f4", 3)
+])
+scene_mesh_dtype = np.dtype([
+    ("vertex_start", "<u8"),
+    ("vertex_count", "<u4"),
+    ("index_start", "<u8"),
+    ("index_count", "<u4"),
+    ("bounds_min", "<f4", 3),
+    ("bounds_max", "<f4", 3)
+])
+
+def align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def write_blocks(path: str, header: np.ndarray, blocks: list):
+    # Writes the header then every (offset, array) block at its offset, zero padded in between
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(header.tobytes())
+        for offset, array in blocks:
+            file.write(b"\0" * (offset - file.tell()))
+            file.write(np.ascontiguousarray(array).tobytes())
+    # Readers never see a half written file
+    os.replace(temporary, path)
+
+def read_header(path: str, dtype: np.dtype, magic: bytes, version: int) -> np.void:
+    header = np.fromfile(path, dtype=dtype, count=1)
+    # Fixed size byte strings come back without their trailing zeros
+    magic = magic.rstrip(b"\0")
+    if len(header) == 0 or header["magic"][0] != magic:
+        raise ValueError(f"{path} is not a {magic.decode()} file")
+    if header["version"][0] != version:
+        raise ValueError(f"{path} has version {header['version'][0]}, expected {version}")
+    return header[0]
+
+def mapped(path: str, dtype, offset: int, shape):
+    # Copy on write mapping: nothing is read until used and edits never reach the file. Returned read-only like
+    # SHARED_GEOMETRY, meshes loaded together share these arrays and Mesh.update_vertices copies before editing
+    if np.prod(shape) == 0:
+        array = np.zeros(shape, dtype=dtype)
+    else:
+        array = np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+    array.flags.writeable = False
+    return array
+
+def write_mesh_binary(path: str, vertex_data, indices, bounds_min=None, bounds_max=None):
+    vertex_data = np.asarray(vertex_data, dtype="<f4").reshape(-1, 6)
+    indices = np.asarray(indices, dtype="<u4").reshape(-1)
+    header = np.zeros(1, dtype=mesh_header_dtype)
+    header["magic"] = MESH_MAGIC
+    header["version"] = MESH_VERSION
+    header["vertex_count"] = len(vertex_data)
+    header["index_count"] = len(indices)
+    header["vertex_offset"] = align(mesh_header_dtype.itemsize)
+    header["index_offset"] = align(int(header["vertex_offset"][0]) + vertex_data.nbytes)
+    if len(vertex_data):
+        header["bounds_min"] = vertex_data[:, 0:3].min(axis=0) if bounds_min is None else bounds_min
+        header["bounds_max"] = vertex_data[:, 0:3].max(axis=0) if bounds_max is None else bounds_max
+    write_blocks(path, header, [(int(header["vertex_offset"][0]), vertex_data), (int(header["index_offset"][0]), indices)])
+
+def read_mesh_binary(path: str):
+    # (vertex_data, indices, bounds_min, bounds_max), the arrays are memory mapped views of the file
+    header = read_header(path, mesh_header_dtype, MESH_MAGIC, MESH_VERSION)
+    vertex_data = mapped(path, np.float32, int(header["vertex_offset"]), (int(header["vertex_count"]), 6))
+    indices = mapped(path, np.uint32, int(header["index_offset"]), (int(header["index_count"]),))
+    return vertex_data, indices, np.array(header["bounds_min"]), np.array(header["bounds_max"])
+
+# Processed meshes keyed by the hash of their source file. Hashing is skipped while the source's size and
+# modification time match the index, so a warm start costs a stat() and a mmap per mesh
+CACHE_VERSION = 1
+index_lock = threading.Lock()
+
+class MeshCache:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+
+    def read_index(self) -> dict:
+        try:
+            with open(self.index_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_index(self, index: dict):
+        with open(self.index_path + ".tmp", "w") as file:
+            json.dump(index, file)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def key(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with index_lock:
+            entry = self.read_index().get(path)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+
+        digest = hashlib.blake2b(digest_size=16)
+        # The loader that produced the file is part of the key, a new format version invalidates old entries
+        digest.update(f"{CACHE_VERSION}:{MESH_VERSION}:{os.path.splitext(path)[1].lower()}".encode())
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        key = digest.hexdigest()
+
+        with index_lock:
+            index = self.read_index()
+            index[path] = [stat.st_size, stat.st_mtime_ns, key]
+            self.write_index(index)
+        return key
+
+    def cache_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".mesh")
+
+    def lookup(self, path: str) -> Optional[tuple]:
+        # Cached (vertex_data, indices, bounds_min, bounds_max) of the source file, None when it has to be parsed
+        cached = self.cache_path(self.key(path))
+        if not os.path.exists(cached):
+            return None
+        try:
+            return read_mesh_binary(cached)
+        except ValueError:
+            return None
+
+    def store(self, path: str, vertex_data, indices):
+        write_mesh_binary(self.cache_path(self.key(path)), vertex_data, indices)
+
+def write_scene(path: str, obj: "Object"):
+    # Saves obj, its descendants and their meshes. Identical geometry is stored once.
+    # Instanced groups are not stored
+    from Graphics.Utils.Shapes import Mesh
+    from Graphics.Engine import InstancedGroup
+
+    nodes = []
+    shapes = []
+    meshes = []
+    mesh_index = {}
+    vertex_blocks = []
+    index_blocks = []
+    names = bytearray()
+    vertex_total = 0
+    index_total = 0
+
+    def add_name(name: str):
+        encoded = str(name).encode("utf-8")
+        names.extend(encoded)
+        return (len(names) - len(encoded), len(encoded))
+
+    def visit(node, parent: int):
+        nonlocal vertex_total, index_total
+        if isinstance(node, InstancedGroup):
+            print(f"[Scene ⚠] Instanced group '{node.name}' is not saved")
+            return
+        row = len(nodes)
+        nodes.append((parent, add_name(node.name), tuple(node.position), tuple(node.angle), tuple(node.scale)))
+        for name, shape in node.shapes.items():
+            if not isinstance(shape, Mesh):
+                continue
+            vertex_data = np.ascontiguousarray(shape.vertex_data, dtype=np.float32)
+            indices = np.ascontiguousarray(shape.indices, dtype=np.uint32)
+            digest = hashlib.blake2b(vertex_data.tobytes(), digest_size=16)
+            digest.update(indices.tobytes())
+            key = digest.digest()
+            if key not in mesh_index:
+                mesh_index[key] = len(meshes)
+                meshes.append((vertex_total, len(vertex_data), index_total, len(indices), shape.bounds_min, shape.bounds_max))
+                vertex_blocks.append(vertex_data)
+                index_blocks.append(indices)
+                vertex_total += len(vertex_data)
+                index_total += len(indices)
+            shapes.append((row, mesh_index[key], add_name(name), add_name(shape.material), tuple(shape.position), tuple(shape.rotation), tuple(shape.scale), tuple(shape.color)))
+        for child in node.children.values():
+            visit(child, row)
+
+    visit(obj, -1)
+
+    node_array = np.array(nodes, dtype=scene_node_dtype)
+    shape_array = np.array(shapes, dtype=scene_shape_dtype)
+    mesh_array = np.array(meshes, dtype=scene_mesh_dtype)
+    vertices = np.concatenate(vertex_blocks) if vertex_blocks else np.zeros((0, 6), dtype=np.float32)
+    indices = np.concatenate(index_blocks) if index_blocks else np.zeros(0, dtype=np.uint32)
+    names = np.frombuffer(bytes(names), dtype=np.uint8)
+
+    header = np.zeros(1, dtype=scene_header_dtype)
+    header["magic"] = SCENE_MAGIC
+    header["version"] = SCENE_VERSION
+    header["node_count"] = len(node_array)
+    header["shape_count"] = len(shape_array)
+    header["mesh_count"] = len(mesh_array)
+    blocks = []
+    offset = scene_header_dtype.itemsize
+    for field, array in (("nodes", node_array), ("shapes", shape_array), ("meshes", mesh_array), ("names", names), ("vertices", vertices), ("indices", indices)):
+        offset = align(offset)
+        header[field] = offset
+        blocks.append((offset, array))
+        offset += array.nbytes
+    header["names_size"] = len(names)
+    header["vertex_count"] = len(vertices)
+    header["index_count"] = len(indices)
+    write_blocks(path, header, blocks)
+
+def read_scene(path: str, parent: "Object") -> "Object":
+    # Rebuilds a saved tree under parent and returns its top node. Meshes use the mapped file as their
+    # vertex / index data, shapes that shared geometry when saved share the same memory again
+    from Graphics.Utils.Shapes import Mesh
+
+    header = read_header(path, scene_header_dtype, SCENE_MAGIC, SCENE_VERSION)
+    nodes = mapped(path, scene_node_dtype, int(header["nodes"]), (int(header["node_count"]),))
+    shapes = mapped(path, scene_shape_dtype, int(header["shapes"]), (int(header["shape_count"]),))
+    meshes = mapped(path, scene_mesh_dtype, int(header["meshes"]), (int(header["mesh_count"]),))
+    names = bytes(mapped(path, np.uint8, int(header["names"]), (int(header["names_size"]),)))
+    vertices = mapped(path, np.float32, int(header["vertices"]), (int(header["vertex_count"]), 6))
+    indices = mapped(path, np.uint32, int(header["indices"]), (int(header["index_count"]),))
+
+    def name(span) -> str:
+        return names[span[0]:span[0] + span[1]].decode("utf-8")
+
+    objects = []
+    for parent_row, name_span, position, angle, scale in nodes.tolist():
+        owner = parent if parent_row < 0 else objects[parent_row]
+        objects.append(owner.addChild(name(name_span), vec3(position), vec3(angle), vec3(scale)))
+
+    mesh_rows = meshes.tolist()
+    for node, mesh, name_span, material_span, position, rotation, scale, color in shapes.tolist():
+        vertex_start, vertex_count, index_start, index_count, bounds_min, bounds_max = mesh_rows[mesh]
+        shape = Mesh(None, None, indices[index_start:index_start + index_count], position=vec3(position), rotation=vec3(rotation),
+                     scale=vec3(scale), color=tuple(color), material=name(material_span),
+                     vertex_data=vertices[vertex_start:vertex_start + vertex_count], bounds=(bounds_min, bounds_max))
+        objects[node].addShape(name(name_span), shape)
+    return objects[0] if objects else None
@@ -0,0 +1,300 @@
+import numpy as np
+
+# Frustum culling helpers and the scene BVH. Nothing in here touches OpenGL so it can run without a context.
+
+EMPTY_MIN = np.float32(np.inf)
+EMPTY_MAX = np.float32(-np.inf)
+
+def frustum_planes(view_projection) -> np.ndarray:
+    # Gribb/Hartmann plane extraction from a row-major projection * view matrix.
+    # Returns (6, 4) planes (a, b, c, d) with normals pointing inside: left, right, bottom, top, near, far
+    m = np.asarray(view_projection, dtype=np.float32).reshape(4, 4)
+    planes = np.stack([
+        m[3] + m[0],
+        m[3] - m[0],
+        m[3] + m[1],
+        m[3] - m[1],
+        m[3] + m[2],
+        m[3] - m[2]
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+def transform_aabb(matrices, mins, maxs):
+    # World space AABBs of local boxes under (N, 4, 4) or (4, 4) row-major matrices, using center/extent
+    matrices = np.asarray(matrices, dtype=np.float32)
+    mins = np.asarray(mins, dtype=np.float32)
+    maxs = np.asarray(maxs, dtype=np.float32)
+    center = (mins + maxs) * 0.5
+    extent = (maxs - mins) * 0.5
+
+    rotation = matrices[..., :3, :3]
+    world_center = np.einsum("...ij,...j->...i", rotation, center) + matrices[..., :3, 3]
+    world_extent = np.einsum("...ij,...j->...i", np.abs(rotation), extent)
+    return world_center - world_extent, world_center + world_extent
+
+def classify_aabbs(planes, mins, maxs):
+    # Returns (outside, inside) boolean masks, boxes in neither intersect the frustum boundary
+    normals = planes[:, :3]
+    positive = normals >= 0.0
+
+    # Corner furthest along each plane normal (p-vertex) and the one furthest against it (n-vertex)
+    p_vertex = np.where(positive, maxs[:, None, :], mins[:, None, :])
+    n_vertex = np.where(positive, mins[:, None, :], maxs[:, None, :])
+    p_distance = np.einsum("npk,pk->np", p_vertex, normals) + planes[:, 3]
+    n_distance = np.einsum("npk,pk->np", n_vertex, normals) + planes[:, 3]
+
+    outside = (p_distance < 0.0).any(axis=1)
+    inside = (n_distance >= 0.0).all(axis=1)
+    return outside, inside
+
+def morton_codes(points, bits: int = 10) -> np.ndarray:
+    # 30 bit Morton codes of points normalised to their bounding box, used to order BVH leaves
+    lo = points.min(axis=0)
+    size = points.max(axis=0) - lo
+    size[size == 0.0] = 1.0
+    cells = ((points - lo) / size * ((1 << bits) - 1)).astype(np.uint32)
+
+    codes = np.zeros(len(points), dtype=np.uint32)
+    for bit in range(bits):
+        for axis in range(3):
+            codes |= ((cells[:, axis] >> bit) & 1) << (3 * bit + (2 - axis))
+    return codes
+
+class SceneBVH:
+    # Bounding volume hierarchy over every drawable of the scene (meshes and instanced groups).
+    # Items only need get_world_bounds() -> (min, max). Leaves are sorted along a Morton curve and
+    # paired up level by level, so building, refitting and querying are all vectorized over a level.
+    # It also keeps each item's level of detail state (see select_lods) and occlusion state (see occlusion.py)
+    LEAF_SIZE = 4
+    MAX_LODS = 4
+
+    def __init__(self):
+        self.items = []
+        self.item_index = {}
+        self.moved = set()
+        self.structure_dirty = True
+
+        self.item_mins = np.zeros((0, 3), dtype=np.float32)
+        self.item_maxs = np.zeros((0, 3), dtype=np.float32)
+        self.order = np.zeros(0, dtype=np.int64)  # sorted slot -> item
+        self.slot_of = np.zeros(0, dtype=np.int64)  # item -> sorted slot
+        # levels[0] are the leaf nodes, levels[-1] holds the single root node
+        self.levels = []
+
+        # Per item LOD switch sizes (padded with -inf) and current level, rows follow self.items
+        self.lod_thresholds = np.full((0, self.MAX_LODS), -np.inf, dtype=np.float32)
+        self.lod_levels = np.zeros(0, dtype=np.int8)
+        # Per item result of the last occlusion query and the last frame the item passed frustum culling
+        self.occluded = np.zeros(0, dtype=bool)
+        self.last_seen = np.zeros(0, dtype=np.int64)
+
+        # Results and statistics of the last cull() call
+        self.visible_indices = np.zeros(0, dtype=np.int64)
+        self.tested_nodes = 0
+        self.visible_count = 0
+
+    def add(self, item):
+        if id(item) in self.item_index:
+            return
+        index = len(self.items)
+        self.item_index[id(item)] = index
+        self.items.append(item)
+        self.structure_dirty = True
+
+        self.reserve(index + 1)
+        self.lod_levels[index] = 0
+        self.occluded[index] = False
+        self.last_seen[index] = -1
+        self.set_lod_thresholds(item, getattr(item, "lod_thresholds", []))
+
+    def add_many(self, items: list):
+        # add() for a list of new items, the per item state is reset with slices
+        start = len(self.items)
+        items = [item for item in items if id(item) not in self.item_index]
+        self.item_index.update(zip(map(id, items), range(start, start + len(items))))
+        self.items.extend(items)
+        self.structure_dirty = True
+
+        end = len(self.items)
+        self.reserve(end)
+        self.lod_thresholds[start:end] = -np.inf
+        self.lod_levels[start:end] = 0
+        self.occluded[start:end] = False
+        self.last_seen[start:end] = -1
+        for item in items:
+            thresholds = getattr(item, "lod_thresholds", ())
+            if len(thresholds):
+                self.set_lod_thresholds(item, thresholds)
+
+    def reserve(self, count: int):
+        index = len(self.lod_levels)
+        if count <= index:
+            return
+        # Grow geometrically, adding items one by one stays linear
+        capacity = 2 * index if index > 32 else 64
+        capacity = capacity if capacity > count else count
+        thresholds = np.full((capacity, self.MAX_LODS), -np.inf, dtype=np.float32)
+        thresholds[:index] = self.lod_thresholds[:index]
+        levels = np.zeros(capacity, dtype=np.int8)
+        levels[:index] = self.lod_levels[:index]
+        self.lod_thresholds, self.lod_levels = thresholds, levels
+        occluded = np.zeros(capacity, dtype=bool)
+        occluded[:index] = self.occluded[:index]
+        last_seen = np.full(capacity, -1, dtype=np.int64)
+        last_seen[:index] = self.last_seen[:index]
+        self.occluded, self.last_seen = occluded, last_seen
+
+    def remove(self, item):
+        index = self.item_index.pop(id(item), None)
+        if index is None:
+            return
+        # Swap-remove, the last item takes over the freed slot
+        last = self.items.pop()
+        if last is not item:
+            self.items[index] = last
+            self.item_index[id(last)] = index
+            self.lod_thresholds[index] = self.lod_thresholds[len(self.items)]
+            self.lod_levels[index] = self.lod_levels[len(self.items)]
+            self.occluded[index] = self.occluded[len(self.items)]
+            self.last_seen[index] = self.last_seen[len(self.items)]
+        self.moved.discard(item)
+        self.structure_dirty = True
+
+    def set_lod_thresholds(self, item, thresholds):
+        index = self.item_index.get(id(item))
+        if index is None:
+            return
+        if len(thresholds) > self.MAX_LODS:
+            raise ValueError(f"At most {self.MAX_LODS} LOD levels are supported, got {len(thresholds)}")
+        self.lod_thresholds[index] = -np.inf
+        self.lod_thresholds[index, :len(thresholds)] = thresholds
+        self.lod_levels[index] = 0
+
+    def select_lods(self, indices, sizes, hysteresis: float = 0.1) -> np.ndarray:
+        # Picks the level of each given item from its projected size: level k is used below thresholds[k - 1].
+        # A level only changes once the size is hysteresis (relative) past the threshold, so objects sitting
+        # right at a switch distance don't pop back and forth. Returns (indices, levels) of the items that changed
+        thresholds = self.lod_thresholds[indices]
+        current = self.lod_levels[indices]
+        sizes = sizes[:, None]
+        coarser = (sizes < thresholds * (1.0 - hysteresis)).sum(axis=1)
+        finer = (sizes < thresholds * (1.0 + hysteresis)).sum(axis=1)
+        levels = np.where(coarser > current, coarser, np.where(finer < current, finer, current)).astype(np.int8)
+
+        changed = levels != current
+        self.lod_levels[indices] = levels
+        return indices[changed], levels[changed]
+
+    def mark_moved(self, item):
+        self.moved.add(item)
+
+    def gather_bounds(self, items):
+        mins = np.empty((len(items), 3), dtype=np.float32)
+        maxs = np.empty((len(items), 3), dtype=np.float32)
+        for i, item in enumerate(items):
+            mins[i], maxs[i] = item.get_world_bounds()
+        return mins, maxs
+
+    def build(self):
+        self.item_mins, self.item_maxs = self.gather_bounds(self.items)
+        self.moved.clear()
+        self.structure_dirty = False
+        self.levels = []
+
+        count = len(self.items)
+        if count == 0:
+            self.order = self.slot_of = np.zeros(0, dtype=np.int64)
+            return
+
+        self.order = np.argsort(morton_codes((self.item_mins + self.item_maxs) * 0.5), kind="stable")
+        self.slot_of = np.empty(count, dtype=np.int64)
+        self.slot_of[self.order] = np.arange(count)
+
+        mins, maxs = self.leaf_bounds(np.arange(self.leaf_count()))
+        self.levels.append([mins, maxs])
+        while len(mins) > 1:
+            mins, maxs = self.pair_up(mins), self.pair_up(maxs, False)
+            self.levels.append([mins, maxs])
+
+    def leaf_count(self) -> int:
+        return (len(self.items) + self.LEAF_SIZE - 1) // self.LEAF_SIZE
+
+    def leaf_bounds(self, leaves):
+        # Union of the item boxes stored in each of the given leaf nodes
+        slots = leaves[:, None] * self.LEAF_SIZE + np.arange(self.LEAF_SIZE)
+        valid = slots < len(self.items)
+        items = self.order[np.where(valid, slots, 0)]
+        mins = np.where(valid[..., None], self.item_mins[items], EMPTY_MIN).min(axis=1)
+        maxs = np.where(valid[..., None], self.item_maxs[items], EMPTY_MAX).max(axis=1)
+        return mins, maxs
+
+    @staticmethod
+    def pair_up(bounds, is_min: bool = True):
+        if len(bounds) % 2:
+            bounds = np.concatenate([bounds, np.full((1, 3), EMPTY_MIN if is_min else EMPTY_MAX, dtype=np.float32)])
+        pairs = bounds.reshape(-1, 2, 3)
+        return pairs.min(axis=1) if is_min else pairs.max(axis=1)
+
+    def refit(self, items):
+        # Recompute the boxes of the moved items and of every node above them, one level at a time
+        indices = np.fromiter((self.item_index[id(item)] for item in items), dtype=np.int64, count=len(items))
+        self.item_mins[indices], self.item_maxs[indices] = self.gather_bounds(items)
+
+        nodes = np.unique(self.slot_of[indices] // self.LEAF_SIZE)
+        self.levels[0][0][nodes], self.levels[0][1][nodes] = self.leaf_bounds(nodes)
+        for level in range(1, len(self.levels)):
+            nodes = np.unique(nodes // 2)
+            child_mins, child_maxs = self.levels[level - 1]
+            left = nodes * 2
+            right = np.minimum(left + 1, len(child_mins) - 1)
+            self.levels[level][0][nodes] = np.minimum(child_mins[left], child_mins[right])
+            self.levels[level][1][nodes] = np.maximum(child_maxs[left], child_maxs[right])
+
+    def update(self):
+        if self.structure_dirty:
+            self.build()
+            return
+        moved = [item for item in self.moved if id(item) in self.item_index]
+        self.moved.clear()
+        if moved:
+            self.refit(moved)
+
+    def cull(self, planes) -> list:
+        # Items whose box touches the frustum. Nodes fully inside accept their whole subtree without further tests.
+        # planes = None returns every item (culling disabled)
+        self.update()
+        self.tested_nodes = 0
+        if not self.items or planes is None:
+            self.visible_indices = np.arange(len(self.items))
+            self.visible_count = len(self.items)
+            return list(self.items)
+
+        accepted = []  # (first slot, last slot) ranges of the sorted item order
+        frontier = np.zeros(1, dtype=np.int64)
+        for level in range(len(self.levels) - 1, -1, -1):
+            mins, maxs = self.levels[level]
+            outside, inside = classify_aabbs(planes, mins[frontier], maxs[frontier])
+            self.tested_nodes += len(frontier)
+
+            span = self.LEAF_SIZE << level
+            for node in frontier[inside]:
+                accepted.append((node * span, node * span + span))
+
+            frontier = frontier[~outside & ~inside]
+            if level > 0:
+                frontier = np.concatenate([frontier * 2, frontier * 2 + 1])
+                frontier = frontier[frontier < len(self.levels[level - 1][0])]
+
+        # Leaves that straddle a plane are resolved per item
+        slots = (frontier[:, None] * self.LEAF_SIZE + np.arange(self.LEAF_SIZE)).reshape(-1)
+        slots = slots[slots < len(self.items)]
+        items = self.order[slots]
+        outside, _ = classify_aabbs(planes, self.item_mins[items], self.item_maxs[items])
+        visible = [items[~outside]]
+        for start, end in accepted:
+            visible.append(self.order[start:end])
+
+        visible = np.concatenate(visible)
+        self.visible_indices = visible
+        self.visible_count = len(visible)
+        return [self.items[i] for i in visible]
@@ -0,0 +1,162 @@
+from __future__ import annotations
+from OpenGL.GL import *
+from Graphics.Utils.Shapes import Mesh, vertex_runs
+from Graphics.Utils.shader_utils import Material
+from Graphics.Utils import profiler
+from glm import vec3
+import ctypes
+import numpy as np
+
+# Geometry that is edited every frame (cloth, terrain, soft bodies). The vertex buffer holds REGIONS copies of
+# the vertex data; each frame with edits writes only the dirty vertex runs into the next copy and draws from
+# it with a base vertex, while the GPU may still be reading the previous ones. A fence set when a copy stops
+# being drawn tells when it can be written again, so uploads never stall on the GPU.
+
+REGIONS = 3
+# Upper bound for waiting on a region still in use, in ns
+WAIT_TIMEOUT = 100_000_000
+
+_buffer_storage = None
+
+def supports_buffer_storage() -> bool:
+    # glBufferStorage (GL 4.4 / ARB_buffer_storage) allows persistently mapped buffers, needs a current context
+    global _buffer_storage
+    if _buffer_storage is None:
+        version = glGetIntegerv(GL_MAJOR_VERSION) * 10 + glGetIntegerv(GL_MINOR_VERSION)
+        _buffer_storage = bool(glBufferStorage) and version >= 44
+    return _buffer_storage
+
+class RingBuffer:
+    # regions copies of size bytes in one GL buffer. With buffer storage it is mapped once (persistent and
+    # coherent) and written through a NumPy view, otherwise regions are written with glBufferSubData
+    def __init__(self, size: int, regions: int = REGIONS):
+        self.size = size
+        self.regions = regions
+        self.current = 0
+        # Fence of every region that is waiting for the GPU, None once it is free
+        self.fences = [None] * regions
+        self.mapped = None
+
+        total = size * regions if size else 1
+        self.buffer = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        if supports_buffer_storage():
+            flags = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+            glBufferStorage(GL_ARRAY_BUFFER, total, None, flags)
+            pointer = glMapBufferRange(GL_ARRAY_BUFFER, 0, total, flags)
+            self.mapped = np.ctypeslib.as_array((ctypes.c_ubyte * total).from_address(pointer))
+        else:
+            glBufferData(GL_ARRAY_BUFFER, total, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def advance(self) -> int:
+        # Fences the region drawn until now and makes the next one current, waiting if the GPU still reads it
+        self.fences[self.current] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.current = (self.current + 1) % self.regions
+        fence = self.fences[self.current]
+        if fence is not None:
+            if glClientWaitSync(fence, 0, 0) not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                profiler.count("ring_waits", 1)
+                glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, WAIT_TIMEOUT)
+            glDeleteSync(fence)
+            self.fences[self.current] = None
+        return self.current
+
+    def write(self, region: int, offset: int, data: np.ndarray):
+        # offset is in bytes from the start of the region, data has to be contiguous
+        data = data.reshape(-1).view(np.uint8)
+        start = region * self.size + offset
+        if self.mapped is not None:
+            self.mapped[start:start + len(data)] = data
+        else:
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+            glBufferSubData(GL_ARRAY_BUFFER, start, len(data), data)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+        profiler.count("uploaded_bytes", len(data))
+
+    def delete(self):
+        for fence in self.fences:
+            if fence is not None:
+                glDeleteSync(fence)
+        self.fences = [None] * self.regions
+        if self.mapped is not None:
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+            glUnmapBuffer(GL_ARRAY_BUFFER)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            self.mapped = None
+        glDeleteBuffers(1, [self.buffer])
+
+class DynamicMesh(Mesh):
+    # Mesh for geometry edited every frame through update_vertices / touch_vertices (Mesh), streamed through a
+    # RingBuffer. Static batching leaves it alone, it is always drawn on its own
+    __slots__ = ("ring", "stale")
+
+    def __init__(self, object: "Object", positions, indices, normals=None, position: vec3 = vec3(0, 0, 0), rotation: vec3 = vec3(0, 0, 0), scale: vec3 = vec3(1, 1, 1), color: tuple = (1.0, 1.0, 1.0), material: str = "default"):
+        self.ring = None
+        # Vertices every region is missing, per region
+        self.stale = None
+        super().__init__(object, positions, indices, normals, position, rotation, scale, color, material)
+
+    def upload(self):
+        if self.ring is not None and self.ring.size == self.vertex_data.nbytes and self.uploaded_indices == self.index_count:
+            # Same layout (set_vertex_data with new values), streamed like an edit of every vertex
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.ebo)
+            glBufferSubData(GL_COPY_WRITE_BUFFER, 0, self.indices.nbytes, self.indices)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+            self.dirty = False
+            self.dirty_vertices = np.ones(self.vertex_count, dtype=bool)
+            self.upload_ranges()
+            return
+
+        if self.ring is not None:
+            self.ring.delete()
+        self.ring = RingBuffer(self.vertex_data.nbytes)
+        self.vbo = self.ring.buffer
+        for region in range(self.ring.regions):
+            self.ring.write(region, 0, self.vertex_data)
+        self.stale = np.zeros((self.ring.regions, self.vertex_count), dtype=bool)
+
+        if self.vao is None:
+            self.vao = glGenVertexArrays(1)
+            self.ebo = glGenBuffers(1)
+        glBindVertexArray(self.vao)
+        self.bind_attributes()
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices.nbytes, self.indices, GL_STATIC_DRAW)
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        self.uploaded_vertices = self.vertex_count
+        self.uploaded_indices = self.index_count
+        self.dirty = False
+        self.dirty_vertices = None
+        profiler.count("uploaded_bytes", self.indices.nbytes)
+
+    def upload_ranges(self):
+        # Every region now misses the new edits, the next one gets its missing runs and becomes the drawn one
+        self.stale |= self.dirty_vertices
+        self.dirty_vertices = None
+        region = self.ring.advance()
+        starts, ends = vertex_runs(self.stale[region], self.MERGE_GAP)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.ring.write(region, start * self.STRIDE, self.vertex_data[start:end])
+        self.stale[region] = False
+
+    def get_base_vertex(self) -> int:
+        return 0 if self.ring is None else self.ring.current * self.vertex_count
+
+    def issue_draw(self, material: Material):
+        geometry = self.get_geometry()
+        material.set_mat4("model", self.get_model_matrix())
+        material.set_vec3("color", self.color)
+        glDrawElementsBaseVertex(GL_TRIANGLES, geometry.index_count, GL_UNSIGNED_INT, None, geometry.get_base_vertex())
+
+    def delete(self):
+        if self.ring is not None:
+            self.ring.delete()
+            self.ring = None
+        if self.vao is not None:
+            glDeleteBuffers(1, [self.ebo])
+            glDeleteVertexArrays(1, [self.vao])
+            self.vao = self.vbo = self.ebo = None
+            self.uploaded_vertices = self.uploaded_indices = 0
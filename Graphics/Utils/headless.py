@@ -0,0 +1,16 @@
+import os
+
+# PyOpenGL picks its platform when OpenGL is first imported, so headless runs have to select EGL or OSMesa
+# before anything imports OpenGL.GL. This module must not import OpenGL itself.
+
+HEADLESS_PLATFORMS = ("egl", "osmesa")
+
+def select_platform(platform: str = "egl"):
+    # Call before importing Graphics.Engine (or anything importing OpenGL) to run headless
+    os.environ.setdefault("PYOPENGL_PLATFORM", platform)
+    if platform == "egl":
+        # Mesa's surfaceless platform works without X/Wayland, llvmpipe renders on the CPU
+        os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+def current_platform() -> str:
+    return os.environ.get("PYOPENGL_PLATFORM", "")
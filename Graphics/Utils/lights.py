@@ -0,0 +1,126 @@
+from OpenGL.GL import *
+from Graphics.Utils.shader_utils import TextureBuffer, UniformBuffer, TEXTURE_BUFFERS, light_dtype
+from typing import Tuple
+import numpy as np
+
+# Clustered forward lighting. The view frustum is cut into a grid of clusters (screen tiles times exponentially
+# spaced depth slices), every light is assigned to the clusters its radius reaches and the fragment shader only
+# visits the lights of its own cluster. Light data, per cluster ranges and the light lists are texture buffers.
+
+DEFAULT_GRID = (16, 9, 24)  # tiles across, tiles down, depth slices
+
+def cluster_lights(centers, radii, tan_half_fov: float, aspect: float, near: float, far: float, grid: Tuple[int, int, int] = DEFAULT_GRID):
+    # centers are view space light positions (camera looking down -z). Returns (ranges, indices): ranges is
+    # (clusters, 2) uint32 (first, count) into indices, which lists light numbers grouped by cluster.
+    # Cluster numbering is x + tiles_x * (y + tiles_y * slice), as in find_cluster of default_fragment_shader.
+    # Pure NumPy, no GL needed
+    tiles_x, tiles_y, slices = grid
+    clusters = tiles_x * tiles_y * slices
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    radii = np.asarray(radii, dtype=np.float64).reshape(-1)
+
+    # Depth range of every light's sphere
+    depth = -centers[:, 2]
+    nearest = np.maximum(depth - radii, near)
+    farthest = np.minimum(depth + radii, far)
+
+    # Conservative NDC box of the sphere's bounding box: the extreme x / depth ratios come from the nearest
+    # depth on the side facing away from the axis and from the farthest depth on the other side
+    def ndc_range(low, high, scale):
+        lo = np.where(low < 0.0, low / nearest, low / farthest) / scale
+        hi = np.where(high > 0.0, high / nearest, high / farthest) / scale
+        return lo, hi
+    x_lo, x_hi = ndc_range(centers[:, 0] - radii, centers[:, 0] + radii, tan_half_fov * aspect)
+    y_lo, y_hi = ndc_range(centers[:, 1] - radii, centers[:, 1] + radii, tan_half_fov)
+
+    visible = (farthest >= nearest) & (x_hi >= -1.0) & (x_lo <= 1.0) & (y_hi >= -1.0) & (y_lo <= 1.0)
+    lights = np.flatnonzero(visible)
+
+    def tiles(lo, hi, count):
+        first = np.clip(np.floor((lo + 1.0) * 0.5 * count), 0, count - 1).astype(np.int64)
+        last = np.clip(np.floor((hi + 1.0) * 0.5 * count), 0, count - 1).astype(np.int64)
+        return first, last
+    x0, x1 = tiles(x_lo[lights], x_hi[lights], tiles_x)
+    y0, y1 = tiles(y_lo[lights], y_hi[lights], tiles_y)
+    scale, bias = depth_slicing(near, far, slices)
+    z0 = np.clip(np.floor(np.log(nearest[lights]) * scale - bias), 0, slices - 1).astype(np.int64)
+    z1 = np.clip(np.floor(np.log(farthest[lights]) * scale - bias), 0, slices - 1).astype(np.int64)
+
+    # Expand every light's box of clusters into (cluster, light) pairs in one go
+    span_x = x1 - x0 + 1
+    span_y = y1 - y0 + 1
+    counts = span_x * span_y * (z1 - z0 + 1)
+    owner = np.repeat(np.arange(len(lights)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = x0[owner] + local % span_x[owner]
+    y = y0[owner] + (local // span_x[owner]) % span_y[owner]
+    z = z0[owner] + local // (span_x[owner] * span_y[owner])
+    cluster = x + tiles_x * (y + tiles_y * z)
+
+    order = np.argsort(cluster, kind="stable")
+    indices = lights[owner[order]].astype(np.uint32)
+    per_cluster = np.bincount(cluster, minlength=clusters)
+    ranges = np.empty((clusters, 2), dtype=np.uint32)
+    ranges[:, 0] = np.cumsum(per_cluster) - per_cluster
+    ranges[:, 1] = per_cluster
+    return ranges, indices
+
+def depth_slicing(near: float, far: float, slices: int):
+    # slice = log(depth) * scale - bias puts near at slice 0 and far at slice `slices`
+    scale = slices / np.log(far / near)
+    return scale, np.log(near) * scale
+
+class LightManager:
+    # Owns the light data of every PointLight in one structured array (light_dtype rows, also the layout of the
+    # lightData texture buffer). Lights read and write their row directly, removal swaps the last light in
+    def __init__(self, capacity: int = 64, grid: Tuple[int, int, int] = DEFAULT_GRID):
+        self.data = np.zeros(capacity, dtype=light_dtype)
+        self.lights = []
+        self.grid = grid
+        self.light_buffer = TextureBuffer(GL_RGBA32F, TEXTURE_BUFFERS["lightData"])
+        self.range_buffer = TextureBuffer(GL_RG32UI, TEXTURE_BUFFERS["clusterRanges"])
+        self.index_buffer = TextureBuffer(GL_R32UI, TEXTURE_BUFFERS["clusterLights"])
+        # Filled by the last update(), kept for stats and debugging
+        self.ranges = np.zeros((0, 2), dtype=np.uint32)
+        self.indices = np.zeros(0, dtype=np.uint32)
+
+    def add(self, light):
+        if len(self.lights) == len(self.data):
+            data = np.zeros(len(self.data) * 2, dtype=light_dtype)
+            data[:len(self.data)] = self.data
+            self.data = data
+            for slot, other in enumerate(self.lights):
+                other.attach(self, slot)
+        self.lights.append(light)
+        light.attach(self, len(self.lights) - 1)
+
+    def remove(self, light):
+        slot = light.slot
+        last = self.lights.pop()
+        light.detach()
+        if last is not light:
+            self.data[slot] = self.data[len(self.lights)]
+            self.lights[slot] = last
+            last.attach(self, slot, copy=False)
+
+    def update(self, view: np.ndarray, tan_half_fov: float, aspect: float, near: float, far: float, viewport, lights_buffer: UniformBuffer):
+        # view is the row-major view matrix of the camera the clusters are built for
+        count = len(self.lights)
+        data = self.data[:count]
+        centers = data["position"] @ view[:3, :3].T + view[:3, 3]
+        self.ranges, self.indices = cluster_lights(centers, data["radius"], tan_half_fov, aspect, near, far, self.grid)
+
+        # Empty texture buffers are not allowed everywhere, keep at least one element
+        self.light_buffer.upload(self.data[:count if count else 1])
+        self.range_buffer.upload(self.ranges)
+        self.index_buffer.upload(self.indices if len(self.indices) else np.zeros(1, dtype=np.uint32))
+
+        block = lights_buffer.data[0]
+        block["clusterGrid"] = (*self.grid, count)
+        block["clusterDepth"] = (near, far, *depth_slicing(near, far, self.grid[2]))
+        block["viewport"] = viewport
+        lights_buffer.upload()
+
+    def delete(self):
+        for buffer in (self.light_buffer, self.range_buffer, self.index_buffer):
+            buffer.delete()
@@ -0,0 +1,98 @@
+from Graphics.Utils.Shapes import Mesh, compute_normals
+from typing import List, Optional, Sequence
+import numpy as np
+
+# Mesh decimation for level of detail meshes, by vertex clustering: vertices are snapped to a grid, every
+# occupied cell becomes one vertex at the mean of its members and triangles that collapse are dropped.
+# Everything is array work, so it is fast enough to run at load time as well as offline:
+#   python -m Graphics.Utils.lod model.obj --ratios 0.5 0.25 0.1 --output-dir lods/
+
+# Screen sizes (fraction of the view height) at which build_lods switches to LOD 1, 2, ...
+DEFAULT_THRESHOLDS = [0.25, 0.1, 0.04, 0.015]
+
+def cluster_vertices(positions: np.ndarray, indices: np.ndarray, cell_size: float):
+    lo = positions.min(axis=0)
+    cells = np.floor((positions - lo) / cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, cluster = np.unique(keys, return_inverse=True)
+    cluster = cluster.reshape(-1)
+
+    counts = np.bincount(cluster).astype(np.float32)
+    clustered = np.stack([np.bincount(cluster, weights=positions[:, axis]) for axis in range(3)], axis=1) / counts[:, None]
+
+    # Triangles with two corners in the same cell collapse, triangles left with the same three cells are duplicates
+    triangles = cluster[indices.reshape(-1, 3)]
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    triangles = triangles[keep]
+    _, first = np.unique(np.sort(triangles, axis=1), axis=0, return_index=True)
+    triangles = triangles[np.sort(first)]
+
+    # Drop clusters no triangle uses anymore
+    used = np.unique(triangles)
+    remap = np.full(len(clustered), -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    return clustered[used].astype(np.float32), remap[triangles].reshape(-1).astype(np.uint32)
+
+def decimate(positions, indices, ratio: float, iterations: int = 16):
+    # Returns (positions, indices) with at most ratio times the triangles, as close to it as the grid allows.
+    # The cell size is found by bisection between a very fine and a single cell grid. Meshes too small to
+    # decimate without collapsing completely are returned as they are
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    indices = np.asarray(indices, dtype=np.uint32).reshape(-1)
+    target = int(len(indices) // 3 * ratio)
+    if ratio >= 1.0 or len(indices) == 0:
+        return positions, indices
+
+    diagonal = float(np.linalg.norm(positions.max(axis=0) - positions.min(axis=0)))
+    if diagonal == 0.0:
+        return positions, indices
+    fine, coarse = diagonal / 4096.0, diagonal
+    best = (positions, indices)
+    for _ in range(iterations):
+        cell_size = (fine * coarse) ** 0.5
+        result = cluster_vertices(positions, indices, cell_size)
+        if len(result[1]) == 0:
+            coarse = cell_size
+        elif len(result[1]) // 3 <= target:
+            best = result
+            coarse = cell_size
+        else:
+            fine = cell_size
+    return best
+
+def build_lods(mesh: Mesh, ratios: Sequence[float] = (0.5, 0.25, 0.1), thresholds: Optional[List[float]] = None) -> List[Mesh]:
+    # Decimated copies of mesh, one per ratio of the full triangle count, set as its LOD levels
+    positions = np.asarray(mesh.positions, dtype=np.float32)
+    lods = []
+    for ratio in ratios:
+        lod_positions, lod_indices = decimate(positions, mesh.indices, ratio)
+        lods.append(Mesh(None, lod_positions, lod_indices, compute_normals(lod_positions, lod_indices)))
+    mesh.set_lods(lods, DEFAULT_THRESHOLDS[:len(lods)] if thresholds is None else thresholds)
+    return lods
+
+def main(argv=None):
+    import argparse
+    import os
+    from Graphics.Utils.assets import load_mesh_data
+    from Graphics.Utils.cache import write_mesh_binary
+
+    parser = argparse.ArgumentParser(description="Writes decimated LOD levels of a mesh as .mesh files")
+    parser.add_argument("input", help=".obj, .ply or .mesh file")
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.5, 0.25, 0.1], help="triangle count of each level relative to the input")
+    parser.add_argument("--output-dir", default=".")
+    args = parser.parse_args(argv)
+
+    vertex_data, indices, _, _ = load_mesh_data(args.input)
+    positions = np.asarray(vertex_data[:, 0:3])
+    name = os.path.splitext(os.path.basename(args.input))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+    for level, ratio in enumerate(args.ratios, start=1):
+        lod_positions, lod_indices = decimate(positions, indices, ratio)
+        normals = compute_normals(lod_positions, lod_indices)
+        path = os.path.join(args.output_dir, f"{name}_lod{level}.mesh")
+        write_mesh_binary(path, np.concatenate([lod_positions, normals], axis=1), lod_indices)
+        print(f"{path}: {len(lod_indices) // 3} triangles ({len(lod_indices) / len(indices):.1%})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+from OpenGL.GL import *
+from Graphics.Utils import profiler
+from Graphics.Utils.culling import SceneBVH
+from Graphics.Utils.shader_utils import ShaderProgram
+import numpy as np
+
+# Occlusion culling with hardware queries. After the frame is drawn the world boxes of scene items are
+# rasterized against its depth buffer inside GL_ANY_SAMPLES_PASSED queries. Results are only read once the
+# GPU reports them available (usually the next frame), so the CPU never waits on a readback; until then an
+# item keeps its previous state. Visible items are re-tested every visible_interval frames and hidden ones
+# every hidden_interval frames, spread over the frames by item index so the query load stays even.
+
+box_vertex_shader = """
+    #version 330 core
+    layout(location = 0) in vec3 aPos;
+
+    uniform vec3 boxMin;
+    uniform vec3 boxMax;
+    // Shared by every program, filled once per frame (see UniformBuffer)
+    layout(std140) uniform Camera {
+        mat4 view;
+        mat4 projection;
+        vec4 cameraPosition;
+    };
+
+    void main() {
+        gl_Position = projection * view * vec4(mix(boxMin, boxMax, aPos), 1.0);
+    }
+"""
+
+box_fragment_shader = """
+    #version 330 core
+    out vec4 FragColor;
+
+    void main() {
+        FragColor = vec4(1.0);
+    }
+"""
+
+# Unit cube corners and its 12 triangles
+BOX_VERTICES = np.array([[x, y, z] for z in (0, 1) for y in (0, 1) for x in (0, 1)], dtype=np.float32)
+BOX_INDICES = np.array([
+    0, 2, 1, 1, 2, 3,  4, 5, 6, 5, 7, 6,
+    0, 1, 4, 1, 5, 4,  2, 6, 3, 3, 6, 7,
+    0, 4, 2, 2, 4, 6,  1, 3, 5, 3, 7, 5
+], dtype=np.uint32)
+
+class OcclusionCuller:
+    def __init__(self, visible_interval: int = 8, hidden_interval: int = 2, padding: float = 0.01):
+        self.visible_interval = visible_interval
+        self.hidden_interval = hidden_interval
+        # Boxes are grown by this fraction of their size (and a little more) so they never z-fight the surfaces
+        # they enclose
+        self.padding = padding
+        self.frame = 0
+        self.program = None
+        self.vao = None
+        self.buffers = []
+        self.free_queries = []
+        # Issued queries in submission order as [item, query], results become available in the same order
+        self.pending = []
+        self.querying = set()  # id() of items with a query in flight
+
+        # Statistics of the last frame
+        self.culled_count = 0
+        self.queries_issued = 0
+        self.results_read = 0
+
+    def filter(self, scene: SceneBVH, indices: np.ndarray, camera_position) -> np.ndarray:
+        # Reads whatever query results are ready and returns the mask of indices (frustum visible items) to draw
+        self.frame += 1
+        self.collect(scene)
+
+        # Items that were outside the frustum last frame have no current result, they are drawn until tested
+        returning = scene.last_seen[indices] != self.frame - 1
+        scene.occluded[indices[returning]] = False
+        scene.last_seen[indices] = self.frame
+
+        # Never cull something the camera is inside of, its box would be clipped by the near plane
+        eye = np.asarray(camera_position, dtype=np.float32)
+        mins, maxs = self.padded_bounds(scene, indices)
+        inside = ((mins <= eye) & (eye <= maxs)).all(axis=1)
+        scene.occluded[indices[inside]] = False
+
+        keep = ~scene.occluded[indices]
+        self.culled_count = int(len(indices) - np.count_nonzero(keep))
+        profiler.count("occlusion_culled", self.culled_count)
+        return keep
+
+    def collect(self, scene: SceneBVH):
+        self.results_read = 0
+        done = 0
+        for item, query in self.pending:
+            if not glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE):
+                # Later queries were submitted after this one, they are not ready either
+                break
+            passed = glGetQueryObjectuiv(query, GL_QUERY_RESULT)
+            index = scene.item_index.get(id(item))
+            if index is not None:
+                scene.occluded[index] = not passed
+            self.querying.discard(id(item))
+            self.free_queries.append(query)
+            done += 1
+        self.results_read = done
+        del self.pending[:done]
+
+    def padded_bounds(self, scene: SceneBVH, indices: np.ndarray):
+        mins = scene.item_mins[indices]
+        maxs = scene.item_maxs[indices]
+        pad = (maxs - mins) * self.padding + 1e-3
+        return mins - pad, maxs + pad
+
+    def issue(self, scene: SceneBVH, indices: np.ndarray):
+        # Called after the frame is drawn with the frustum visible indices given to filter(), tests those that are due
+        occluded = scene.occluded[indices]
+        interval = np.where(occluded, self.hidden_interval, self.visible_interval)
+        due = (indices + self.frame) % interval == 0
+        mins, maxs = self.padded_bounds(scene, indices)
+        due &= np.isfinite(mins).all(axis=1) & np.isfinite(maxs).all(axis=1)
+
+        tested = [(scene.items[index], low, high) for index, low, high in zip(indices[due].tolist(), mins[due].tolist(), maxs[due].tolist())
+                  if id(scene.items[index]) not in self.querying]
+        self.queries_issued = len(tested)
+        profiler.count("occlusion_queries", len(tested))
+        if not tested:
+            return
+
+        self.prepare()
+        if len(self.free_queries) < len(tested):
+            self.free_queries.extend(np.atleast_1d(glGenQueries(len(tested) - len(self.free_queries))).tolist())
+
+        # Boxes only test depth, they must not write anything
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        glDepthMask(GL_FALSE)
+        glDepthFunc(GL_LEQUAL)
+        cull_face = glIsEnabled(GL_CULL_FACE)
+        glDisable(GL_CULL_FACE)
+        glUseProgram(self.program.id)
+        glBindVertexArray(self.vao)
+        box_min = self.program.uniforms["boxMin"]
+        box_max = self.program.uniforms["boxMax"]
+        for item, low, high in tested:
+            query = self.free_queries.pop()
+            glUniform3f(box_min, *low)
+            glUniform3f(box_max, *high)
+            glBeginQuery(GL_ANY_SAMPLES_PASSED, query)
+            glDrawElements(GL_TRIANGLES, len(BOX_INDICES), GL_UNSIGNED_INT, None)
+            glEndQuery(GL_ANY_SAMPLES_PASSED)
+            self.pending.append([item, query])
+            self.querying.add(id(item))
+        glBindVertexArray(0)
+        glUseProgram(0)
+        if cull_face:
+            glEnable(GL_CULL_FACE)
+        glDepthFunc(GL_LESS)
+        glDepthMask(GL_TRUE)
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+
+    def prepare(self):
+        if self.program is not None:
+            return
+        self.program = ShaderProgram(box_vertex_shader, box_fragment_shader)
+        self.vao = glGenVertexArrays(1)
+        glBindVertexArray(self.vao)
+        self.buffers = glGenBuffers(2)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[0])
+        glBufferData(GL_ARRAY_BUFFER, BOX_VERTICES.nbytes, BOX_VERTICES, GL_STATIC_DRAW)
+        glEnableVertexAttribArray(0)
+        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffers[1])
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, BOX_INDICES.nbytes, BOX_INDICES, GL_STATIC_DRAW)
+        glBindVertexArray(0)
+
+    def delete(self):
+        queries = self.free_queries + [query for _, query in self.pending]
+        if queries:
+            glDeleteQueries(len(queries), queries)
+        if self.program is not None:
+            glDeleteProgram(self.program.id)
+            glDeleteVertexArrays(1, [self.vao])
+            glDeleteBuffers(2, self.buffers)
+            self.program = None
+        self.free_queries = []
+        self.pending = []
+        self.querying.clear()
@@ -0,0 +1,159 @@
+from OpenGL.GL import *
+from Graphics.Utils.headless import HEADLESS_PLATFORMS, current_platform
+import ctypes
+import numpy as np
+
+# Offscreen OpenGL contexts (EGL or OSMesa) and framebuffers, for running the engine without a window.
+
+class EGLContext:
+    def __init__(self, width: int, height: int, major: int = 3, minor: int = 3):
+        from OpenGL import EGL  # only importable on the EGL platform
+        self.EGL = EGL
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major_version, minor_version = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major_version), ctypes.pointer(minor_version)):
+            raise RuntimeError("eglInitialize failed")
+
+        attributes = [
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8, EGL.EGL_ALPHA_SIZE, 8,
+            EGL.EGL_DEPTH_SIZE, 24,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE
+        ]
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attributes))(*attributes), ctypes.pointer(config), 1, ctypes.pointer(count)) or count.value == 0:
+            raise RuntimeError("No EGL config with an RGBA8 / depth 24 pbuffer")
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attributes = [
+            EGL.EGL_CONTEXT_MAJOR_VERSION, major,
+            EGL.EGL_CONTEXT_MINOR_VERSION, minor,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE
+        ]
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, (EGL.EGLint * len(context_attributes))(*context_attributes))
+        if not self.context:
+            raise RuntimeError(f"Could not create an OpenGL {major}.{minor} core context through EGL")
+
+        surface_attributes = [EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE]
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config, (EGL.EGLint * len(surface_attributes))(*surface_attributes))
+        self.make_current()
+
+    def make_current(self):
+        if not self.EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise RuntimeError("eglMakeCurrent failed")
+
+    def destroy(self):
+        EGL = self.EGL
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+
+class OSMesaContext:
+    def __init__(self, width: int, height: int, major: int = 3, minor: int = 3):
+        from OpenGL import osmesa  # only importable on the OSMesa platform
+        self.osmesa = osmesa
+        attributes = [
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_DEPTH_BITS, 24,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, major,
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, minor,
+            0
+        ]
+        self.context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+        if not self.context:
+            raise RuntimeError(f"Could not create an OpenGL {major}.{minor} core context through OSMesa")
+        # OSMesa needs a client side buffer even though we render into our own framebuffer
+        self.buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        self.width = width
+        self.height = height
+        self.type = GL_UNSIGNED_BYTE
+        self.make_current()
+
+    def make_current(self):
+        if not self.osmesa.OSMesaMakeCurrent(self.context, self.buffer, self.type, self.width, self.height):
+            raise RuntimeError("OSMesaMakeCurrent failed")
+
+    def destroy(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
+
+def create_context(width: int, height: int):
+    platform = current_platform()
+    if platform == "egl":
+        return EGLContext(width, height)
+    if platform == "osmesa":
+        return OSMesaContext(width, height)
+    raise RuntimeError(f"Headless rendering needs PYOPENGL_PLATFORM set to one of {HEADLESS_PLATFORMS} before OpenGL is imported "
+                       f"(call Graphics.Utils.headless.select_platform() first), got '{platform}'")
+
+class Framebuffer:
+    # Color + depth render target with synchronous and PBO based (non stalling) read back
+    def __init__(self, width: int, height: int, pbo_count: int = 2):
+        self.width = width
+        self.height = height
+        self.id = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.id)
+
+        self.color = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.color)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.color)
+
+        self.depth = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth)
+
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Offscreen framebuffer is incomplete")
+
+        # Ring of pixel pack buffers: a read started this frame is collected pbo_count - 1 frames later
+        self.pbos = [int(pbo) for pbo in np.atleast_1d(glGenBuffers(pbo_count))]
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, width * height * 4, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending = []
+
+    def bind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.id)
+        glViewport(0, 0, self.width, self.height)
+
+    def read_pixels(self) -> np.ndarray:
+        # Blocking read back as (height, width, 4) uint8, top row first
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.id)
+        pixels = glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE)
+        return np.frombuffer(pixels, dtype=np.uint8).reshape(self.height, self.width, 4)[::-1].copy()
+
+    def start_read(self):
+        # Queue an asynchronous read of the current frame into the next PBO, returns frames that are ready
+        ready = []
+        if len(self.pending) == len(self.pbos):
+            ready.append(self.finish_read())
+
+        pbo = self.pbos[0]
+        self.pbos = self.pbos[1:] + self.pbos[:1]
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.id)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append(pbo)
+        return ready
+
+    def finish_read(self) -> np.ndarray:
+        # Map the oldest pending PBO, by now the GPU has usually finished the copy so this doesn't stall
+        pbo = self.pending.pop(0)
+        size = self.width * self.height * 4
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, size, GL_MAP_READ_BIT)
+        pixels = np.ctypeslib.as_array(ctypes.cast(pointer, ctypes.POINTER(ctypes.c_uint8)), shape=(size,)).copy()
+        glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        return pixels.reshape(self.height, self.width, 4)[::-1].copy()
+
+    def flush_reads(self) -> list:
+        return [self.finish_read() for _ in range(len(self.pending))]
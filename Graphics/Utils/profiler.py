@@ -0,0 +1,195 @@
+from OpenGL.GL import *
+from collections import deque, defaultdict
+from contextlib import nullcontext
+import ctypes
+import numpy as np
+import time
+import json
+import csv
+
+# Per-frame counters any subsystem can bump (draw calls, triangles, uploaded bytes, ...), collected and
+# reset by Profiler.end_frame
+frame_counters = defaultdict(int)
+
+def count(name: str, amount: int = 1):
+    frame_counters[name] += amount
+
+class Zone:
+    # CPU timing scope, use through Profiler.zone()
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        self.profiler.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.profiler.depth -= 1
+        self.profiler.events.append((self.name, self.start, end - self.start, self.profiler.depth))
+        return False
+
+class GpuZone:
+    # GL_TIME_ELAPSED query around a scope. Only one can be active at a time, nested ones are ignored
+    def __init__(self, timer: "GpuTimer", name: str):
+        self.timer = timer
+        self.name = name
+        self.query = None
+
+    def __enter__(self):
+        self.query = self.timer.begin(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.query is not None:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.timer.active = False
+        return False
+
+class GpuTimer:
+    # Pool of timer queries. Results are polled with GL_QUERY_RESULT_AVAILABLE a few frames later and never
+    # waited on; when every query is still in flight the zone is simply not measured.
+    def __init__(self, profiler: "Profiler", pool_size: int = 16):
+        self.profiler = profiler
+        self.pool_size = pool_size
+        self.free = []
+        self.pending = deque()  # (query, frame, name) in issue order
+        self.active = False
+
+    def begin(self, name: str):
+        if self.active:
+            return None
+        if not self.free:
+            if len(self.pending) >= self.pool_size:
+                self.profiler.dropped_gpu_zones += 1
+                return None
+            self.free.append(int(np.atleast_1d(glGenQueries(1))[0]))
+        query = self.free.pop()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.active = True
+        self.pending.append((query, self.profiler.frame, name))
+        return query
+
+    def poll(self):
+        available = ctypes.c_int(0)
+        elapsed = ctypes.c_uint64(0)
+        while self.pending:
+            query, frame, name = self.pending[0]
+            glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+            if not available.value:
+                # Queries finish in order, nothing behind this one is ready either
+                break
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(elapsed))
+            self.pending.popleft()
+            self.free.append(query)
+            self.profiler.add_gpu_time(frame, name, elapsed.value)
+
+class Profiler:
+    # Frame profiler: nested CPU zones, GPU timer queries and per-frame counters kept in a ring buffer of
+    # the last `capacity` frames, exportable as CSV or Chrome trace JSON (chrome://tracing, Perfetto)
+    def __init__(self, capacity: int = 600, enabled: bool = True, gpu: bool = True):
+        self.enabled = enabled
+        self.gpu_enabled = gpu
+        self.frames = deque(maxlen=capacity)
+        self.frame = 0
+        self.depth = 0
+        self.events = []
+        self.frame_start = time.perf_counter_ns()
+        self.origin = self.frame_start
+        self.gpu = GpuTimer(self)
+        self.dropped_gpu_zones = 0
+
+    def zone(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return Zone(self, name)
+
+    def gpu_zone(self, name: str):
+        if not (self.enabled and self.gpu_enabled):
+            return nullcontext()
+        return GpuZone(self.gpu, name)
+
+    def end_frame(self):
+        # Closes the current frame (everything since the previous end_frame) and pushes it into the ring buffer
+        end = time.perf_counter_ns()
+        if self.enabled:
+            self.frames.append({
+                "frame": self.frame,
+                "start": self.frame_start,
+                "duration": end - self.frame_start,
+                "zones": self.events,
+                "counters": dict(frame_counters),
+                "gpu": {}
+            })
+            if self.gpu_enabled:
+                self.gpu.poll()
+        frame_counters.clear()
+        self.events = []
+        self.frame += 1
+        self.frame_start = end
+
+    def add_gpu_time(self, frame: int, name: str, nanoseconds: int):
+        # GPU results arrive late, attach them to their frame if it is still in the ring buffer
+        if not self.frames:
+            return
+        index = len(self.frames) - 1 - (self.frames[-1]["frame"] - frame)
+        if 0 <= index < len(self.frames):
+            gpu = self.frames[index]["gpu"]
+            gpu[name] = gpu.get(name, 0) + nanoseconds
+
+    def zone_totals(self, record) -> dict:
+        totals = defaultdict(int)
+        for name, start, duration, depth in record["zones"]:
+            totals[name] += duration
+        return totals
+
+    def summary(self) -> dict:
+        # Average milliseconds per frame for the frame itself, every CPU and GPU zone, and average counters
+        frames = len(self.frames)
+        if frames == 0:
+            return {}
+        result = defaultdict(float)
+        for record in self.frames:
+            result["frame_ms"] += record["duration"] / 1e6
+            for name, total in self.zone_totals(record).items():
+                result[f"{name}_ms"] += total / 1e6
+            for name, total in record["gpu"].items():
+                result[f"gpu_{name}_ms"] += total / 1e6
+            for name, value in record["counters"].items():
+                result[name] += value
+        return {name: value / frames for name, value in result.items()}
+
+    def to_csv(self, path: str):
+        zones = sorted({name for record in self.frames for name, *_ in record["zones"]})
+        gpu = sorted({name for record in self.frames for name in record["gpu"]})
+        counters = sorted({name for record in self.frames for name in record["counters"]})
+
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["frame", "frame_ms"] + [f"{name}_ms" for name in zones] + [f"gpu_{name}_ms" for name in gpu] + counters)
+            for record in self.frames:
+                totals = self.zone_totals(record)
+                writer.writerow([record["frame"], record["duration"] / 1e6]
+                                + [totals.get(name, 0) / 1e6 for name in zones]
+                                + [record["gpu"][name] / 1e6 if name in record["gpu"] else "" for name in gpu]
+                                + [record["counters"].get(name, 0) for name in counters])
+
+    def to_chrome_trace(self, path: str):
+        # CPU zones on thread 1, GPU times on thread 2 (placed at the start of their frame), counters as "C" events
+        events = []
+        for record in self.frames:
+            frame_ts = (record["start"] - self.origin) / 1000.0
+            events.append({"name": f"frame {record['frame']}", "ph": "X", "ts": frame_ts, "dur": record["duration"] / 1000.0, "pid": 1, "tid": 1})
+            for name, start, duration, depth in record["zones"]:
+                events.append({"name": name, "ph": "X", "ts": (start - self.origin) / 1000.0, "dur": duration / 1000.0, "pid": 1, "tid": 1})
+            gpu_ts = frame_ts
+            for name, duration in record["gpu"].items():
+                events.append({"name": f"gpu {name}", "ph": "X", "ts": gpu_ts, "dur": duration / 1000.0, "pid": 1, "tid": 2})
+                gpu_ts += duration / 1000.0
+            if record["counters"]:
+                events.append({"name": "counters", "ph": "C", "ts": frame_ts, "pid": 1, "args": record["counters"]})
+
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,289 @@
+from Graphics.Utils.culling import SceneBVH, morton_codes, transform_aabb, EMPTY_MIN, EMPTY_MAX
+from typing import Dict, List, Optional
+import weakref
+import numpy as np
+
+# Ray casts against scene geometry, CPU only. The scene BVH (culling.py) finds the items whose world box a ray
+# enters, rays are then moved into each candidate's local space and tested against a triangle BVH of its
+# geometry with a vectorized Moller-Trumbore. Every stage works on flat (ray, candidate) pair arrays, so a batch
+# of rays costs a handful of NumPy calls per tree level and per distinct geometry, not per ray.
+
+def inverse_directions(directions: np.ndarray) -> np.ndarray:
+    # 1 / direction for the slab tests. Zero components get a tiny value instead, so a ray lying on a slab
+    # gives finite products and no 0 * inf
+    return 1.0 / np.where(directions == 0.0, 1e-30, directions)
+
+def ray_boxes(origins, inverse_directions, mins, maxs, limits) -> np.ndarray:
+    # Slab test of ray i against box i, True when the ray enters it between 0 and limits[i]. Axes are combined
+    # column by column, a reduction over an axis of 3 is much slower in NumPy
+    t1 = (mins - origins) * inverse_directions
+    t2 = (maxs - origins) * inverse_directions
+    low = np.minimum(t1, t2)
+    high = np.maximum(t1, t2)
+    near = np.maximum(np.maximum(low[:, 0], low[:, 1]), low[:, 2])
+    far = np.minimum(np.minimum(high[:, 0], high[:, 1]), high[:, 2])
+    # Empty boxes (EMPTY_MIN / EMPTY_MAX padding) have mins > maxs on every axis
+    return (near <= far) & (far >= 0.0) & (near <= limits) & (mins[:, 0] <= maxs[:, 0])
+
+def traverse(levels: list, leaf_size: int, order: np.ndarray, count: int, origins, inverses, limits):
+    # (rays, elements) of every element in a leaf whose box the ray enters. levels are (mins, maxs) per level
+    # of an implicit binary tree, leaves first and the root last (the SceneBVH layout)
+    rays = np.arange(len(origins))
+    nodes = np.zeros(len(origins), dtype=np.int64)
+    for level in range(len(levels) - 1, -1, -1):
+        mins, maxs = levels[level]
+        hit = ray_boxes(origins[rays], inverses[rays], mins[nodes], maxs[nodes], limits[rays])
+        rays, nodes = rays[hit], nodes[hit]
+        if level > 0:
+            rays = np.repeat(rays, 2)
+            nodes = (nodes[:, None] * 2 + np.arange(2)).reshape(-1)
+            keep = nodes < len(levels[level - 1][0])
+            rays, nodes = rays[keep], nodes[keep]
+    slots = (nodes[:, None] * leaf_size + np.arange(leaf_size)).reshape(-1)
+    rays = np.repeat(rays, leaf_size)
+    keep = slots < count
+    return rays[keep], order[slots[keep]]
+
+def intersect_triangles(origins, directions, v0, v1, v2, limits):
+    # Moller-Trumbore for ray i against triangle i. Returns (t, hit), both sides of a triangle count
+    edge1 = v1 - v0
+    edge2 = v2 - v0
+    p = np.cross(directions, edge2)
+    det = (edge1 * p).sum(axis=1)
+    parallel = np.abs(det) < 1e-12
+    inverse = 1.0 / np.where(parallel, 1.0, det)
+    s = origins - v0
+    u = (s * p).sum(axis=1) * inverse
+    q = np.cross(s, edge1)
+    v = (directions * q).sum(axis=1) * inverse
+    t = (edge2 * q).sum(axis=1) * inverse
+    hit = ~parallel & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t >= 0.0) & (t <= limits)
+    return t, hit
+
+def nearest_per_ray(rays: np.ndarray, t: np.ndarray) -> np.ndarray:
+    # Positions in rays / t of the smallest t of every ray
+    order = np.lexsort((t, rays))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = rays[order[1:]] != rays[order[:-1]]
+    return order[first]
+
+class TriangleBVH:
+    # Same layout as SceneBVH: triangles sorted along a Morton curve, LEAF_SIZE per leaf, paired up level by
+    # level. Built in the geometry's local space, so moving an object never touches it; refit() follows vertex
+    # edits that keep the topology
+    LEAF_SIZE = 4
+
+    def __init__(self, positions: np.ndarray, indices: np.ndarray):
+        self.triangles = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+        self.count = len(self.triangles)
+        corners = np.asarray(positions, dtype=np.float64)[self.triangles]
+        self.order = np.argsort(morton_codes(corners.mean(axis=1)), kind="stable") if self.count else np.zeros(0, dtype=np.int64)
+        self.levels = []
+        self.refit(positions)
+
+    def refit(self, positions: np.ndarray):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        if not self.count:
+            self.levels = [[np.full((1, 3), EMPTY_MIN), np.full((1, 3), EMPTY_MAX)]]
+            return
+        corners = self.positions[self.triangles[self.order]]
+        leaves = (self.count + self.LEAF_SIZE - 1) // self.LEAF_SIZE
+        padded = np.full((leaves * self.LEAF_SIZE, 3, 3), np.nan)
+        padded[:self.count] = corners
+        padded = padded.reshape(leaves, -1, 3)
+        mins, maxs = np.nanmin(padded, axis=1), np.nanmax(padded, axis=1)
+        self.levels = [[mins, maxs]]
+        while len(mins) > 1:
+            mins, maxs = SceneBVH.pair_up(mins), SceneBVH.pair_up(maxs, False)
+            self.levels.append([mins, maxs])
+
+    def intersect(self, origins, directions, limits, mask: Optional[np.ndarray] = None):
+        # Nearest hit of every ray (local space). Returns (rays, triangles, t, normals) of the rays that hit,
+        # normals are the unnormalized face normals as wound. mask (per triangle) leaves out triangles that are False
+        rays, triangles = traverse(self.levels, self.LEAF_SIZE, self.order, self.count, origins, inverse_directions(directions), limits)
+        if mask is not None:
+            keep = mask[triangles]
+            rays, triangles = rays[keep], triangles[keep]
+        corners = self.positions[self.triangles[triangles]]
+        t, hit = intersect_triangles(origins[rays], directions[rays], corners[:, 0], corners[:, 1], corners[:, 2], limits[rays])
+        rays, triangles, t, corners = rays[hit], triangles[hit], t[hit], corners[hit]
+        nearest = nearest_per_ray(rays, t)
+        corners = corners[nearest]
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        return rays[nearest], triangles[nearest], t[nearest], normals
+
+class RayHit:
+    # One hit: the Object and Shape hit, distance along the (normalized) ray, world point and unit normal facing
+    # the ray, the triangle of the shape's geometry and the instance number for instanced groups (-1 otherwise)
+    __slots__ = ("object", "shape", "distance", "point", "normal", "triangle", "instance")
+
+    def __init__(self, object, shape, distance: float, point: np.ndarray, normal: np.ndarray, triangle: int, instance: int):
+        self.object = object
+        self.shape = shape
+        self.distance = distance
+        self.point = point
+        self.normal = normal
+        self.triangle = triangle
+        self.instance = instance
+
+class RayHits:
+    # Results of a batch, row i belongs to ray i. Rays that hit nothing have distance inf and None entries
+    def __init__(self, count: int):
+        self.hit = np.zeros(count, dtype=bool)
+        self.distance = np.full(count, np.inf)
+        self.point = np.full((count, 3), np.nan)
+        self.normal = np.zeros((count, 3))
+        self.triangle = np.full(count, -1, dtype=np.int64)
+        self.instance = np.full(count, -1, dtype=np.int64)
+        self.objects: List[object] = [None] * count
+        self.shapes: List[object] = [None] * count
+
+    def __len__(self) -> int:
+        return len(self.hit)
+
+    def __getitem__(self, ray: int) -> Optional[RayHit]:
+        if not self.hit[ray]:
+            return None
+        return RayHit(self.objects[ray], self.shapes[ray], float(self.distance[ray]), self.point[ray], self.normal[ray], int(self.triangle[ray]), int(self.instance[ray]))
+
+class RayCaster:
+    # Root.raycaster. Triangle BVHs are built on the first query that reaches a geometry and shared by every
+    # shape using the same vertex / index arrays (shared primitives and clones build one tree)
+    def __init__(self, root: "Root"):
+        self.root = root
+        # (id(vertex_data), id(indices)) -> [vertex_data ref, indices ref, edit_count, TriangleBVH]
+        self.trees: Dict[tuple, list] = {}
+        self.prune_at = 64
+
+    def get_tree(self, mesh) -> TriangleBVH:
+        key = (id(mesh.vertex_data), id(mesh.indices))
+        entry = self.trees.get(key)
+        if entry is None or entry[0]() is not mesh.vertex_data or entry[1]() is not mesh.indices:
+            if len(self.trees) >= self.prune_at:
+                # Geometry that was replaced or dropped still has an entry, forget those
+                self.trees = {key: value for key, value in self.trees.items() if value[0]() is not None}
+                self.prune_at = 2 * len(self.trees) + 64
+            tree = TriangleBVH(mesh.vertex_data[:, 0:3], mesh.indices)
+            self.trees[key] = [weakref.ref(mesh.vertex_data), weakref.ref(mesh.indices), mesh.edit_count, tree]
+            return tree
+        if entry[2] != mesh.edit_count:
+            # Vertices edited in place (Mesh.touch_vertices, static batch rebuilds)
+            entry[3].refit(mesh.vertex_data[:, 0:3])
+            entry[2] = mesh.edit_count
+        return entry[3]
+
+    def cast(self, origins, directions, max_distance=np.inf) -> RayHits:
+        # Nearest hit of each ray, origins / directions are (N, 3) (or a single ray) in world space
+        from Graphics.Engine import InstancedGroup
+        from Graphics.Utils.batching import StaticBatch
+
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        lengths = np.linalg.norm(directions, axis=1, keepdims=True)
+        lengths[lengths == 0.0] = 1.0
+        directions = directions / lengths
+        limits = np.broadcast_to(np.asarray(max_distance, dtype=np.float64), (len(origins),)).copy()
+        hits = RayHits(len(origins))
+
+        root = self.root
+        root.update_transforms()
+        scene = root.scene
+        scene.update()
+        if not scene.items or not len(origins):
+            return hits
+
+        # Items whose world box each ray enters
+        inverses = inverse_directions(directions)
+        rays, items = traverse(scene.levels, scene.LEAF_SIZE, scene.order, len(scene.items), origins, inverses, limits)
+        keep = ray_boxes(origins[rays], inverses[rays], scene.item_mins[items], scene.item_maxs[items], limits[rays])
+        rays, items = rays[keep], items[keep]
+        if not len(rays):
+            return hits
+
+        # (ray, model matrix, shape, owner, instance, triangle mask) candidates grouped by geometry
+        groups: Dict[tuple, list] = {}
+
+        def add(mesh, pair_rays, matrices, owner, shapes, instances, mask=None):
+            key = (id(mesh.vertex_data), id(mesh.indices))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [mesh, [], [], [], [], [], mask]
+            group[1].append(pair_rays)
+            group[2].append(matrices)
+            group[3].extend(owner)
+            group[4].extend(shapes)
+            group[5].append(instances)
+
+        order = np.argsort(items, kind="stable")
+        rays, items = rays[order], items[order]
+        starts = np.flatnonzero(np.concatenate([[True], items[1:] != items[:-1]]))
+        ends = np.concatenate([starts[1:], [len(items)]])
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            item = scene.items[items[start]]
+            item_rays = rays[start:end]
+            if isinstance(item, InstancedGroup):
+                # Expand to (ray, instance) pairs whose instance box the ray enters
+                matrices = item.get_instance_model_matrices().astype(np.float64)
+                mesh = item.mesh
+                if not mesh.index_count or not len(matrices):
+                    continue
+                mins, maxs = transform_aabb(matrices, mesh.bounds_min, mesh.bounds_max)
+                pair_rays = np.repeat(item_rays, len(matrices))
+                instances = np.tile(np.arange(len(matrices)), len(item_rays))
+                keep = ray_boxes(origins[pair_rays], inverses[pair_rays], mins[instances], maxs[instances], limits[pair_rays])
+                pair_rays, instances = pair_rays[keep], instances[keep]
+                add(mesh, pair_rays, matrices[instances], [item] * len(pair_rays), [mesh] * len(pair_rays), instances)
+            elif isinstance(item, StaticBatch):
+                if not item.index_count:
+                    continue
+                # Hidden members are left out per triangle, hits are mapped back to members below
+                mask = np.repeat(~item.hidden, item.index_counts // 3)
+                matrix = np.identity(4)[None].repeat(len(item_rays), axis=0)
+                add(item, item_rays, matrix, [None] * len(item_rays), [item] * len(item_rays), np.full(len(item_rays), -1), mask)
+            elif getattr(item, "index_count", 0):
+                matrix = np.asarray(item.get_model_matrix(), dtype=np.float64)[None].repeat(len(item_rays), axis=0)
+                add(item, item_rays, matrix, [item.object] * len(item_rays), [item] * len(item_rays), np.full(len(item_rays), -1))
+
+        for mesh, pair_rays, matrices, owners, shapes, instances, mask in groups.values():
+            pair_rays = np.concatenate(pair_rays)
+            matrices = np.concatenate(matrices)
+            instances = np.concatenate(instances)
+            # Rays to local space: t stays the same as long as the direction is not renormalized
+            inverse = np.linalg.inv(matrices)
+            local_origins = np.einsum("pij,pj->pi", inverse[:, :3, :3], origins[pair_rays]) + inverse[:, :3, 3]
+            local_directions = np.einsum("pij,pj->pi", inverse[:, :3, :3], directions[pair_rays])
+            tree = self.get_tree(mesh)
+            pairs, triangles, t, normals = tree.intersect(local_origins, local_directions, limits[pair_rays], mask)
+
+            # Closer than what this ray hit so far (in another geometry group)?
+            ray_ids = pair_rays[pairs]
+            best = nearest_per_ray(ray_ids, t)
+            pairs, triangles, t, normals, ray_ids = pairs[best], triangles[best], t[best], normals[best], ray_ids[best]
+            closer = t < hits.distance[ray_ids]
+            pairs, triangles, t, normals, ray_ids = pairs[closer], triangles[closer], t[closer], normals[closer], ray_ids[closer]
+
+            # Normals to world space with the inverse transpose, turned towards the ray
+            world_normals = np.einsum("pji,pj->pi", inverse[pairs, :3, :3], normals)
+            world_normals /= np.linalg.norm(world_normals, axis=1, keepdims=True)
+            facing = (world_normals * directions[ray_ids]).sum(axis=1) > 0.0
+            world_normals[facing] *= -1.0
+
+            hits.hit[ray_ids] = True
+            hits.distance[ray_ids] = t
+            hits.point[ray_ids] = origins[ray_ids] + directions[ray_ids] * t[:, None]
+            hits.normal[ray_ids] = world_normals
+            hits.triangle[ray_ids] = triangles
+            hits.instance[ray_ids] = instances[pairs]
+            limits[ray_ids] = t
+            if isinstance(mesh, StaticBatch):
+                members = np.searchsorted(mesh.first_index, triangles * 3, side="right") - 1
+                for ray, member, triangle in zip(ray_ids.tolist(), members.tolist(), triangles.tolist()):
+                    shape = mesh.members[member]
+                    hits.shapes[ray] = shape
+                    hits.objects[ray] = shape.object
+                    hits.triangle[ray] = triangle - int(mesh.first_index[member]) // 3
+            else:
+                for ray, pair in zip(ray_ids.tolist(), pairs.tolist()):
+                    hits.shapes[ray] = shapes[pair]
+                    hits.objects[ray] = owners[pair]
+        return hits
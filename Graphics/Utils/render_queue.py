@@ -0,0 +1,93 @@
+from OpenGL.GL import *
+from Graphics.Utils import profiler
+import numpy as np
+
+class RenderQueue:
+    # Flat list of draw items collected each frame, sorted by (program, material, VAO, depth) before drawing
+    # so consecutive items share state and redundant glUseProgram / glBindVertexArray calls are skipped.
+    # Items need prepare(), get_material(), issue_draw(material), get_triangle_count() and get_vao() (see Shapes.Mesh).
+    def __init__(self):
+        self.items = []
+        self.depths = []
+
+        # Statistics of the last flush()
+        self.draw_calls = 0
+        self.program_changes = 0
+        self.vao_changes = 0
+        self.state_changes_saved = 0
+        self.triangles = 0
+
+    def clear(self):
+        self.items = []
+        self.depths = []
+
+    def submit(self, item, depth: float = 0.0):
+        self.items.append(item)
+        self.depths.append(depth)
+
+    def submit_many(self, items, depths):
+        self.items.extend(items)
+        self.depths.extend(np.asarray(depths, dtype=np.float32).tolist())
+
+    def sort(self):
+        items = []
+        materials = []
+        depths = []
+        for item, depth in zip(self.items, self.depths):
+            # Uploads pending data so every item has its VAO, empty items have none and are dropped
+            item.prepare()
+            if item.get_vao() is None:
+                continue
+            items.append(item)
+            materials.append(item.get_material())
+            depths.append(depth)
+
+        if not items:
+            return [], []
+
+        material_ids = {}
+        programs = np.fromiter((material.id for material in materials), dtype=np.int64, count=len(items))
+        material_keys = np.fromiter((material_ids.setdefault(id(material), len(material_ids)) for material in materials), dtype=np.int64, count=len(items))
+        vaos = np.fromiter((item.get_vao() for item in items), dtype=np.int64, count=len(items))
+
+        # lexsort uses the last key as the primary one
+        order = np.lexsort((np.asarray(depths, dtype=np.float32), vaos, material_keys, programs))
+        return [items[i] for i in order], [materials[i] for i in order]
+
+    def flush(self):
+        items, materials = self.sort()
+
+        program = None
+        current = None
+        vao = None
+        self.program_changes = 0
+        self.vao_changes = 0
+        self.triangles = 0
+        for item, material in zip(items, materials):
+            if material.id != program:
+                material.use()
+                program = material.id
+                current = material
+                self.program_changes += 1
+            elif material is not current:
+                # Another material sharing the program, only its values change
+                material.set_material_properties()
+                current = material
+            if item.get_vao() != vao:
+                vao = item.get_vao()
+                glBindVertexArray(vao)
+                self.vao_changes += 1
+            item.issue_draw(material)
+            self.triangles += item.get_triangle_count()
+
+        if vao is not None:
+            glBindVertexArray(0)
+
+        # Drawing every item on its own costs a program switch, a VAO bind and a VAO unbind each
+        self.draw_calls = len(items)
+        self.state_changes_saved = 3 * self.draw_calls - (self.program_changes + self.vao_changes + (1 if vao is not None else 0))
+        profiler.count("draw_calls", self.draw_calls)
+        profiler.count("triangles", self.triangles)
+        profiler.count("state_changes", self.program_changes + self.vao_changes)
+        profiler.count("state_changes_saved", self.state_changes_saved)
+        self.clear()
@@ -0,0 +1,230 @@
+from Graphics.Utils import transforms
+from typing import List
+import numpy as np
+
+# Struct-of-arrays storage for the scene tree. Every Object and every attached Mesh is one row (node id):
+# position / angle / scale, parent, depth in the tree and the cached world matrix live in contiguous arrays,
+# the Python objects are thin SceneNode handles holding their id. World matrices are recomputed for all dirty
+# nodes and their subtrees at once, level by level from the roots down, with batched matrix products. Local
+# matrices are not kept, they are composed from position / angle / scale whenever a world matrix is rebuilt.
+
+LOCAL_DIRTY = 1
+ALIVE = 2
+
+class SceneStore:
+    def __init__(self, capacity: int = 64):
+        self.count = 0  # ids below this have been handed out at least once
+        self.capacity = 0
+        # [position, angle (degrees), scale] per node
+        self.trs = np.zeros((0, 3, 3), dtype=np.float32)
+        self.parents = np.zeros(0, dtype=np.int32)
+        self.depths = np.zeros(0, dtype=np.int32)
+        self.flags = np.zeros(0, dtype=np.uint8)
+        # Row-major world matrices, up to date after update()
+        self.world = np.zeros((0, 4, 4), dtype=np.float32)
+        # World matrix changed since the last take_moved()
+        self.moved = np.zeros(0, dtype=bool)
+        self.handles: List[object] = []
+        self.free_ids: List[int] = []
+
+        self.dirty = False  # some node has LOCAL_DIRTY set
+        # Live node ids grouped by depth, rebuilt after the tree structure changed
+        self.levels = None
+        self.reserve(capacity)
+
+    def reserve(self, capacity: int):
+        if capacity <= self.capacity:
+            return
+        capacity = capacity if capacity > self.capacity * 2 else self.capacity * 2
+
+        def grow(array):
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            return grown
+
+        self.trs = grow(self.trs)
+        self.parents = grow(self.parents)
+        self.depths = grow(self.depths)
+        self.flags = grow(self.flags)
+        self.world = grow(self.world)
+        self.moved = grow(self.moved)
+        self.capacity = capacity
+
+    def allocate(self, handle, parent: int, trs) -> int:
+        if self.free_ids:
+            node = self.free_ids.pop()
+            self.handles[node] = handle
+        else:
+            self.reserve(self.count + 1)
+            node = self.count
+            self.count += 1
+            self.handles.append(handle)
+        self.trs[node] = trs
+        self.parents[node] = parent
+        self.depths[node] = 0 if parent < 0 else self.depths[parent] + 1
+        self.flags[node] = ALIVE | LOCAL_DIRTY
+        self.dirty = True
+        self.levels = None
+        return node
+
+    def allocate_many(self, handles: list, parents, trs) -> np.ndarray:
+        # Rows for many nodes at once, parents have to be allocated already (or be earlier in this batch)
+        n = len(handles)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+        parents = np.broadcast_to(np.asarray(parents, dtype=np.int32), (n,))
+        self.reserve(self.count + n)
+        nodes = np.arange(self.count, self.count + n)
+        self.count += n
+        self.handles.extend(handles)
+        self.trs[nodes] = trs
+        self.parents[nodes] = parents
+        self.flags[nodes] = ALIVE | LOCAL_DIRTY
+        # Parents inside the batch come first, so depths can be filled in order of the parents' depths
+        depths = np.zeros(n, dtype=np.int32)
+        has_parent = parents >= 0
+        inside = has_parent & (parents >= nodes[0])
+        depths[has_parent & ~inside] = self.depths[parents[has_parent & ~inside]] + 1
+        for row in np.flatnonzero(inside).tolist():
+            depths[row] = depths[parents[row] - nodes[0]] + 1
+        self.depths[nodes] = depths
+        self.dirty = True
+        self.levels = None
+        return nodes
+
+    def release(self, nodes):
+        nodes = np.atleast_1d(np.asarray(nodes, dtype=np.int64))
+        self.flags[nodes] = 0
+        self.parents[nodes] = -1
+        self.moved[nodes] = False
+        for node in nodes.tolist():
+            self.handles[node] = None
+        self.free_ids.extend(nodes.tolist())
+        self.levels = None
+
+    def mark(self, node: int):
+        self.flags[node] |= LOCAL_DIRTY
+        self.dirty = True
+
+    def mark_many(self, nodes):
+        self.flags[nodes] |= LOCAL_DIRTY
+        self.dirty = True
+
+    def get_levels(self) -> list:
+        if self.levels is None:
+            alive = np.flatnonzero(self.flags[:self.count] & ALIVE)
+            depths = self.depths[alive]
+            order = alive[np.argsort(depths, kind="stable")]
+            counts = np.bincount(depths) if len(depths) else np.zeros(0, dtype=np.int64)
+            self.levels = np.split(order, np.cumsum(counts)[:-1]) if len(counts) else []
+        return self.levels
+
+    def update(self):
+        # World matrices of the dirty nodes and everything below them, a level at a time
+        if not self.dirty:
+            return
+        n = self.count
+        changed = (self.flags[:n] & LOCAL_DIRTY) != 0
+        self.flags[:n] &= ~np.uint8(LOCAL_DIRTY)
+
+        for level in self.get_levels():
+            parents = self.parents[level]
+            update = changed[level] | ((parents >= 0) & changed[parents])
+            if not update.any():
+                continue
+            nodes = level[update]
+            parents = parents[update]
+            trs = self.trs[nodes]
+            local = transforms.compose_matrices(trs[:, 0], trs[:, 1], trs[:, 2])
+            # Roots only exist on the first level
+            if parents[0] < 0:
+                self.world[nodes] = local
+            else:
+                self.world[nodes] = np.matmul(self.world[parents], local)
+            changed[nodes] = True
+        self.moved[:n] |= changed
+        self.dirty = False
+
+    def take_moved(self) -> np.ndarray:
+        nodes = np.flatnonzero(self.moved[:self.count])
+        self.moved[nodes] = False
+        return nodes
+
+class SceneNode:
+    # Thin handle onto one SceneStore row. Until the node is attached to a store (and after it is released)
+    # its position / angle / scale are kept in a small local array instead
+    __slots__ = ("store", "node", "detached")
+
+    def init_transform(self, position, angle, scale):
+        self.store = None
+        self.node = None
+        self.detached = np.array([tuple(position), tuple(angle), tuple(scale)], dtype=np.float32)
+
+    def attach_node(self, store: SceneStore, parent: int):
+        if self.node is not None:
+            return
+        self.node = store.allocate(self, parent, self.detached)
+        self.store = store
+        self.detached = None
+
+    @staticmethod
+    def attach_many(handles: list, store: SceneStore, parents, trs):
+        # attach_node for many detached handles at once, trs is (N, 3, 3) or broadcastable to it
+        nodes = store.allocate_many(handles, parents, np.broadcast_to(np.asarray(trs, dtype=np.float32), (len(handles), 3, 3)))
+        for handle, node in zip(handles, nodes.tolist()):
+            handle.store = store
+            handle.node = node
+            handle.detached = None
+        return nodes
+
+    def release_node(self):
+        if self.node is None:
+            return
+        self.detached = self.store.trs[self.node].copy()
+        self.store.release(self.node)
+        self.store = None
+        self.node = None
+
+    def get_trs(self) -> np.ndarray:
+        # (3, 3) view of [position, angle, scale], call changed_trs() after writing to it
+        return self.detached if self.node is None else self.store.trs[self.node]
+
+    def changed_trs(self):
+        if self.node is not None:
+            self.store.mark(self.node)
+
+    def get_local_array(self) -> np.ndarray:
+        trs = self.get_trs()
+        return transforms.compose_matrices(trs[0], trs[1], trs[2])[0]
+
+    def get_world_array(self) -> np.ndarray:
+        # Row-major world matrix, a view into the store: copy it to keep it past the next change
+        if self.node is None:
+            return self.get_local_array()
+        self.store.update()
+        return self.store.world[self.node]
+
+def assign_poses(handles: list, positions, angles):
+    # obj.position = positions[i]; obj.angle = angles[i] for every handle that is not None, handles attached to a
+    # store are written with one fancy-indexed assignment (physics write back)
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    angles = np.asarray(angles, dtype=np.float32).reshape(-1, 3)
+    rows = []
+    nodes = []
+    store = None
+    for row, handle in enumerate(handles):
+        if handle is None:
+            continue
+        if handle.node is None or (store is not None and handle.store is not store):
+            trs = handle.get_trs()
+            trs[0] = positions[row]
+            trs[1] = angles[row]
+            handle.changed_trs()
+            continue
+        store = handle.store
+        rows.append(row)
+        nodes.append(handle.node)
+    if nodes:
+        store.trs[nodes, 0] = positions[rows]
+        store.trs[nodes, 1] = angles[rows]
+        store.mark_many(nodes)
@@ -1,5 +1,10 @@
 from OpenGL.GL import *
+from OpenGL.error import GLError
+from Graphics.Utils import profiler
+from typing import Optional
 import ctypes
+import hashlib
+import os
 import numpy as np
 
 # Default vertex shader (used for basic setups)
@@ -9,8 +14,12 @@ default_vertex_shader = """
     layout(location = 1) in vec3 aNormal;
 
     uniform mat4 model;
-    uniform mat4 view;
-    uniform mat4 projection;
+    // Shared by every program, filled once per frame (see UniformBuffer)
+    layout(std140) uniform Camera {
+        mat4 view;
+        mat4 projection;
+        vec4 cameraPosition;
+    };
 
     out vec3 Normal;
     out vec3 FragPos;
@@ -22,6 +31,33 @@ default_vertex_shader = """
     }
 """
 
+# Vertex shader for InstancedGroup, the per-instance model matrix comes from an instanced attribute (locations 2-5)
+instanced_vertex_shader = """
+    #version 330 core
+    layout(location = 0) in vec3 aPos;
+    layout(location = 1) in vec3 aNormal;
+    layout(location = 2) in mat4 aInstanceModel;
+
+    uniform mat4 model; // world transform of the group
+    uniform mat4 local; // local transform of the mesh
+    // Shared by every program, filled once per frame (see UniformBuffer)
+    layout(std140) uniform Camera {
+        mat4 view;
+        mat4 projection;
+        vec4 cameraPosition;
+    };
+
+    out vec3 Normal;
+    out vec3 FragPos;
+
+    void main() {
+        mat4 instanceModel = model * aInstanceModel * local;
+        FragPos = vec3(instanceModel * vec4(aPos, 1.0));
+        Normal = mat3(transpose(inverse(instanceModel))) * aNormal;
+        gl_Position = projection * view * vec4(FragPos, 1.0);
+    }
+"""
+
 # Default fragment shader
 default_fragment_shader = """
     #version 330 core
@@ -38,34 +74,57 @@ default_fragment_shader = """
     uniform float roughness;
     uniform float reflectiveness;
 
-    // Lighting structures (from application)
-    struct Light {
-        vec3 position; // Light position
-        vec3 color; // Light color
-        float intensity; // Light intensity
-        float constant; // Constant attenuation factor
-        float linear; // Linear attenuation factor
-        float quadratic; // Quadratic attenuation factor
+    // Lights are stored in a texture buffer, 3 texels per light matching light_dtype:
+    // (position, intensity), (color, radius), (constant, linear, quadratic, unused)
+    uniform samplerBuffer lightData;
+    // Per cluster (first index, count) into clusterLights, which holds light numbers (see lights.py)
+    uniform usamplerBuffer clusterRanges;
+    uniform usamplerBuffer clusterLights;
+
+    // Shared by every program, filled once per frame (see UniformBuffer)
+    layout(std140) uniform Lights {
+        uvec4 clusterGrid; // Tiles across, tiles down, depth slices, light count
+        vec4 clusterDepth; // Near plane, far plane, slice scale, slice bias
+        vec4 viewport; // x, y, width, height of the view the clusters were built for
     };
 
-    uniform Light lights[10]; // Array of 10 lights (you can increase this number as needed)
-    uniform int lightCount; // Number of lights active in the scene
+    int find_cluster() {
+        // View space depth from the depth buffer value, slices are spaced exponentially between near and far
+        float near = clusterDepth.x;
+        float far = clusterDepth.y;
+        float depth = near * far / (far - gl_FragCoord.z * (far - near));
+        int slice = clamp(int(log(depth) * clusterDepth.z - clusterDepth.w), 0, int(clusterGrid.z) - 1);
+
+        vec2 tile = (gl_FragCoord.xy - viewport.xy) / viewport.zw * vec2(clusterGrid.xy);
+        ivec2 cell = clamp(ivec2(tile), ivec2(0), ivec2(clusterGrid.xy) - 1);
+        return cell.x + int(clusterGrid.x) * (cell.y + int(clusterGrid.y) * slice);
+    }
 
     void main() {
         vec3 finalColor = vec3(0.0); // Initialize final color as black (no light)
+        vec3 normal = normalize(Normal);
+
+        // Only the lights whose radius reaches this fragment's cluster are visited
+        uvec2 range = texelFetch(clusterRanges, find_cluster()).xy;
+        for (uint i = 0u; i < range.y; i++) {
+            int light = int(texelFetch(clusterLights, int(range.x + i)).r) * 3;
+            vec4 positionIntensity = texelFetch(lightData, light);
+            vec4 colorRadius = texelFetch(lightData, light + 1);
+            vec4 falloff = texelFetch(lightData, light + 2);
 
-        // Loop over all lights in the scene
-        for (int i = 0; i < lightCount; i++) {
             // Calculate direction from fragment to light
-            vec3 lightDir = normalize(lights[i].position - FragPos);
-            float diff = max(dot(normalize(Normal), lightDir), 0.0); // Diffuse lighting
+            vec3 lightDir = normalize(positionIntensity.xyz - FragPos);
+            float diff = max(dot(normal, lightDir), 0.0); // Diffuse lighting
 
             // Attenuation calculation: distance-based reduction of light intensity
-            float distance = length(lights[i].position - FragPos);
-            float attenuation = 1.0 / (lights[i].constant + lights[i].linear * distance + lights[i].quadratic * (distance * distance));
+            float distance = length(positionIntensity.xyz - FragPos);
+            float attenuation = 1.0 / (falloff.x + falloff.y * distance + falloff.z * (distance * distance));
+            // Fades to exactly zero at the radius, lights are not assigned to clusters past it
+            float window = clamp(1.0 - pow(distance / colorRadius.w, 4.0), 0.0, 1.0);
+            attenuation *= window * window;
 
             // Add the light's contribution to the final color (with attenuation and intensity)
-            finalColor += diff * lights[i].color * lights[i].intensity * attenuation;
+            finalColor += diff * colorRadius.rgb * positionIntensity.w * attenuation;
         }
 
         // Apply the final color to the fragment
@@ -74,67 +133,337 @@ default_fragment_shader = """
 
 """
 
+# Uniform blocks shared by all programs and the binding point each one is attached to
+CAMERA_BINDING = 0
+LIGHTS_BINDING = 1
+UNIFORM_BLOCKS = {"Camera": CAMERA_BINDING, "Lights": LIGHTS_BINDING}
+
+# Texture buffers shared by all programs and the texture unit each one is bound to. The last units are used
+# so material textures can keep counting from 0
+TEXTURE_BUFFERS = {"lightData": 13, "clusterRanges": 14, "clusterLights": 15}
+
+# std140 layouts of the blocks above, mat4 are stored column-major
+camera_block_dtype = np.dtype([
+    ("view", np.float32, (16,)),
+    ("projection", np.float32, (16,)),
+    ("position", np.float32, (4,))
+])
+
+light_dtype = np.dtype([
+    ("position", np.float32, (3,)),
+    ("intensity", np.float32),
+    ("color", np.float32, (3,)),
+    ("radius", np.float32),
+    ("constant", np.float32),
+    ("linear", np.float32),
+    ("quadratic", np.float32),
+    ("pad", np.float32)
+])
+
+lights_block_dtype = np.dtype([
+    ("clusterGrid", np.uint32, (4,)),
+    ("clusterDepth", np.float32, (4,)),
+    ("viewport", np.float32, (4,))
+])
+
+class UniformBuffer:
+    def __init__(self, dtype: np.dtype, binding: int):
+        # One std140 block backed by a NumPy structured array, edit self.data then call upload()
+        self.data = np.zeros(1, dtype=dtype)
+        self.binding = binding
+        self.id = None
+        self.uploaded = None
+
+    def upload(self):
+        if self.id is None:
+            self.id = glGenBuffers(1)
+            glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+            glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+            glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.id)
+        elif np.array_equal(self.uploaded, self.data.view(np.uint8)):
+            # Nothing changed since last frame
+            return
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.id)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        profiler.count("uploaded_bytes", self.data.nbytes)
+        self.uploaded = self.data.view(np.uint8).copy()
+
+class TextureBuffer:
+    def __init__(self, internal_format, unit: int):
+        # A buffer object read in shaders through texelFetch on a samplerBuffer, kept bound to its texture unit
+        self.internal_format = internal_format
+        self.unit = unit
+        self.id = None
+        self.texture = None
+
+    def upload(self, data: np.ndarray):
+        if self.id is None:
+            self.id = glGenBuffers(1)
+            self.texture = glGenTextures(1)
+            glActiveTexture(GL_TEXTURE0 + self.unit)
+            glBindTexture(GL_TEXTURE_BUFFER, self.texture)
+            glBindBuffer(GL_TEXTURE_BUFFER, self.id)
+            glTexBuffer(GL_TEXTURE_BUFFER, self.internal_format, self.id)
+            glActiveTexture(GL_TEXTURE0)
+
+        # New storage every upload, the driver orphans the old one instead of waiting for draws still reading it
+        glBindBuffer(GL_TEXTURE_BUFFER, self.id)
+        glBufferData(GL_TEXTURE_BUFFER, data.nbytes, data, GL_STREAM_DRAW)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+        profiler.count("uploaded_bytes", data.nbytes)
+
+    def delete(self):
+        if self.id is not None:
+            glDeleteTextures([self.texture])
+            glDeleteBuffers(1, [self.id])
+            self.id = None
+            self.texture = None
+
+def compile_shader(shader_type, source: str):
+    shader = glCreateShader(shader_type)
+    glShaderSource(shader, source)
+    glCompileShader(shader)
+    if not glGetShaderiv(shader, GL_COMPILE_STATUS):
+        kind = "Vertex" if shader_type == GL_VERTEX_SHADER else "Fragment"
+        print(f"ERROR: {kind} Shader compilation failed\n{glGetShaderInfoLog(shader)}")
+    return shader
+
+def link_program(vertex_shader_source: str, fragment_shader_source: str, retrievable: bool = False):
+    # Compile Vertex and Fragment Shader
+    vertex_shader = compile_shader(GL_VERTEX_SHADER, vertex_shader_source)
+    fragment_shader = compile_shader(GL_FRAGMENT_SHADER, fragment_shader_source)
+
+    # Link shaders into a program
+    shader_program = glCreateProgram()
+    if retrievable:
+        # Lets the driver keep the binary around for glGetProgramBinary
+        glProgramParameteri(shader_program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    glAttachShader(shader_program, vertex_shader)
+    glAttachShader(shader_program, fragment_shader)
+    glLinkProgram(shader_program)
+
+    if not glGetProgramiv(shader_program, GL_LINK_STATUS):
+        print(f"ERROR: Shader program linking failed\n{glGetProgramInfoLog(shader_program)}")
+
+    glDeleteShader(vertex_shader)
+    glDeleteShader(fragment_shader)
+    return shader_program
+
+def program_key(vertex_shader_source: str, fragment_shader_source: str) -> str:
+    digest = hashlib.sha1(vertex_shader_source.encode())
+    digest.update(b"\0")
+    digest.update(fragment_shader_source.encode())
+    return digest.hexdigest()
+
+class ProgramBinaryCache:
+    # Linked programs saved with glGetProgramBinary, one file per source hash and driver. A binary the driver
+    # refuses (driver update, different GPU) is ignored and the program is rebuilt from source.
+    MAGIC = b"GLPROG01"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.driver = None
+
+    def path(self, key: str) -> str:
+        if self.driver is None:
+            # Binaries are only valid for the driver that produced them, needs a current context
+            renderer = f"{glGetString(GL_VENDOR)}|{glGetString(GL_RENDERER)}|{glGetString(GL_VERSION)}"
+            self.driver = hashlib.sha1(renderer.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, f"{key}-{self.driver}.bin")
+
+    def load(self, key: str):
+        # Program id linked from the cached binary, None when there is none or the driver rejected it. Rejected
+        # files are deleted, the program built from source replaces them
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        if len(data) < 12 or data[:8] != self.MAGIC:
+            self.discard(path)
+            return None
+        binary_format = int(np.frombuffer(data, dtype="<u4", count=1, offset=8)[0])
+        binary = np.frombuffer(data, dtype=np.uint8, offset=12)
+
+        program = glCreateProgram()
+        try:
+            # A format the driver doesn't know (anymore) is GL_INVALID_ENUM, raised by PyOpenGL's error checking
+            glProgramBinary(program, binary_format, binary.ctypes.data_as(ctypes.c_void_p), len(binary))
+            linked = glGetProgramiv(program, GL_LINK_STATUS)
+        except GLError:
+            linked = False
+        if not linked:
+            glDeleteProgram(program)
+            self.discard(path)
+            return None
+        return program
+
+    def discard(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def store(self, key: str, program):
+        length = int(glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH))
+        if length == 0:
+            # Driver without program binary support
+            return
+        binary = np.zeros(length, dtype=np.uint8)
+        written = GLsizei(0)
+        binary_format = GLenum(0)
+        glGetProgramBinary(program, length, ctypes.byref(written), ctypes.byref(binary_format), binary.ctypes.data_as(ctypes.c_void_p))
+
+        path = self.path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(self.MAGIC)
+            file.write(np.array([binary_format.value], dtype="<u4").tobytes())
+            file.write(binary[:written.value].tobytes())
+        os.replace(temporary, path)
+
+class ShaderProgram:
+    # A linked program, shared by every material built from the same sources. Uniform locations and the values
+    # last uploaded live here because uniform state belongs to the program, not to the material
+    def __init__(self, vertex_shader_source: str, fragment_shader_source: str, binary_cache: Optional[ProgramBinaryCache] = None):
+        self.key = program_key(vertex_shader_source, fragment_shader_source)
+        self.id = binary_cache.load(self.key) if binary_cache is not None else None
+        self.from_binary = self.id is not None
+        if self.id is None:
+            self.id = link_program(vertex_shader_source, fragment_shader_source, retrievable=binary_cache is not None)
+            if binary_cache is not None and glGetProgramiv(self.id, GL_LINK_STATUS):
+                binary_cache.store(self.key, self.id)
+
+        self.bind_uniform_blocks()
+        # name -> location of every active uniform
+        self.uniforms = self.read_uniforms()
+        # name -> float32 buffer holding the last value uploaded, used to skip redundant uploads
+        self.uniform_values = {}
+
+    def bind_uniform_blocks(self):
+        # Attach the shared blocks this program uses to their global binding points
+        for block, binding in UNIFORM_BLOCKS.items():
+            index = glGetUniformBlockIndex(self.id, block)
+            if index != GL_INVALID_INDEX:
+                glUniformBlockBinding(self.id, index, binding)
+
+        # Same for the shared texture buffers, sampler uniforms keep their unit for the life of the program
+        glUseProgram(self.id)
+        for sampler, unit in TEXTURE_BUFFERS.items():
+            location = glGetUniformLocation(self.id, sampler)
+            if location != -1:
+                glUniform1i(location, unit)
+        glUseProgram(0)
+
+    def read_uniforms(self):
+        # Query every active uniform once after linking instead of calling glGetUniformLocation per upload
+        uniforms = {}
+        for index in range(glGetProgramiv(self.id, GL_ACTIVE_UNIFORMS)):
+            name, size, type = glGetActiveUniform(self.id, index)
+            if isinstance(name, bytes):
+                name = name.rstrip(b"\x00").decode()
+
+            location = glGetUniformLocation(self.id, name)
+            if location == -1:
+                # Members of uniform blocks have no location
+                continue
+            uniforms[name] = location
+
+            # Arrays are reported once as "name[0]", register the bare name and every element
+            if name.endswith("[0]"):
+                base = name[:-3]
+                uniforms[base] = location
+                for element in range(1, size):
+                    uniforms[f"{base}[{element}]"] = glGetUniformLocation(self.id, f"{base}[{element}]")
+        return uniforms
+
 class Material:
-    def __init__(self, albedo: tuple = (1.0, 1.0, 1.0), roughness: float = 0.5, reflectiveness: float = 0.5, vertex_shader: str = default_vertex_shader, fragment_shader: str = default_fragment_shader):
+    def __init__(self, albedo: tuple = (1.0, 1.0, 1.0), roughness: float = 0.5, reflectiveness: float = 0.5, vertex_shader: str = default_vertex_shader, fragment_shader: str = default_fragment_shader, program: Optional[ShaderProgram] = None):
         # Material properties (color, roughness, reflectiveness)
         self.albedo = albedo
         self.roughness = roughness
         self.reflectiveness = reflectiveness
-        self.id = self.bake(vertex_shader, fragment_shader)
+        # Materials made through shaderManager share the program of identical sources, standalone ones bake their own
+        if program is not None:
+            self.adopt(program)
+        else:
+            self.bake(vertex_shader, fragment_shader)
 
     def bake(self, vertex_shader_source: str, fragment_shader_source: str):
-        # Compile Vertex Shader
-        vertex_shader = glCreateShader(GL_VERTEX_SHADER)
-        glShaderSource(vertex_shader, vertex_shader_source)
-        glCompileShader(vertex_shader)
-        if not glGetShaderiv(vertex_shader, GL_COMPILE_STATUS):
-            print(f"ERROR: Vertex Shader compilation failed\n{glGetShaderInfoLog(vertex_shader)}")
-        
-        # Compile Fragment Shader
-        fragment_shader = glCreateShader(GL_FRAGMENT_SHADER)
-        glShaderSource(fragment_shader, fragment_shader_source)
-        glCompileShader(fragment_shader)
-        if not glGetShaderiv(fragment_shader, GL_COMPILE_STATUS):
-            print(f"ERROR: Fragment Shader compilation failed\n{glGetShaderInfoLog(fragment_shader)}")
-
-        # Link shaders into a program
-        shader_program = glCreateProgram()
-        glAttachShader(shader_program, vertex_shader)
-        glAttachShader(shader_program, fragment_shader)
-        glLinkProgram(shader_program)
-
-        if not glGetProgramiv(shader_program, GL_LINK_STATUS):
-            print(f"ERROR: Shader program linking failed\n{glGetProgramInfoLog(shader_program)}")
-
-
-        glDeleteShader(vertex_shader)
-        glDeleteShader(fragment_shader)
-        return shader_program
+        self.adopt(ShaderProgram(vertex_shader_source, fragment_shader_source))
+        return self.id
+
+    def adopt(self, program: ShaderProgram):
+        self.program = program
+        self.id = program.id
+        self.uniforms = program.uniforms
+        self.uniform_values = program.uniform_values
+
+    def get_location(self, name):
+        if isinstance(name, bytes):
+            name = name.decode()
+        return name, self.uniforms.get(name, -1)
+
+    def get_buffer(self, name, shape):
+        # Preallocated upload buffer per uniform, starts as NaN so the first upload is never skipped
+        buffer = self.uniform_values.get(name)
+        if buffer is None:
+            buffer = self.uniform_values[name] = np.full(shape, np.nan, dtype=np.float32)
+        return buffer
 
     def use(self):
-        # Use the compiled shader program
+        # Use the compiled shader program, with this material's values since the program may be shared
         glUseProgram(self.id)
-        
+        self.set_material_properties()
 
     def set_mat4(self, name, mat):
-        location = glGetUniformLocation(self.id, name)
+        name, location = self.get_location(name)
         if location == -1:
             print(f"[GL ⚠] Uniform '{name}' not found in shader ID {self.id}. Did you bind the shader? Is the uniform used?")
             raise RuntimeError(f"Uniform '{name}' not found in shader ID {self.id}")
-        if isinstance(mat, np.ndarray):
-            glUniformMatrix4fv(location, 1, GL_TRUE, mat.astype(np.float32))
-        else:
-            glUniformMatrix4fv(location, 1, GL_TRUE, np.array(mat.to_list(), dtype=np.float32))
-
 
+        # Row-major values (NumPy arrays or glm matrices), uploaded with transpose = GL_TRUE
+        value = np.asarray(mat, dtype=np.float32).reshape(4, 4)
+        buffer = self.get_buffer(name, (4, 4))
+        if np.array_equal(buffer, value):
+            profiler.count("uniform_skipped")
+            return
+        buffer[...] = value
+        glUniformMatrix4fv(location, 1, GL_TRUE, buffer)
+        profiler.count("uniform_uploads")
+        profiler.count("uploaded_bytes", 64)
 
     def set_vec3(self, name, vec):
         # Set a 3D vector uniform (for colors, light directions, etc.)
-        glUniform3f(glGetUniformLocation(self.id, name), vec[0], vec[1], vec[2])
+        name, location = self.get_location(name)
+        if location == -1:
+            return
+        buffer = self.get_buffer(name, 3)
+        if buffer[0] == vec[0] and buffer[1] == vec[1] and buffer[2] == vec[2]:
+            profiler.count("uniform_skipped")
+            return
+        buffer[:] = (vec[0], vec[1], vec[2])
+        glUniform3fv(location, 1, buffer)
+        profiler.count("uniform_uploads")
+        profiler.count("uploaded_bytes", 12)
 
     def set_float(self, name, value):
         # Set a float uniform (for roughness, reflectiveness, etc.)
-        glUniform1f(glGetUniformLocation(self.id, name), value)
+        name, location = self.get_location(name)
+        if location == -1:
+            return
+        buffer = self.get_buffer(name, 1)
+        if buffer[0] == value:
+            profiler.count("uniform_skipped")
+            return
+        buffer[0] = value
+        glUniform1fv(location, 1, buffer)
+        profiler.count("uniform_uploads")
+        profiler.count("uploaded_bytes", 4)
 
     def set_material_properties(self):
         # Send material properties to shader
@@ -143,18 +472,32 @@ class Material:
         self.set_float("reflectiveness", self.reflectiveness)
 
 class shaderManager:
-    def __init__(self):
+    def __init__(self, cache_dir: Optional[str] = None):
         # Shader manager that stores all materials
         self.shaders = {}
+        # Source hash -> program, materials with the same sources share one program
+        self.programs = {}
+        # Linked program binaries are kept in cache_dir to skip the GLSL compiler on the next start
+        self.binary_cache = ProgramBinaryCache(cache_dir) if cache_dir is not None else None
+        # Per-frame data shared by all materials
+        self.camera_buffer = UniformBuffer(camera_block_dtype, CAMERA_BINDING)
+        self.lights_buffer = UniformBuffer(lights_block_dtype, LIGHTS_BINDING)
+
+    def get_program(self, vertex_shader_source: str, fragment_shader_source: str) -> ShaderProgram:
+        key = program_key(vertex_shader_source, fragment_shader_source)
+        if key not in self.programs:
+            self.programs[key] = ShaderProgram(vertex_shader_source, fragment_shader_source, self.binary_cache)
+        return self.programs[key]
 
     def add_shader(self, material_dict: dict):
         # Add material based on dict (can be loaded from JSON)
+        vertex_shader = default_vertex_shader if not "vertex" in material_dict else material_dict["vertex"]
+        fragment_shader = default_fragment_shader if not "fragment" in material_dict else material_dict["fragment"]
         self.shaders[material_dict["name"]] = Material(
             albedo=material_dict["albedo"],
             roughness=material_dict["roughness"],
             reflectiveness=material_dict["reflectiveness"],
-            vertex_shader= default_vertex_shader if not "vertex" in material_dict else material_dict["vertex"],
-            fragment_shader= default_fragment_shader if not "fragment" in material_dict else material_dict["fragment"]
+            program=self.get_program(vertex_shader, fragment_shader)
         )
 
 #albedo: tuple = (1.0, 1.0, 1.0), roughness: float = 0.5, reflectiveness: float = 0.5
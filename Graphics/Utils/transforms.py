@@ -0,0 +1,59 @@
+import numpy as np
+import glm
+
+# Vectorized versions of the transform maths used by Object and Mesh.
+# Matrices are row-major (N, 4, 4) float32 arrays, built in the same order as
+# get_model_matrix: translate * rotateX * rotateY * rotateZ * scale, angles in degrees.
+
+def rotation_matrices(angles) -> np.ndarray:
+    angles = np.radians(np.asarray(angles, dtype=np.float32).reshape(-1, 3))
+    c = np.cos(angles)
+    s = np.sin(angles)
+    n = len(angles)
+
+    rx = np.zeros((n, 3, 3), dtype=np.float32)
+    rx[:, 0, 0] = 1.0
+    rx[:, 1, 1] = c[:, 0]
+    rx[:, 1, 2] = -s[:, 0]
+    rx[:, 2, 1] = s[:, 0]
+    rx[:, 2, 2] = c[:, 0]
+
+    ry = np.zeros((n, 3, 3), dtype=np.float32)
+    ry[:, 1, 1] = 1.0
+    ry[:, 0, 0] = c[:, 1]
+    ry[:, 0, 2] = s[:, 1]
+    ry[:, 2, 0] = -s[:, 1]
+    ry[:, 2, 2] = c[:, 1]
+
+    rz = np.zeros((n, 3, 3), dtype=np.float32)
+    rz[:, 2, 2] = 1.0
+    rz[:, 0, 0] = c[:, 2]
+    rz[:, 0, 1] = -s[:, 2]
+    rz[:, 1, 0] = s[:, 2]
+    rz[:, 1, 1] = c[:, 2]
+
+    return rx @ ry @ rz
+
+def compose_matrices(positions, angles, scales) -> np.ndarray:
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    scales = np.asarray(scales, dtype=np.float32).reshape(-1, 3)
+
+    matrices = np.zeros((len(positions), 4, 4), dtype=np.float32)
+    # Scaling the columns of the rotation is the same as multiplying by the scale matrix on the right
+    matrices[:, :3, :3] = rotation_matrices(angles) * scales[:, None, :]
+    matrices[:, :3, 3] = positions
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+def column_major(matrices) -> np.ndarray:
+    # (N, 4, 4) row-major -> (N, 16) in the layout glsl expects for mat4 attributes and std140 blocks
+    matrices = np.asarray(matrices, dtype=np.float32).reshape(-1, 4, 4)
+    return np.ascontiguousarray(matrices.transpose(0, 2, 1)).reshape(-1, 16)
+
+def compose_matrix(position, angle, scale) -> glm.mat4:
+    # Single glm version of compose_matrices
+    model = glm.translate(glm.mat4(1.0), glm.vec3(position))
+    model = glm.rotate(model, glm.radians(angle[0]), glm.vec3(1, 0, 0))
+    model = glm.rotate(model, glm.radians(angle[1]), glm.vec3(0, 1, 0))
+    model = glm.rotate(model, glm.radians(angle[2]), glm.vec3(0, 0, 1))
+    return glm.scale(model, glm.vec3(scale))
@@ -0,0 +1,207 @@
+from Graphics.Utils.headless import select_platform
+
+# Engine benchmarks: scene building, Object.draw / draw_scene CPU time per frame, memory and shader baking.
+# Runs on an offscreen context (llvmpipe is fine) so results from different commits can be compared:
+#   python benchmark.py --output results.json
+#   python benchmark.py --sizes 1000 10000 --frames 20
+import argparse
+import gc
+import json
+import os
+import platform as host_platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# The platform has to be chosen before OpenGL is imported anywhere
+if __name__ == "__main__":
+    select_platform(os.environ.get("PYOPENGL_PLATFORM", "egl"))
+
+from OpenGL.GL import *
+from Graphics import Engine
+from Graphics.Utils import Shapes
+from Graphics.Utils.shader_utils import Material, default_vertex_shader, default_fragment_shader, instanced_vertex_shader
+from glm import vec3
+import numpy as np
+
+SIZES = [1000, 10000, 100000]
+LAYOUTS = ["flat", "deep", "bulk"]
+DEEP_CHAIN = 32  # nodes per chain in the deep layout, stays well below the recursion limit of Object.draw
+GRID_EXTENT = 40.0
+GRID_DISTANCE = 60.0
+
+def rss_bytes() -> int:
+    # Resident set size, Linux only (0 elsewhere)
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+def timings(samples: list) -> dict:
+    samples = np.asarray(samples, dtype=np.float64) * 1000.0
+    return {
+        "mean_ms": float(samples.mean()),
+        "median_ms": float(np.median(samples)),
+        "min_ms": float(samples.min()),
+        "max_ms": float(samples.max()),
+        "p95_ms": float(np.percentile(samples, 95))
+    }
+
+def build_scene(root: Engine.Root, shapes: int, layout: str):
+    # Every shape is a small cube on its own node, laid out on a grid that always fits the view.
+    # flat: all nodes are children of one top level object. deep: chains of DEEP_CHAIN nested nodes,
+    # with local positions chosen so the world layout is the same as the flat one. bulk: the flat scene built
+    # with a single Object.addChildren call.
+    side = int(np.ceil(np.sqrt(shapes)))
+    spacing = GRID_EXTENT / side
+    group = root.addObject(f"{layout}_{shapes}", position=vec3(-GRID_EXTENT * 0.5, -GRID_EXTENT * 0.5, -GRID_DISTANCE))
+    if layout == "bulk":
+        cells = np.arange(shapes)
+        positions = np.stack([cells % side, cells // side, np.zeros(shapes)], axis=1) * spacing
+        group.addChildren("node", positions, shape=Shapes.Cube(None, scale=vec3(spacing * 0.4)), shape_name="cube")
+        return group
+    parent = group
+    previous = vec3(0.0, 0.0, 0.0)
+    for i in range(shapes):
+        grid_position = vec3(i % side, i // side, 0.0) * spacing
+        if layout == "flat":
+            node = group.addChild(f"node_{i}", position=grid_position)
+        else:
+            if i % DEEP_CHAIN == 0:
+                parent = group.addChild(f"chain_{i // DEEP_CHAIN}")
+                previous = vec3(0.0, 0.0, 0.0)
+            node = parent.addChild(f"node_{i}", position=grid_position - previous)
+            parent = node
+            previous = grid_position
+        node.addShape("cube", Shapes.Cube(None, scale=vec3(spacing * 0.4)))
+    return group
+
+def bench_scene(shapes: int, layout: str, frames: int, width: int, height: int) -> dict:
+    root = Engine.Root(Width=width, Height=height, backend="headless")
+    root.addLight(vec3(0.0, 0.0, 5.0), intensity=5.0, radius=100.0)
+    gc.collect()
+
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+    build_scene(root, shapes, layout)
+    build_time = time.perf_counter() - start
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = rss_bytes()
+
+    # First frame uploads every mesh and builds the BVH, measured on its own
+    start = time.perf_counter()
+    root.update_frame_uniforms()
+    root.useShader("default")
+    root.root.draw()
+    glFinish()
+    first_frame = time.perf_counter() - start
+
+    # Plain recursive traversal, every shape is drawn
+    object_draw = []
+    for _ in range(frames):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        start = time.perf_counter()
+        root.root.draw()
+        object_draw.append(time.perf_counter() - start)
+        glFinish()
+
+    # Culled, state sorted path used by render_frame
+    draw_scene = []
+    root.draw_scene()
+    glFinish()
+    for _ in range(frames):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        start = time.perf_counter()
+        root.draw_scene()
+        draw_scene.append(time.perf_counter() - start)
+        glFinish()
+
+    result = {
+        "shapes": shapes,
+        "layout": layout,
+        "nodes": sum(1 for _ in root.root.walk()),
+        "build_s": build_time,
+        "build_us_per_shape": build_time / shapes * 1e6,
+        "memory": {
+            "python_bytes": traced,
+            "python_peak_bytes": traced_peak,
+            "python_bytes_per_shape": traced / shapes,
+            "rss_delta_bytes": rss_after - rss_before
+        },
+        "first_frame_ms": first_frame * 1000.0,
+        "object_draw": timings(object_draw),
+        "draw_scene": timings(draw_scene),
+        "visible": root.scene.visible_count,
+        "draw_calls": root.render_queue.draw_calls
+    }
+    root.stop()
+    return result
+
+def bench_bake(repeats: int, width: int, height: int) -> dict:
+    root = Engine.Root(Width=width, Height=height, backend="headless")
+    result = {}
+    for name, vertex in (("default", default_vertex_shader), ("instanced", instanced_vertex_shader)):
+        samples = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            material = Material(vertex_shader=vertex, fragment_shader=default_fragment_shader)
+            samples.append(time.perf_counter() - start)
+            glDeleteProgram(material.id)
+        result[name] = timings(samples)
+    root.stop()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless engine benchmarks, results as JSON")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="shape counts of the synthetic scenes")
+    parser.add_argument("--layouts", nargs="+", default=LAYOUTS, choices=LAYOUTS)
+    parser.add_argument("--frames", type=int, default=30, help="timed frames per scene")
+    parser.add_argument("--bake-repeats", type=int, default=10)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": host_platform.platform(),
+            "gl_platform": os.environ.get("PYOPENGL_PLATFORM", ""),
+            "frames": args.frames,
+            "resolution": [args.width, args.height]
+        },
+        "bake": bench_bake(args.bake_repeats, args.width, args.height),
+        "scenes": []
+    }
+
+    root = Engine.Root(Width=16, Height=16, backend="headless")
+    report["meta"]["gl_renderer"] = glGetString(GL_RENDERER).decode()
+    report["meta"]["gl_version"] = glGetString(GL_VERSION).decode()
+    root.stop()
+
+    for shapes in args.sizes:
+        for layout in args.layouts:
+            print(f"{layout} scene, {shapes} shapes", file=sys.stderr)
+            report["scenes"].append(bench_scene(shapes, layout, args.frames, args.width, args.height))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# Lets pytest import the Graphics package from the repository root without installing it. Tests run headless,
+# so the platform is selected here, before any test module imports OpenGL
+from Graphics.Utils.headless import select_platform
+import pytest
+
+select_platform()
+
+@pytest.fixture(scope="session")
+def root():
+    # One headless engine for every test needing a GL context, skipped where no EGL/OSMesa context can be made
+    try:
+        from Graphics import Engine
+        engine = Engine.Root(Width=96, Height=64, backend="headless")
+    except Exception as error:
+        pytest.skip(f"no headless GL context: {error}")
+    yield engine
+    engine.stop()
@@ -4,3 +4,5 @@ from glm import *
 import time
 
 MainRoot = Engine.Root(visuals_frequency = 120)
+
+MainRoot.run()
@@ -0,0 +1,56 @@
+from Graphics.Utils.assets import parse_obj, triangulate, load_mesh_data
+import numpy as np
+import pytest
+
+# OBJ face tokens are v, v/vt, v//vn or v/vt/vn, with 1-based or negative (relative to the vertices read so far)
+# vertex numbers. Every form has to end up as the same 0-based triangle list
+
+SQUARE = """v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vt 0 0
+vn 0 0 1
+"""
+
+def write_obj(tmp_path, faces: str):
+    path = tmp_path / "mesh.obj"
+    path.write_text(SQUARE + faces)
+    return str(path)
+
+@pytest.mark.parametrize("faces", [
+    "f 1 2 3\nf 1 3 4\n",
+    "f -4 -3 -2\nf -4 -2 -1\n",
+    "f 1/1 2/1 3/1\nf 1/1/1 3/1/1 4/1/1\n",
+    "f 1//1 -3//1 3//1\nf -4/1/1 3/1 4\n",
+    "f 1 2 3 4\n"
+])
+def test_parse_obj_face_tokens(tmp_path, faces):
+    positions, indices, normals = parse_obj(write_obj(tmp_path, faces))
+    assert positions.shape == (4, 3)
+    assert normals is None
+    assert indices.dtype == np.uint32
+    assert indices.tolist() == [0, 1, 2, 0, 2, 3]
+
+def test_parse_obj_negative_indices_are_relative_to_the_line(tmp_path):
+    # The second triangle's -3 -2 -1 are the three vertices defined right before it
+    path = tmp_path / "mesh.obj"
+    path.write_text("v 0 0 0\nv 1 0 0\nv 0 1 0\nf -3 -2 -1\nv 0 0 1\nv 1 0 1\nv 0 1 1\nf -3 -2 -1\n")
+    positions, indices, _ = parse_obj(str(path))
+    assert indices.tolist() == [0, 1, 2, 3, 4, 5]
+
+def test_load_mesh_data_with_negative_indices(tmp_path):
+    vertex_data, indices, _, _ = load_mesh_data(write_obj(tmp_path, "f -4 -3 -2\n"))
+    assert vertex_data.shape == (4, 6)
+    assert indices.tolist() == [0, 1, 2]
+
+@pytest.mark.parametrize("faces", ["f 0 1 2\n", "f -5 -2 -1\n", "f 1 2 9\n"])
+def test_out_of_range_indices_raise(tmp_path, faces):
+    with pytest.raises(ValueError):
+        load_mesh_data(write_obj(tmp_path, faces))
+
+def test_triangulate_fans_mixed_polygons():
+    indices = triangulate([[0, 1, 2], [3, 4, 5, 6, 7], [8, 9]])
+    assert indices.dtype == np.uint32
+    assert indices.reshape(-1, 3).tolist() == [[0, 1, 2], [3, 4, 5], [3, 5, 6], [3, 6, 7]]
+    assert triangulate([[-1, -2, -3]], np.int64).tolist() == [-1, -2, -3]
@@ -0,0 +1,85 @@
+from Graphics.Utils.batching import StaticBatch
+from Graphics.Utils import Shapes
+from glm import vec3
+import numpy as np
+import pytest
+
+# Removing members compacts the batch buffers in place: the result has to be exactly what merging the
+# remaining members from scratch gives, without merging. Members get a color of their own so the test owns
+# its batch
+
+COLOR = (0.25, 0.75, 0.5)
+
+def snapshot(batch):
+    return (batch.vertex_data.copy(), batch.indices.copy(), batch.first_vertex.copy(), batch.first_index.copy(),
+            batch.index_counts.copy(), batch.bounds_min.copy(), batch.bounds_max.copy())
+
+def check_matches_merge(batch):
+    compacted = snapshot(batch)
+    batch.merge()
+    for got, expected in zip(compacted, snapshot(batch)):
+        assert np.array_equal(got, expected)
+    assert all(batch.member_index[id(member)] == i for i, member in enumerate(batch.members))
+    assert len(batch.member_index) == len(batch.members) == len(batch.hidden)
+
+@pytest.fixture
+def level(root):
+    obj = root.addObject("batching_test", position=vec3(200, 0, 0))
+    for i in range(9):
+        child = obj.addChild(f"n{i}", position=vec3(i * 3 - 12, i % 2, 0), angle=vec3(0, i * 20, 0))
+        # Different vertex and index counts, so every removal shifts by a different amount
+        shape = Shapes.Cube(None, color=COLOR) if i % 2 else Shapes.Sphere(None, radius=0.5 + i * 0.1, slices=8 + i, stacks=4 + i, color=COLOR)
+        child.addShape("shape", shape)
+    obj.make_static()
+    yield obj
+    root.root.removeChild(obj.name)
+
+def get_batch(root) -> StaticBatch:
+    return root.static_batches.batches[("default", COLOR)]
+
+def test_remove_compacts_without_merging(root, level, monkeypatch):
+    batch = get_batch(root)
+    assert len(batch.members) == 9
+    merges = []
+    monkeypatch.setattr(StaticBatch, "merge", lambda self: merges.append(self))
+
+    # First, middle and last member
+    for name in ("n0", "n4", "n8"):
+        mesh = level.children[name].shapes["shape"]
+        level.removeChild(name)
+        assert mesh.static_batch is None and id(mesh) not in batch.member_index
+    assert merges == [] and len(batch.members) == 6
+    monkeypatch.undo()
+    check_matches_merge(batch)
+
+def test_remove_keeps_hidden_members_and_runs(root, level):
+    batch = get_batch(root)
+    level.children["n2"].set_static_hidden(True)
+    level.children["n6"].set_static_hidden(True)
+    level.removeChild("n3")
+    hidden = [member.object.name for member, flag in zip(batch.members, batch.hidden) if flag]
+    assert hidden == ["n2", "n6"]
+
+    # Runs skip exactly the hidden members' ranges
+    counts, offsets = batch.get_runs()
+    visible = [i for i in range(len(batch.members)) if not batch.hidden[i]]
+    assert counts.sum() == batch.index_counts[visible].sum()
+    assert offsets[0] == 0 and len(counts) == 3
+    check_matches_merge(batch)
+
+def test_rebuild_after_remove_stays_in_place(root, level):
+    batch = get_batch(root)
+    level.removeChild("n1")
+    moved = level.children["n5"]
+    moved.position = vec3(0, 6, 4)
+    moved.rebuild_static()
+    mesh = moved.shapes["shape"]
+    index = batch.member_index[id(mesh)]
+    start = int(batch.first_vertex[index])
+    assert np.allclose(batch.vertex_data[start:start + mesh.vertex_count, 0:3].mean(axis=0), np.asarray(moved.get_world_matrix())[:3, 3], atol=0.5)
+    check_matches_merge(batch)
+
+def test_removing_every_member_deletes_the_batch(root, level):
+    for name in list(level.children):
+        level.removeChild(name)
+    assert ("default", COLOR) not in root.static_batches.batches
@@ -0,0 +1,123 @@
+from Graphics.Physics import BOX, SPHERE, SpatialHashGrid, collide
+import numpy as np
+import pytest
+
+# Broad phase against a brute force O(n^2) AABB overlap test while boxes move across cell boundaries, and the
+# narrow phase contacts of every collider combination
+
+def brute_force(bodies, mins, maxs) -> set:
+    pairs = set()
+    for a in range(len(bodies)):
+        for b in range(a + 1, len(bodies)):
+            if (mins[a] <= maxs[b]).all() and (mins[b] <= maxs[a]).all():
+                pairs.add((min(bodies[a], bodies[b]), max(bodies[a], bodies[b])))
+    return pairs
+
+def grid_pairs(grid, bodies, mins, maxs) -> set:
+    i, j = grid.update(bodies, mins, maxs)
+    pairs = [(min(a, b), max(a, b)) for a, b in zip(i.tolist(), j.tolist())]
+    # Every pair once, never a body with itself
+    assert len(set(pairs)) == len(pairs)
+    assert all(a != b for a, b in pairs)
+    return set(pairs)
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(3)
+
+def test_update_matches_brute_force_while_bodies_move(rng):
+    count = 200
+    # Body ids with gaps, as when only some bodies have colliders
+    bodies = np.sort(rng.choice(1000, count, replace=False))
+    centers = rng.uniform(-10, 10, (count, 3))
+    extents = rng.uniform(0.1, 0.6, (count, 3))
+    grid = SpatialHashGrid()
+    paths = set()
+
+    for step in range(40):
+        expected = brute_force(bodies, centers - extents, centers + extents)
+        assert grid_pairs(grid, bodies, centers - extents, centers + extents) == expected
+        assert grid.candidate_count == len(expected)
+        paths.add("rebuild" if grid.rebuilt else "move" if grid.moved_bodies else "still")
+        if step % 10 == 9:
+            # Most bodies jump: rebuilt from scratch
+            centers = centers + rng.uniform(-3, 3, (count, 3))
+        elif step % 3 == 0:
+            # Only positions inside their cells change: cached candidates, exact test only
+            centers = centers + rng.uniform(-1e-3, 1e-3, (count, 3))
+        else:
+            # A few bodies cross cell boundaries: moved in the sorted order
+            moving = rng.choice(count, 12, replace=False)
+            centers[moving] += rng.uniform(-1.5, 1.5, (12, 3))
+    assert {"rebuild", "move", "still"} <= paths
+
+def test_update_rebuilds_for_larger_bodies_and_new_sets(rng):
+    grid = SpatialHashGrid()
+    bodies = np.arange(50)
+    centers = rng.uniform(-5, 5, (50, 3))
+    extents = np.full((50, 3), 0.3)
+    grid_pairs(grid, bodies, centers - extents, centers + extents)
+    size = grid.cell_size
+
+    # A body larger than the cells grows them
+    extents[7] = 2.0
+    assert grid_pairs(grid, bodies, centers - extents, centers + extents) == brute_force(bodies, centers - extents, centers + extents)
+    assert grid.rebuilt and grid.cell_size > size
+
+    # A different set of bodies
+    bodies, centers, extents = bodies[::2], centers[::2], extents[::2]
+    assert grid_pairs(grid, bodies, centers - extents, centers + extents) == brute_force(bodies, centers - extents, centers + extents)
+    assert grid.rebuilt
+
+    # Fewer than two bodies have no pairs
+    assert grid_pairs(grid, bodies[:1], centers[:1] - extents[:1], centers[:1] + extents[:1]) == set()
+
+def contacts(positions, colliders, radii, half_extents, i, j):
+    positions = np.asarray(positions, dtype=np.float32)
+    colliders = np.asarray(colliders, dtype=np.int8)
+    radii = np.asarray(radii, dtype=np.float32)
+    half_extents = np.asarray(half_extents, dtype=np.float32)
+    return collide(positions, colliders, radii, half_extents, np.asarray(i), np.asarray(j))
+
+def test_collide_spheres():
+    positions = [[0, 0, 0], [1.5, 0, 0], [0, 0, 0], [10, 0, 0]]
+    a, b, normals, depths = contacts(positions, [SPHERE] * 4, [1.0, 1.0, 0.5, 1.0], np.ones((4, 3)), [0, 0, 2], [1, 2, 3])
+    # Touching pairs only, the normal points from a to b
+    assert a.tolist() == [0, 0] and b.tolist() == [1, 2]
+    assert np.allclose(normals[0], [1.0, 0.0, 0.0])
+    assert depths[0] == pytest.approx(0.5)
+    # Concentric spheres get a fixed normal
+    assert np.allclose(normals[1], [0.0, 1.0, 0.0])
+    assert depths[1] == pytest.approx(1.5)
+
+def test_collide_boxes_along_least_overlap():
+    positions = [[0, 0, 0], [0.5, -1.8, 0.2], [3, 0, 0]]
+    half_extents = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    a, b, normals, depths = contacts(positions, [BOX] * 3, np.zeros(3), half_extents, [0, 0], [1, 2])
+    assert a.tolist() == [0] and b.tolist() == [1]
+    # Overlaps are (1.5, 0.2, 1.8), y is the shallowest and b is below a
+    assert np.allclose(normals[0], [0.0, -1.0, 0.0])
+    assert depths[0] == pytest.approx(0.2)
+
+@pytest.mark.parametrize("order", ["box_first", "sphere_first"])
+def test_collide_sphere_and_box(order):
+    # Sphere 1 touches the box's +x face, sphere 2 its edge, sphere 3 is inside it, sphere 4 is clear
+    positions = [[0, 0, 0], [1.3, 0.2, 0], [1.3, 1.3, 0], [0, 0.7, 0], [0, 3, 0]]
+    colliders = [BOX, SPHERE, SPHERE, SPHERE, SPHERE]
+    radii = [0.0, 0.5, 0.5, 0.5, 0.5]
+    half_extents = [[1, 1, 1]] + [[0.5, 0.5, 0.5]] * 4
+    spheres = [1, 2, 3, 4]
+    boxes = [0] * 4
+    i, j = (boxes, spheres) if order == "box_first" else (spheres, boxes)
+    a, b, normals, depths = contacts(positions, colliders, radii, half_extents, i, j)
+
+    # Always reported as (box, sphere)
+    assert a.tolist() == [0, 0, 0] and b.tolist() == [1, 2, 3]
+    assert np.allclose(normals[0], [1.0, 0.0, 0.0])
+    assert depths[0] == pytest.approx(0.2)
+    diagonal = np.sqrt(2.0) * 0.3
+    assert np.allclose(normals[1], [np.sqrt(0.5), np.sqrt(0.5), 0.0])
+    assert depths[1] == pytest.approx(0.5 - diagonal)
+    # Center inside: pushed out through the nearest face, deep enough to clear it
+    assert np.allclose(normals[2], [0.0, 1.0, 0.0])
+    assert depths[2] == pytest.approx(0.3 + 0.5)
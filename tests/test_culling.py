@@ -0,0 +1,168 @@
+from Graphics.Utils.culling import SceneBVH, classify_aabbs, frustum_planes, transform_aabb
+from glm import lookAt, perspective, radians, vec3
+import numpy as np
+import pytest
+
+# BVH culling against a brute force test of every item box on its own: the BVH has to return exactly the items
+# whose box is not outside a frustum plane, whatever the tree looks like after adds, removes and refits
+
+class Box:
+    # Minimal BVH item
+    def __init__(self, center, extent):
+        self.center = np.asarray(center, dtype=np.float32)
+        self.extent = np.asarray(extent, dtype=np.float32)
+
+    def get_world_bounds(self):
+        return self.center - self.extent, self.center + self.extent
+
+def camera_planes(position=(0.0, 0.0, 0.0), target=(0.0, 0.0, -1.0), fov=60.0, far=60.0):
+    projection = perspective(radians(fov), 16.0 / 9.0, 0.1, far)
+    view = lookAt(vec3(*position), vec3(*target), vec3(0.0, 1.0, 0.0))
+    return frustum_planes(np.array(projection * view))
+
+def random_boxes(count, rng):
+    return [Box(rng.uniform(-40, 40, 3) - [0, 0, 20], rng.uniform(0.1, 4.0, 3)) for _ in range(count)]
+
+def brute_force(items, planes) -> set:
+    # Ids of the items whose box is not entirely behind one of the planes, box by box
+    visible = set()
+    for item in items:
+        mins, maxs = item.get_world_bounds()
+        corners = np.array([[x, y, z] for x in (mins[0], maxs[0]) for y in (mins[1], maxs[1]) for z in (mins[2], maxs[2])])
+        distances = corners @ planes[:, :3].T + planes[:, 3]
+        if not (distances < 0.0).all(axis=0).any():
+            visible.add(id(item))
+    return visible
+
+def culled(scene, planes) -> set:
+    visible = scene.cull(planes)
+    assert len(visible) == scene.visible_count == len(scene.visible_indices)
+    assert len({id(item) for item in visible}) == len(visible)
+    return {id(item) for item in visible}
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(11)
+
+def test_classify_aabbs_matches_corners(rng):
+    planes = camera_planes()
+    centers = rng.uniform(-40, 40, (500, 3)) - [0, 0, 20]
+    extents = rng.uniform(0.1, 6.0, (500, 3))
+    outside, inside = classify_aabbs(planes, centers - extents, centers + extents)
+
+    corners = centers[:, None, :] + extents[:, None, :] * np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+    distances = np.einsum("nck,pk->ncp", corners, planes[:, :3]) + planes[:, 3]
+    assert np.array_equal(outside, (distances < 0.0).all(axis=1).any(axis=1))
+    assert np.array_equal(inside, (distances >= 0.0).all(axis=(1, 2)))
+    assert outside.any() and inside.any() and (~outside & ~inside).any()
+
+@pytest.mark.parametrize("count", [1, 3, 4, 5, 37, 300])
+def test_cull_matches_brute_force_on_random_scenes(rng, count):
+    scene = SceneBVH()
+    items = random_boxes(count, rng)
+    scene.add_many(items)
+    for position, target in [((0, 0, 0), (0, 0, -1)), ((5, 3, -10), (-20, 0, -30)), ((0, 0, -80), (0, 0, 0))]:
+        planes = camera_planes(position, target)
+        assert culled(scene, planes) == brute_force(items, planes)
+
+def test_cull_without_planes_returns_everything(rng):
+    scene = SceneBVH()
+    items = random_boxes(20, rng)
+    scene.add_many(items)
+    assert culled(scene, None) == {id(item) for item in items}
+
+def test_cull_after_add_remove_and_refit(rng):
+    scene = SceneBVH()
+    items = random_boxes(120, rng)
+    for item in items[:60]:
+        scene.add(item)
+    planes = camera_planes()
+    assert culled(scene, planes) == brute_force(items[:60], planes)
+
+    # Added after the tree was built: a rebuild
+    scene.add_many(items[60:])
+    assert culled(scene, planes) == brute_force(items, planes)
+
+    # Removed with swap-remove
+    removed = items[::7]
+    for item in removed:
+        scene.remove(item)
+    items = [item for item in items if item not in removed]
+    assert culled(scene, planes) == brute_force(items, planes)
+
+    # Moved items are refitted, the tree keeps its structure
+    for step in range(3):
+        moved = [items[i] for i in rng.choice(len(items), 25, replace=False)]
+        for item in moved:
+            item.center = rng.uniform(-40, 40, 3).astype(np.float32) - [0, 0, 20]
+            scene.mark_moved(item)
+        assert culled(scene, planes) == brute_force(items, planes)
+        assert not scene.structure_dirty
+
+def test_refit_keeps_node_boxes_around_their_items(rng):
+    scene = SceneBVH()
+    items = random_boxes(50, rng)
+    scene.add_many(items)
+    scene.update()
+    for item in items[:10]:
+        item.center = item.center + 30.0
+        scene.mark_moved(item)
+    scene.update()
+    assert not scene.structure_dirty
+    # Every leaf holds the union of its items' boxes
+    leaves = np.arange(scene.leaf_count())
+    mins, maxs = scene.leaf_bounds(leaves)
+    assert np.array_equal(mins, scene.levels[0][0]) and np.array_equal(maxs, scene.levels[0][1])
+    # And every parent the union of its children
+    for level in range(1, len(scene.levels)):
+        child_mins, child_maxs = scene.levels[level - 1]
+        parent_mins, parent_maxs = scene.levels[level]
+        parents = np.arange(len(child_mins)) // 2
+        assert (parent_mins[parents] <= child_mins).all() and (parent_maxs[parents] >= child_maxs).all()
+
+def test_transform_aabb_contains_transformed_corners(rng):
+    angle = np.radians(30.0)
+    matrix = np.identity(4)
+    matrix[:3, :3] = [[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]]
+    matrix[:3, :3] *= 2.0
+    matrix[:3, 3] = [1, 2, 3]
+    mins, maxs = transform_aabb(matrix, [-1, -1, -1], [1, 1, 1])
+    corners = np.array([[x, y, z, 1] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]) @ matrix.T
+    assert np.allclose(mins, corners[:, :3].min(axis=0), atol=1e-5)
+    assert np.allclose(maxs, corners[:, :3].max(axis=0), atol=1e-5)
+
+def test_lod_hysteresis_at_threshold_boundaries():
+    scene = SceneBVH()
+    item = Box((0, 0, 0), (1, 1, 1))
+    scene.add(item)
+    scene.set_lod_thresholds(item, [0.5, 0.25])
+    index = np.array([scene.item_index[id(item)]])
+
+    def select(size):
+        changed, levels = scene.select_lods(index, np.array([size]))
+        return int(scene.lod_levels[index[0]]), len(changed)
+
+    # Switches to a coarser level only 10% below a threshold
+    assert select(0.46) == (0, 0)
+    assert select(0.451) == (0, 0)
+    assert select(0.449) == (1, 1)
+    # And back to the finer one only 10% above it
+    assert select(0.5) == (1, 0)
+    assert select(0.549) == (1, 0)
+    assert select(0.551) == (0, 1)
+    # Big jumps skip levels in one go
+    assert select(0.1) == (2, 1)
+    assert select(0.27) == (2, 0)
+    assert select(0.28) == (1, 1)
+    assert select(0.9) == (0, 1)
+
+def test_lod_levels_without_thresholds_stay_at_zero():
+    scene = SceneBVH()
+    items = [Box((0, 0, 0), (1, 1, 1)) for _ in range(3)]
+    scene.add_many(items)
+    scene.set_lod_thresholds(items[1], [0.3])
+    changed, levels = scene.select_lods(np.arange(3), np.array([0.01, 0.01, 0.01]))
+    assert changed.tolist() == [scene.item_index[id(items[1])]]
+    assert levels.tolist() == [1]
+    with pytest.raises(ValueError):
+        scene.set_lod_thresholds(items[0], [0.5, 0.4, 0.3, 0.2, 0.1])
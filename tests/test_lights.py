@@ -0,0 +1,94 @@
+from Graphics.Utils.lights import cluster_lights, depth_slicing, DEFAULT_GRID
+from Graphics.Engine import PointLight
+import numpy as np
+import pytest
+
+# cluster_lights has to be conservative: every point a light's radius reaches must land in a cluster that lists
+# the light, otherwise the fragment shader skips it there. Points are sampled inside the light spheres and
+# mapped to clusters the way find_cluster in default_fragment_shader does
+
+TAN_HALF_FOV = np.tan(np.radians(45.0) * 0.5)
+ASPECT = 16.0 / 9.0
+NEAR = 0.1
+FAR = 100.0
+
+def find_clusters(points, grid=DEFAULT_GRID):
+    # Cluster of each view space point, -1 for points outside the frustum
+    tiles_x, tiles_y, slices = grid
+    depth = -points[:, 2]
+    ndc_x = points[:, 0] / (depth * TAN_HALF_FOV * ASPECT)
+    ndc_y = points[:, 1] / (depth * TAN_HALF_FOV)
+    inside = (depth >= NEAR) & (depth <= FAR) & (np.abs(ndc_x) <= 1.0) & (np.abs(ndc_y) <= 1.0)
+
+    scale, bias = depth_slicing(NEAR, FAR, slices)
+    slice = np.clip(np.floor(np.log(np.where(inside, depth, NEAR)) * scale - bias), 0, slices - 1).astype(np.int64)
+    x = np.clip(np.floor((ndc_x + 1.0) * 0.5 * tiles_x), 0, tiles_x - 1).astype(np.int64)
+    y = np.clip(np.floor((ndc_y + 1.0) * 0.5 * tiles_y), 0, tiles_y - 1).astype(np.int64)
+    return np.where(inside, x + tiles_x * (y + tiles_y * slice), -1)
+
+def assigned_matrix(ranges, indices, light_count):
+    # assigned[cluster, light] is True when the cluster lists the light
+    clusters = np.repeat(np.arange(len(ranges)), ranges[:, 1].astype(np.int64))
+    assigned = np.zeros((len(ranges), light_count), dtype=bool)
+    assigned[clusters, indices.astype(np.int64)] = True
+    return assigned
+
+def sample_spheres(centers, radii, per_light, rng):
+    # Uniform points inside every sphere, with the light each one belongs to
+    owner = np.repeat(np.arange(len(centers)), per_light)
+    directions = rng.normal(size=(len(owner), 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    distances = radii[owner] * rng.random(len(owner)) ** (1.0 / 3.0)
+    return centers[owner] + directions * distances[:, None], owner
+
+def random_lights(count, rng):
+    # Lights in and around the frustum, some crossing the near plane and the sides
+    depth = rng.uniform(0.0, 60.0, count)
+    half_height = depth * TAN_HALF_FOV
+    centers = np.stack([rng.uniform(-1.3, 1.3, count) * half_height * ASPECT, rng.uniform(-1.3, 1.3, count) * half_height, -depth], axis=1)
+    return centers, rng.uniform(0.2, 6.0, count)
+
+def test_cluster_lights_is_conservative():
+    rng = np.random.default_rng(7)
+    centers, radii = random_lights(200, rng)
+    ranges, indices = cluster_lights(centers, radii, TAN_HALF_FOV, ASPECT, NEAR, FAR)
+    assigned = assigned_matrix(ranges, indices, len(centers))
+
+    points, owner = sample_spheres(centers, radii, 400, rng)
+    clusters = find_clusters(points)
+    inside = clusters >= 0
+    assert inside.sum() > 10000
+    missed = ~assigned[clusters[inside], owner[inside]]
+    assert missed.sum() == 0
+
+def test_cluster_lights_ranges_cover_indices():
+    rng = np.random.default_rng(3)
+    centers, radii = random_lights(50, rng)
+    ranges, indices = cluster_lights(centers, radii, TAN_HALF_FOV, ASPECT, NEAR, FAR)
+    assert ranges.shape == (int(np.prod(DEFAULT_GRID)), 2)
+    # Ranges are consecutive and together cover the whole light list
+    assert ranges[0, 0] == 0
+    assert np.array_equal(ranges[1:, 0], ranges[:-1, 0] + ranges[:-1, 1])
+    assert int(ranges[:, 1].sum()) == len(indices)
+    # A light is listed at most once per cluster
+    clusters = np.repeat(np.arange(len(ranges)), ranges[:, 1].astype(np.int64))
+    pairs = clusters * len(centers) + indices.astype(np.int64)
+    assert len(np.unique(pairs)) == len(pairs)
+
+def test_lights_outside_the_frustum_are_skipped():
+    # Behind the camera, past the far plane and far off to the side
+    centers = np.array([[0.0, 0.0, 5.0], [0.0, 0.0, -150.0], [500.0, 0.0, -10.0]])
+    radii = np.array([1.0, 10.0, 2.0])
+    ranges, indices = cluster_lights(centers, radii, TAN_HALF_FOV, ASPECT, NEAR, FAR)
+    assert len(indices) == 0
+    assert not ranges[:, 1].any()
+
+def test_point_light_radius_has_to_be_positive():
+    light = PointLight((0, 0, 0), (1, 1, 1), 1.0, 10.0)
+    assert light.linear == pytest.approx(0.45) and light.quadratic == pytest.approx(0.75)
+    for radius in (0.0, -1.0, float("nan")):
+        with pytest.raises(ValueError):
+            PointLight((0, 0, 0), (1, 1, 1), 1.0, radius)
+        with pytest.raises(ValueError):
+            light.radius = radius
+    assert light.radius == 10.0
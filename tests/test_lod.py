@@ -0,0 +1,66 @@
+from Graphics.Utils.lod import build_lods, cluster_vertices, decimate
+from Graphics.Utils import Shapes
+import numpy as np
+import pytest
+
+# Decimated meshes have to land at (not above) the requested triangle count and stay valid index buffers
+
+def wavy_grid(size: int):
+    # size x size quads of a bumpy surface, two triangles each
+    x, y = np.meshgrid(np.linspace(-1, 1, size + 1), np.linspace(-1, 1, size + 1))
+    positions = np.stack([x, y, 0.3 * np.sin(3 * x) * np.cos(2 * y)], axis=-1).reshape(-1, 3)
+    corner = np.arange(size)[:, None] * (size + 1) + np.arange(size)[None, :]
+    quads = np.stack([corner, corner + 1, corner + size + 2, corner, corner + size + 2, corner + size + 1], axis=-1)
+    return positions.astype(np.float32), quads.reshape(-1).astype(np.uint32)
+
+def check_valid(positions, indices):
+    assert indices.dtype == np.uint32 and len(indices) % 3 == 0
+    assert indices.max() < len(positions)
+    triangles = indices.reshape(-1, 3)
+    # No collapsed or repeated triangles, no unused vertices
+    assert ((triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])).all()
+    assert len(np.unique(np.sort(triangles, axis=1), axis=0)) == len(triangles)
+    assert len(np.unique(indices)) == len(positions)
+
+@pytest.mark.parametrize("ratio", [0.5, 0.25, 0.1, 0.02])
+def test_decimate_lands_near_ratio(ratio):
+    positions, indices = wavy_grid(64)
+    triangles = len(indices) // 3
+    lod_positions, lod_indices = decimate(positions, indices, ratio)
+    check_valid(lod_positions, lod_indices)
+    assert 0.8 * ratio * triangles <= len(lod_indices) // 3 <= ratio * triangles
+    # Clustered vertices stay inside the original bounds
+    assert (lod_positions >= positions.min(axis=0) - 1e-6).all() and (lod_positions <= positions.max(axis=0) + 1e-6).all()
+
+def test_decimate_keeps_meshes_it_cannot_reduce():
+    # Two triangles can't be reduced to a quarter without collapsing completely
+    positions, indices = wavy_grid(1)
+    assert np.array_equal(decimate(positions, indices, 0.25)[1], indices)
+    full_positions, full_indices = wavy_grid(8)
+    assert np.array_equal(decimate(full_positions, full_indices, 1.0)[1], full_indices)
+    assert len(decimate(full_positions, np.zeros(0, dtype=np.uint32), 0.5)[1]) == 0
+
+def test_cluster_vertices_cell_sizes():
+    positions, indices = wavy_grid(16)
+    # Cells smaller than the vertex spacing keep every triangle
+    fine_positions, fine_indices = cluster_vertices(positions, indices, 1e-3)
+    assert len(fine_indices) == len(indices)
+    check_valid(fine_positions, fine_indices)
+    # Coarser cells merge vertices to their cell's mean
+    coarse_positions, coarse_indices = cluster_vertices(positions, indices, 0.3)
+    check_valid(coarse_positions, coarse_indices)
+    assert len(coarse_positions) < len(positions) and len(coarse_indices) < len(indices)
+    # One cell for everything collapses every triangle
+    empty_positions, empty_indices = cluster_vertices(positions, indices, 10.0)
+    assert len(empty_indices) == 0 and len(empty_positions) == 0
+
+def test_build_lods_sets_levels():
+    positions, indices = wavy_grid(32)
+    mesh = Shapes.Mesh(None, positions, indices)
+    lods = build_lods(mesh)
+    counts = [lod.index_count // 3 for lod in lods]
+    assert mesh.lod_meshes == lods and len(mesh.lod_thresholds) == 3
+    assert counts[0] <= len(indices) // 6 and counts[0] > counts[1] > counts[2] > 0
+
+    lods = build_lods(mesh, [0.3], thresholds=[0.2])
+    assert len(lods) == 1 and mesh.lod_thresholds == [0.2]
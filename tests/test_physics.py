@@ -0,0 +1,126 @@
+from Graphics.Physics import PhysicsWorld
+import numpy as np
+import pytest
+
+# Fixed-step integration, the catch-up cap of advance() and writing simulated poses back to their objects
+
+class Handle:
+    # Stands in for an Object outside a scene store: assign_poses writes into get_trs() and calls changed_trs()
+    def __init__(self):
+        self.node = None
+        self.store = None
+        self.body = None
+        self.trs = np.zeros((3, 3), dtype=np.float32)
+        self.writes = 0
+
+    def get_trs(self):
+        return self.trs
+
+    def changed_trs(self):
+        self.writes += 1
+
+def test_step_integrates_gravity_and_forces():
+    world = PhysicsWorld(gravity=(0.0, -10.0, 0.0))
+    ids = world.add_bodies([[0, 0, 0], [5, 0, 0], [0, 5, 0]], velocities=[[1, 0, 0], [0, 0, 0], [0, 0, 0]], masses=[1.0, 0.0, 2.0])
+    world.angular_velocities[ids[0]] = [0.0, 90.0, 0.0]
+    world.apply_forces([ids[2]], [[0.0, 20.0, 0.0]])
+    world.step(0.5)
+
+    # Semi-implicit Euler: the velocity is updated first and moves the body in the same step
+    assert np.allclose(world.velocities[ids[0]], [1.0, -5.0, 0.0])
+    assert np.allclose(world.positions[ids[0]], [0.5, -2.5, 0.0])
+    assert np.allclose(world.angles[ids[0]], [0.0, 45.0, 0.0])
+    # Mass 0 is static, gravity doesn't apply
+    assert np.array_equal(world.positions[ids[1]], [5.0, 0.0, 0.0])
+    assert np.array_equal(world.velocities[ids[1]], [0.0, 0.0, 0.0])
+    # The force cancels gravity on the 2 kg body and is cleared after the step
+    assert np.allclose(world.velocities[ids[2]], [0.0, 0.0, 0.0])
+    assert np.array_equal(world.forces[:world.count], np.zeros((3, 3)))
+    assert world.steps == 1
+
+def test_step_separates_overlapping_spheres():
+    world = PhysicsWorld(gravity=(0.0, 0.0, 0.0))
+    ids = world.add_bodies([[0, 0, 0], [1.5, 0, 0]], velocities=[[1, 0, 0], [-1, 0, 0]])
+    world.set_sphere_colliders(ids, [1.0, 1.0])
+    world.step(0.1)
+    assert world.positions[ids[1], 0] - world.positions[ids[0], 0] == pytest.approx(2.0)
+    # No longer approaching
+    assert world.velocities[ids[1], 0] - world.velocities[ids[0], 0] >= 0.0
+
+def test_advance_runs_due_steps_and_keeps_the_remainder():
+    world = PhysicsWorld()
+    world.add_bodies([[0, 0, 0]])
+    calls = []
+    steps, accumulator = world.advance(0.035, 0.01, max_steps=5, before_step=calls.append)
+    assert steps == 3 and world.steps == 3
+    assert accumulator == pytest.approx(0.005)
+    assert calls == [0.01] * 3
+    assert world.dropped_time == 0.0
+
+def test_advance_caps_steps_and_drops_whole_steps():
+    world = PhysicsWorld()
+    world.add_bodies([[0, 0, 0]])
+    steps, accumulator = world.advance(0.1234, 0.01, max_steps=4)
+    assert steps == 4 and world.steps == 4
+    # Beyond the cap only whole steps are dropped, the fraction of a step carries over
+    assert accumulator == pytest.approx(0.0034)
+    assert world.dropped_time == pytest.approx(0.08)
+
+    steps, accumulator = world.advance(accumulator + 0.02, 0.01, max_steps=4)
+    assert steps == 2 and accumulator == pytest.approx(0.0034)
+    assert world.dropped_time == pytest.approx(0.08)
+
+def test_write_back_moving_bodies():
+    world = PhysicsWorld()
+    handles = [Handle(), Handle(), None]
+    ids = world.add_bodies([[0, 0, 0], [3, 0, 0], [6, 0, 0]], masses=[1.0, 0.0, 1.0], objects=handles)
+    assert [handle.body for handle in handles[:2]] == [0, 1]
+    # New bodies are written once, wherever they start
+    world.write_back()
+    assert [handle.writes for handle in handles[:2]] == [1, 1]
+    assert np.array_equal(handles[1].trs[0], [3.0, 0.0, 0.0])
+
+    world.angular_velocities[ids[0]] = [0.0, 0.0, 10.0]
+    world.step(0.1)
+    world.write_back()
+    assert np.allclose(handles[0].trs[0], world.positions[ids[0]])
+    assert np.allclose(handles[0].trs[1], [0.0, 0.0, 1.0])
+    # The static body didn't move and isn't written again
+    assert [handle.writes for handle in handles[:2]] == [2, 1]
+
+def test_write_back_body_at_rest_pushed_out_of_penetration():
+    world = PhysicsWorld(gravity=(0.0, 0.0, 0.0))
+    floor, box = Handle(), Handle()
+    ids = world.add_bodies([[0, -1, 0], [0, 0.25, 0]], masses=[0.0, 1.0], objects=[floor, box])
+    world.set_box_colliders(ids, [[5.0, 1.0, 5.0], [0.5, 0.5, 0.5]])
+    world.write_back()
+    assert box.writes == 1
+
+    world.step(0.01)
+    # Resting: the correction moved it without leaving it any velocity
+    assert np.array_equal(world.velocities[ids[1]], [0.0, 0.0, 0.0])
+    assert world.positions[ids[1], 1] == pytest.approx(0.5)
+    world.write_back()
+    assert box.writes == 2
+    assert box.trs[0, 1] == pytest.approx(0.5)
+    assert floor.writes == 1
+
+    # Settled, nothing left to write
+    world.step(0.01)
+    world.write_back()
+    assert box.writes == 2
+
+def test_write_back_follows_swap_remove():
+    world = PhysicsWorld(gravity=(0.0, 0.0, 0.0))
+    handles = [Handle() for _ in range(3)]
+    ids = world.add_bodies([[0, 0, 0], [1, 0, 0], [2, 0, 0]], objects=handles)
+    world.write_back()
+    # The last body takes over row 0 with its last written pose
+    world.remove_body(ids[0])
+    assert handles[2].body == 0 and handles[0].body is None
+    world.write_back()
+    assert [handle.writes for handle in handles] == [1, 1, 1]
+    world.positions[0] = [2.0, 1.0, 0.0]
+    world.write_back()
+    assert [handle.writes for handle in handles] == [1, 1, 2]
+    assert np.array_equal(handles[2].trs[0], [2.0, 1.0, 0.0])
@@ -0,0 +1,172 @@
+from Graphics.Utils.raycast import TriangleBVH, intersect_triangles
+from Graphics.Utils import Shapes
+from glm import vec3
+import numpy as np
+import pytest
+
+# Ray queries against a brute force reference: every ray against every raw triangle, solved as the linear system
+# o + t d = v0 + u e1 + v e2 (independent of the Moller-Trumbore code under test). Scene tests build their objects
+# far from the engine's default cube and limit the ray length so nothing else can be hit
+
+FAR_AWAY = np.array([1000.0, 0.0, 0.0])
+
+def reference(origins, directions, triangles, limits):
+    # (t, triangle) of the nearest hit per ray, inf / -1 for misses
+    origins = np.asarray(origins, dtype=np.float64)
+    directions = np.asarray(directions, dtype=np.float64)
+    limits = np.broadcast_to(np.asarray(limits, dtype=np.float64), (len(origins),))
+    v0, e1, e2 = triangles[:, 0], triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    best_t = np.full(len(origins), np.inf)
+    best = np.full(len(origins), -1)
+    for ray in range(len(origins)):
+        systems = np.stack([-np.broadcast_to(directions[ray], e1.shape), e1, e2], axis=2)
+        solvable = np.abs(np.linalg.det(systems)) > 1e-9
+        tuv = np.full((len(triangles), 3), -1.0)
+        tuv[solvable] = np.linalg.solve(systems[solvable], (origins[ray] - v0[solvable])[..., None])[..., 0]
+        t, u, v = tuv.T
+        hit = solvable & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0) & (t <= limits[ray])
+        if hit.any():
+            best[ray] = np.flatnonzero(hit)[np.argmin(t[hit])]
+            best_t[ray] = t[best[ray]]
+    return best_t, best
+
+def random_rays(count, rng, center=np.zeros(3), spread=3.0):
+    origins = center + rng.normal(size=(count, 3)) * spread
+    # Aimed near the center so most of them hit something
+    targets = center + rng.normal(size=(count, 3)) * 0.7
+    directions = targets - origins
+    return origins, directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+def world_triangles(mesh, matrix):
+    positions = mesh.vertex_data[:, 0:3].astype(np.float64) @ matrix[:3, :3].T + matrix[:3, 3]
+    return positions[mesh.indices.reshape(-1, 3).astype(np.int64)]
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(5)
+
+@pytest.fixture
+def holder(root):
+    # Parent object for one test's shapes, removed afterwards
+    obj = root.addObject("raycast_test", position=vec3(*FAR_AWAY))
+    yield obj
+    root.root.removeChild(obj.name)
+
+def test_intersect_triangles_matches_reference(rng):
+    triangles = rng.normal(size=(300, 3, 3))
+    origins, directions = random_rays(300, rng)
+    limits = rng.uniform(1.0, 6.0, 300)
+    t, hit = intersect_triangles(origins, directions, triangles[:, 0], triangles[:, 1], triangles[:, 2], limits)
+    for ray in range(0, 300, 30):
+        expected_t, expected = reference(origins[ray:ray + 1], directions[ray:ray + 1], triangles[ray:ray + 1], limits[ray])
+        assert hit[ray] == (expected[0] == 0)
+        if hit[ray]:
+            assert t[ray] == pytest.approx(expected_t[0], abs=1e-9)
+    assert hit.any() and not hit.all()
+
+@pytest.mark.parametrize("limit", [np.inf, 2.5])
+def test_triangle_bvh_matches_reference(rng, limit):
+    positions = rng.normal(size=(400, 3))
+    indices = rng.integers(0, 400, size=(600, 3)).reshape(-1)
+    tree = TriangleBVH(positions, indices)
+    origins, directions = random_rays(200, rng)
+    limits = np.full(200, limit)
+    rays, triangles, t, normals = tree.intersect(origins, directions, limits)
+
+    expected_t, expected = reference(origins, directions, positions[indices.reshape(-1, 3)], limits)
+    assert np.array_equal(rays, np.flatnonzero(expected >= 0))
+    assert np.allclose(t, expected_t[rays], atol=1e-9)
+    assert (t <= limit).all()
+    # Misses are both rays passing everything and, with a limit, rays stopping short
+    assert 0 < len(rays) < 200
+
+def test_triangle_bvh_refit_follows_vertex_edits(rng):
+    positions = rng.normal(size=(100, 3))
+    indices = rng.integers(0, 100, size=(150, 3)).reshape(-1)
+    tree = TriangleBVH(positions, indices)
+    positions = positions + rng.normal(size=(100, 3)) * 0.5
+    tree.refit(positions)
+    origins, directions = random_rays(100, rng)
+    rays, _, t, _ = tree.intersect(origins, directions, np.full(100, np.inf))
+    expected_t, expected = reference(origins, directions, positions[indices.reshape(-1, 3)], np.inf)
+    assert np.array_equal(rays, np.flatnonzero(expected >= 0))
+    assert np.allclose(t, expected_t[rays], atol=1e-9)
+
+def test_cast_mesh_hit_normal_and_max_distance(root, holder):
+    holder.addShape("cube", Shapes.Cube(None))
+    origin = FAR_AWAY + [0.0, 0.0, 5.0]
+    hit = root.raycast(origin, (0, 0, -2))
+    assert hit.object is holder and hit.shape is holder.shapes["cube"]
+    assert hit.distance == pytest.approx(4.0)
+    assert np.allclose(hit.point, FAR_AWAY + [0.0, 0.0, 1.0])
+    assert np.allclose(hit.normal, (0.0, 0.0, 1.0))
+    assert root.raycast(origin, (0, 0, -1), max_distance=3.9) is None
+    assert root.raycast(origin, (0, 0, 1), max_distance=50.0) is None
+
+def test_cast_instanced_group_matches_reference(root, holder, rng):
+    group = holder.addInstancedGroup("group", Shapes.Sphere(None, radius=0.5, slices=12, stacks=6))
+    group.add_instances(rng.uniform(-2, 2, size=(12, 3)), angles=rng.uniform(0, 90, size=(12, 3)), scales=rng.uniform(0.5, 1.5, size=(12, 3)))
+    origins, directions = random_rays(150, rng, FAR_AWAY)
+    hits = root.raycast_many(origins, directions, 20.0)
+
+    matrices = group.get_instance_model_matrices().astype(np.float64)
+    triangles = np.concatenate([world_triangles(group.mesh, matrix) for matrix in matrices])
+    per_instance = group.mesh.index_count // 3
+    expected_t, expected = reference(origins, directions, triangles, 20.0)
+    assert 0 < hits.hit.sum() < len(hits)
+    assert np.array_equal(hits.hit, expected >= 0)
+    assert np.allclose(hits.distance[hits.hit], expected_t[hits.hit], atol=1e-5)
+    rays = np.flatnonzero(hits.hit)
+    assert np.array_equal(hits.instance[rays], expected[rays] // per_instance)
+    assert np.array_equal(hits.triangle[rays], expected[rays] % per_instance)
+    assert all(hits.objects[ray] is group and hits.shapes[ray] is group.mesh for ray in rays)
+
+def test_cast_skips_hidden_static_members(root, holder):
+    front = holder.addChild("front", position=vec3(0, 0, 2))
+    front.addShape("cube", Shapes.Cube(None))
+    back = holder.addChild("back")
+    back.addShape("cube", Shapes.Cube(None))
+    holder.make_static()
+    origin = FAR_AWAY + [0.0, 0.0, 10.0]
+
+    hit = root.raycast(origin, (0, 0, -1), 50.0)
+    assert hit.shape is front.shapes["cube"] and hit.object is front
+    assert hit.distance == pytest.approx(7.0)
+
+    front.set_static_hidden(True)
+    hit = root.raycast(origin, (0, 0, -1), 50.0)
+    assert hit.shape is back.shapes["cube"] and hit.object is back
+    assert hit.distance == pytest.approx(9.0)
+
+    back.set_static_hidden(True)
+    assert root.raycast(origin, (0, 0, -1), 50.0) is None
+
+def test_cast_refits_after_update_vertices(root, holder, rng):
+    positions = np.array([[-1, -1, 0], [1, -1, 0], [0, 1, 0], [-1, -1, -2], [1, -1, -2], [0, 1, -2]], dtype=np.float32)
+    mesh = Shapes.Mesh(None, positions, np.arange(6, dtype=np.uint32))
+    holder.addShape("triangles", mesh)
+    origins, directions = random_rays(60, rng, FAR_AWAY, 2.0)
+
+    first = root.raycast_many(origins, directions, 20.0)
+    tree = root.raycaster.get_tree(mesh)
+    count = mesh.edit_count
+
+    mesh.update_vertices([0, 1, 2], positions[:3] + [0.0, 0.5, 1.0])
+    assert mesh.edit_count > count
+    hits = root.raycast_many(origins, directions, 20.0)
+    # The same tree, refitted in place
+    assert root.raycaster.get_tree(mesh) is tree
+
+    triangles = world_triangles(mesh, holder.get_world_matrix().astype(np.float64))
+    expected_t, expected = reference(origins, directions, triangles, 20.0)
+    assert 0 < hits.hit.sum() < len(hits)
+    assert np.array_equal(hits.hit, expected >= 0)
+    assert np.allclose(hits.distance[hits.hit], expected_t[hits.hit], atol=1e-5)
+    assert not np.array_equal(first.distance, hits.distance)
+
+def test_pick_center_pixel(root):
+    camera = root.get_activeCamera()
+    hit = root.pick(camera.width // 2, camera.height // 2)
+    assert hit is not None and hit.object is root.find("Root/Cube")
+    origins, directions = camera.get_rays([0, camera.width - 1], [0, camera.height - 1])
+    assert np.allclose(np.linalg.norm(directions, axis=1), 1.0)
@@ -0,0 +1,157 @@
+from Graphics.Utils.scene_store import SceneNode, SceneStore
+from Graphics.Utils import transforms
+import numpy as np
+import pytest
+
+# Batched world matrices against a naive recursive parent @ local product per node, through allocation,
+# release, row reuse and re-parenting (a handle released and attached again under another parent)
+
+def random_trs(rng, count):
+    trs = np.empty((count, 3, 3), dtype=np.float32)
+    trs[:, 0] = rng.uniform(-5, 5, (count, 3))
+    trs[:, 1] = rng.uniform(-180, 180, (count, 3))
+    trs[:, 2] = rng.uniform(0.5, 2.0, (count, 3))
+    return trs
+
+def naive_world(store, node):
+    trs = store.trs[node].astype(np.float64)
+    local = transforms.compose_matrices(trs[0], trs[1], trs[2])[0].astype(np.float64)
+    parent = int(store.parents[node])
+    return local if parent < 0 else naive_world(store, parent) @ local
+
+def alive(store):
+    return [node for node in range(store.count) if store.handles[node] is not None]
+
+def check_world(store):
+    store.update()
+    for node in alive(store):
+        assert np.allclose(store.world[node], naive_world(store, node), atol=1e-3), node
+
+def descendants(store, nodes) -> set:
+    found = set(nodes)
+    grown = True
+    while grown:
+        children = {node for node in alive(store) if int(store.parents[node]) in found}
+        grown = not children <= found
+        found |= children
+    return found
+
+def make_node(trs):
+    handle = SceneNode()
+    handle.init_transform(trs[0], trs[1], trs[2])
+    return handle
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(7)
+
+@pytest.fixture
+def tree(rng):
+    # A few roots with random subtrees, some allocated one at a time and some in batches
+    store = SceneStore(capacity=4)
+    handles = []
+    for _ in range(3):
+        handle = make_node(random_trs(rng, 1)[0])
+        handle.attach_node(store, -1)
+        handles.append(handle)
+    for _ in range(60):
+        parent = handles[rng.integers(len(handles))]
+        handle = make_node(random_trs(rng, 1)[0])
+        handle.attach_node(store, parent.node)
+        handles.append(handle)
+    for _ in range(4):
+        parents = [handles[index].node for index in rng.integers(len(handles), size=25)]
+        batch = [make_node(trs) for trs in random_trs(rng, 25)]
+        SceneNode.attach_many(batch, store, parents, np.stack([handle.detached for handle in batch]))
+        handles.extend(batch)
+    # Batches whose parents are inside the batch itself
+    batch = [make_node(trs) for trs in random_trs(rng, 10)]
+    SceneNode.attach_many(batch, store, [handles[0].node] + [store.count + row for row in range(9)], random_trs(rng, 10))
+    handles.extend(batch)
+    return store, handles
+
+def test_update_matches_naive_product(tree):
+    store, handles = tree
+    check_world(store)
+    assert max(store.depths[:store.count]) >= 10
+    for handle in handles[::17]:
+        assert np.allclose(handle.get_world_array(), naive_world(store, handle.node), atol=1e-3)
+
+def test_update_after_local_changes(tree, rng):
+    store, handles = tree
+    check_world(store)
+    for step in range(5):
+        for handle in rng.choice(handles, 15, replace=False):
+            handle.get_trs()[:] = random_trs(rng, 1)[0]
+            handle.changed_trs()
+        check_world(store)
+
+def test_take_moved_reports_dirtied_subtrees(tree, rng):
+    store, handles = tree
+    store.update()
+    store.take_moved()
+    assert len(store.take_moved()) == 0
+
+    for step in range(5):
+        marked = [int(node) for node in rng.choice(alive(store), 6, replace=False)]
+        store.mark_many(marked)
+        store.update()
+        assert set(store.take_moved().tolist()) == descendants(store, marked)
+        assert len(store.take_moved()) == 0
+
+    # Nothing dirty, nothing moved
+    store.update()
+    assert len(store.take_moved()) == 0
+
+def test_release_and_reuse_rows(tree, rng):
+    store, handles = tree
+    check_world(store)
+    # Release a whole subtree the way Object.removeChild does
+    top = handles[5]
+    subtree = descendants(store, [top.node])
+    released = [handle for handle in handles if handle.node in subtree]
+    for handle in released:
+        handle.release_node()
+    assert all(handle.node is None for handle in released)
+    assert set(store.free_ids) == subtree
+    check_world(store)
+    assert not set(store.take_moved().tolist()) & subtree
+
+    # Single allocations take the freed rows back before growing the store
+    count = store.count
+    parent = handles[0]
+    fresh = [make_node(trs) for trs in random_trs(rng, len(subtree))]
+    for handle in fresh:
+        handle.attach_node(store, parent.node)
+    assert store.count == count and {handle.node for handle in fresh} == subtree
+    assert store.free_ids == []
+    check_world(store)
+    assert set(store.take_moved().tolist()) >= subtree
+
+def test_reparent_keeps_local_transform(tree, rng):
+    store, handles = tree
+    check_world(store)
+    # Move a subtree under another node: its rows are released and attached again parents first, the local
+    # transforms come along in the handles
+    top = handles[8]
+    order = sorted(descendants(store, [top.node]), key=lambda node: store.depths[node])
+    moving = [store.handles[node] for node in order]
+    parents = {id(handle): store.handles[int(store.parents[handle.node])] for handle in moving[1:]}
+    locals_before = {id(handle): handle.get_local_array().copy() for handle in moving}
+
+    targets = [handle for handle in handles if handle.node is not None and handle.node not in order]
+    new_parent = targets[rng.integers(len(targets))]
+    for handle in moving:
+        handle.release_node()
+    store.take_moved()
+    for handle in moving:
+        parent = new_parent if handle is top else parents[id(handle)]
+        handle.attach_node(store, parent.node)
+
+    assert store.parents[top.node] == new_parent.node
+    assert store.depths[top.node] == store.depths[new_parent.node] + 1
+    for handle in moving:
+        assert np.array_equal(handle.get_local_array(), locals_before[id(handle)])
+        assert store.depths[handle.node] == store.depths[store.parents[handle.node]] + 1
+    check_world(store)
+    assert set(store.take_moved().tolist()) == {handle.node for handle in moving}
@@ -0,0 +1,58 @@
+from Graphics.Utils.shader_utils import ProgramBinaryCache, ShaderProgram, program_key, default_vertex_shader, default_fragment_shader
+from OpenGL.GL import glGetProgramiv, GL_LINK_STATUS
+import glob
+import os
+import numpy as np
+import pytest
+
+# A cached program binary the driver refuses (unknown format after a driver update, corrupted file) must fall back
+# to compiling from source and replace the stale file, never fail the engine start
+
+def cached_file(directory) -> str:
+    files = glob.glob(os.path.join(directory, "*.bin"))
+    assert len(files) == 1
+    return files[0]
+
+@pytest.fixture
+def cache(root, tmp_path):
+    cache = ProgramBinaryCache(str(tmp_path))
+    program = ShaderProgram(default_vertex_shader, default_fragment_shader, cache)
+    if not glob.glob(os.path.join(str(tmp_path), "*.bin")):
+        pytest.skip("driver without program binary support")
+    assert not program.from_binary
+    return cache
+
+def rewrite(path: str, offset: int, data: bytes):
+    with open(path, "r+b") as file:
+        file.seek(offset)
+        file.write(data)
+
+def test_valid_binary_is_used(cache):
+    program = ShaderProgram(default_vertex_shader, default_fragment_shader, cache)
+    assert program.from_binary
+    assert glGetProgramiv(program.id, GL_LINK_STATUS)
+
+def test_unknown_binary_format_falls_back_to_source(cache):
+    path = cached_file(cache.directory)
+    rewrite(path, 8, np.array([0xDEADBEEF], dtype="<u4").tobytes())
+    program = ShaderProgram(default_vertex_shader, default_fragment_shader, cache)
+    assert not program.from_binary
+    assert glGetProgramiv(program.id, GL_LINK_STATUS)
+    # The stale file was replaced by the binary of the program built from source
+    assert ShaderProgram(default_vertex_shader, default_fragment_shader, cache).from_binary
+
+def test_corrupted_binary_falls_back_to_source(cache):
+    path = cached_file(cache.directory)
+    size = os.path.getsize(path)
+    rewrite(path, 12, bytes(np.random.default_rng(0).integers(0, 256, size - 12, dtype=np.uint8)))
+    program = ShaderProgram(default_vertex_shader, default_fragment_shader, cache)
+    assert not program.from_binary
+    assert glGetProgramiv(program.id, GL_LINK_STATUS)
+
+@pytest.mark.parametrize("data", [b"", b"GLPROG", b"NOTAPROGRAMFILE!"])
+def test_truncated_or_foreign_file_falls_back_to_source(cache, data):
+    path = cached_file(cache.directory)
+    with open(path, "wb") as file:
+        file.write(data)
+    assert cache.load(program_key(default_vertex_shader, default_fragment_shader)) is None
+    assert not os.path.exists(path)